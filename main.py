@@ -18,6 +18,7 @@ from models.event_loop import vir_event_loop_poll_register, vir_event_loop_poll_
 from models import Host
 from models import Utils
 from models import PidFile
+from models import GuestFSPool
 
 
 __author__ = 'James Iter'
@@ -44,6 +45,9 @@ def main():
         target=Host().guest_state_report_engine, args=())
     threads.append(t_)
 
+    t_ = threading.Thread(target=Host().guest_state_flush_engine, args=())
+    threads.append(t_)
+
     t_ = threading.Thread(target=Host().instruction_process_engine, args=())
     threads.append(t_)
 
@@ -56,6 +60,29 @@ def main():
     t_ = threading.Thread(target=Host().host_performance_collection_engine, args=())
     threads.append(t_)
 
+    t_ = threading.Thread(target=Host().glusterfs_pool_engine, args=())
+    threads.append(t_)
+
+    if config['trash_delay'] >= 0:
+        t_ = threading.Thread(target=Host().trash_reaper_engine, args=())
+        threads.append(t_)
+
+    if config['image_allocation_dirs']:
+        t_ = threading.Thread(target=Host().image_allocation_engine, args=())
+        threads.append(t_)
+
+    if config['warm_image_pool']:
+        t_ = threading.Thread(target=Host().warm_image_pool_engine, args=())
+        threads.append(t_)
+
+    # 预先启动 libguestfs appliance，避免首批 Guest 创建时等待 launch
+    t_ = threading.Thread(target=GuestFSPool.warm, args=())
+    threads.append(t_)
+
+    if config['metrics_listen']:
+        t_ = threading.Thread(target=Host().metrics_exporter_engine, args=())
+        threads.append(t_)
+
     vir_event_loop_poll_register()
     t_ = threading.Thread(target=vir_event_loop_poll_run, name="libvirtEventLoop")
     threads.append(t_)
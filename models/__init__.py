@@ -5,6 +5,9 @@
 from status import (
     EmitKind,
     GuestState,
+    GuestStateReportKind,
+    GuestInitializeMode,
+    SnapshotMode,
     HostEvent,
     LogLevel,
     ResponseState,
@@ -20,20 +23,87 @@ from initialize import (
     Init
 )
 
+from progress import (
+    ProgressTracker
+)
+
+from guestfs_pool import (
+    GuestFSPool
+)
+
+from cloud_init import (
+    CloudInit
+)
+
+from guest_state import (
+    GuestStateTable
+)
+
 from guest import (
     Guest
 )
 
+from copy_engine import (
+    CopyEngine
+)
+
+from qcow2 import (
+    Qcow2
+)
+
+from qemu_img import (
+    QemuImg
+)
+
+from backup import (
+    IncrementalBackup
+)
+
+from gluster_pool import (
+    GlusterFSPool
+)
+from trash import (
+    Trash
+)
+
+from storage_scheduler import (
+    StorageScheduler
+)
+
+from template_cache import (
+    TemplateCache
+)
+
 from storage import (
     Storage
 )
 
+from fan_out import (
+    FanOutCopy
+)
+
+from warm_pool import (
+    WarmImagePool
+)
+
+from image_allocation import (
+    ImageAllocation
+)
+
+from pressure import (
+    Pressure
+)
+
+from metrics import (
+    Metrics, StageTimer
+)
+
 from host import (
     Host
 )
 
 from utils import (
-    Utils, QGA, Emit
+    Utils, QGA, Emit, SSHPool
 )
 
 
@@ -45,6 +115,11 @@ __copyright__ = '(c) 2017 by James Iter.'
 
 __all__ = [
     'Init', 'Guest', 'Storage', 'Host', 'Utils', 'QGA', 'Emit', 'EmitKind', 'GuestState', 'HostEvent', 'LogLevel',
-    'ResponseState', 'GuestCollectionPerformanceDataKind', 'HostCollectionPerformanceDataKind', 'PidFile'
+    'ResponseState', 'GuestCollectionPerformanceDataKind', 'HostCollectionPerformanceDataKind', 'PidFile',
+    'Pressure', 'Metrics', 'GuestStateTable', 'GuestStateReportKind',
+    'TemplateCache', 'CopyEngine', 'ProgressTracker', 'GuestFSPool',
+    'CloudInit', 'GuestInitializeMode', 'SnapshotMode', 'WarmImagePool', 'FanOutCopy', 'StageTimer', 'Qcow2',
+    'StorageScheduler', 'GlusterFSPool', 'Trash', 'ImageAllocation', 'QemuImg',
+    'IncrementalBackup', 'SSHPool'
 ]
 
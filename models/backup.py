@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import json
+import time
+import uuid
+import traceback
+
+import libvirt
+import libvirt_qemu
+import xml.etree.ElementTree as ET
+
+from initialize import config, logger
+from metrics import Metrics
+from qemu_img import QemuImg
+from jimvn_exception import CommandExecFailed
+
+
+__author__ = 'James Iter'
+__date__ = '2026/10/19'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2026 by James Iter.'
+
+
+class IncrementalBackup(object):
+    """
+    基于持久化脏位图的增量备份。每个磁盘维护一个名为 backup_bitmap_name 的持久化位图，记录上次备份以来写过的块。
+    首次备份(或位图丢失时)为全量备份，之后只导出位图中的块，写入以上一次备份为后端镜像的 qcow2，
+    因此目标目录中每个磁盘的备份链可直接用于恢复。备份由 qemu 以流的方式在后台执行，Guest 无需暂停。
+    需要 qemu 2.12 及以上版本。
+    """
+
+    @staticmethod
+    def qmp(dom=None, execute=None, arguments=None):
+        command = {'execute': execute}
+
+        if arguments is not None:
+            command['arguments'] = arguments
+
+        ret = json.loads(libvirt_qemu.qemuMonitorCommand(dom, json.dumps(command),
+                                                         libvirt_qemu.VIR_DOMAIN_QEMU_MONITOR_COMMAND_DEFAULT))
+
+        if 'error' in ret:
+            raise CommandExecFailed(u' '.join([execute, u'执行失败：', ret['error'].get('desc', u'')]))
+
+        return ret.get('return')
+
+    @staticmethod
+    def disks(dom=None, devs=None):
+        """
+        :return: [(dev, 设备别名, 镜像路径), ...]，仅含 device 为 disk 的磁盘
+        """
+        disks = list()
+
+        for disk in ET.fromstring(dom.XMLDesc()).findall('devices/disk'):
+            dev = disk.find('target').get('dev')
+
+            if disk.get('device') != 'disk' or disk.find('alias') is None:
+                continue
+
+            if devs is not None and dev not in devs:
+                continue
+
+            source = disk.find('source')
+            disks.append((dev, 'drive-' + disk.find('alias').get('name'), source.get('file') or source.get('name')))
+
+        return disks
+
+    @classmethod
+    def block_info(cls, dom=None, device=None):
+        """
+        :return: (虚拟大小, 已有的位图名称列表)
+        """
+        for block in cls.qmp(dom=dom, execute='query-block'):
+            if block['device'] == device:
+                bitmaps = [bitmap['name'] for bitmap in block.get('dirty-bitmaps', list())]
+                return block['inserted']['image']['virtual-size'], bitmaps
+
+        raise CommandExecFailed(u' '.join([u'未找到块设备', device]))
+
+    @staticmethod
+    def chain_dir(target_dir=None, path=None):
+        # 以磁盘 uuid 划分备份链目录
+        return os.path.join(target_dir, os.path.basename(path).split('.')[0])
+
+    @staticmethod
+    def previous(chain_dir=None):
+        backups = sorted([name for name in os.listdir(chain_dir) if name.endswith('.qcow2')])
+
+        if not backups:
+            return None
+
+        return os.path.join(chain_dir, backups[-1])
+
+    @classmethod
+    def wait(cls, dom=None, job_id=None, progress=None, interval=1):
+        """
+        等待 qemu 作业结束。作业以 auto-dismiss 为 false 启动，结束后保留状态以便取得错误信息，再由此处清除
+        """
+        while True:
+            job = None
+
+            for item in cls.qmp(dom=dom, execute='query-jobs'):
+                if item['id'] == job_id:
+                    job = item
+
+            if job is None:
+                raise CommandExecFailed(u' '.join([u'备份作业', job_id, u'已不存在']))
+
+            if progress is not None and job['total-progress'] > 0:
+                progress(job['current-progress'], job['total-progress'])
+
+            if job['status'] == 'concluded':
+                cls.qmp(dom=dom, execute='job-dismiss', arguments={'id': job_id})
+
+                if 'error' in job:
+                    raise CommandExecFailed(u' '.join([u'备份作业', job_id, u'失败：', job['error']]))
+
+                return
+
+            time.sleep(interval)
+
+    @classmethod
+    def backup_disk(cls, dom=None, dev=None, device=None, path=None, target_dir=None, full=False, speed=0,
+                    progress=None):
+        """
+        :return: {'dev', 'path', 'mode', 'size'}
+        """
+        bitmap = config['backup_bitmap_name']
+        virtual_size, bitmaps = cls.block_info(dom=dom, device=device)
+
+        chain_dir = cls.chain_dir(target_dir=target_dir, path=path)
+
+        if not os.path.isdir(chain_dir):
+            os.makedirs(chain_dir, 0755)
+
+        previous = cls.previous(chain_dir=chain_dir)
+        # 位图缺失(如首次备份、外部快照切换了活动层)或没有上一次的备份时，只能全量备份
+        full = full or bitmap not in bitmaps or previous is None
+        # 以毫秒时间戳开头，previous 按名称排序即得最近一次的备份；随机后缀避免重名
+        suffix = uuid.uuid4().hex[:8]
+        target = os.path.join(chain_dir, '.'.join(['-'.join([str(int(time.time() * 1000)), suffix]), 'qcow2']))
+        job_id = '-'.join(['backup', device, suffix])
+
+        args = ['create', '-f', 'qcow2', target, str(virtual_size)]
+
+        if not full:
+            args = ['create', '-f', 'qcow2', '-F', 'qcow2', '-b', previous, target, str(virtual_size)]
+
+        exit_status, output = QemuImg.run(args=args, timeout=config['qemu_img_timeout'])
+
+        if exit_status != 0:
+            raise CommandExecFailed(u' '.join([u'路径', target, u'创建备份目标时，命令执行退出异常：', output]))
+
+        backup = {'job-id': job_id, 'device': device, 'target': target, 'format': 'qcow2', 'mode': 'existing',
+                  'speed': speed, 'auto-dismiss': False}
+
+        try:
+            if full:
+                backup['sync'] = 'full'
+
+                # 清空(或新建)位图与全量备份在同一事务中开始，使两者的起点一致
+                if bitmap in bitmaps:
+                    bitmap_action = {'type': 'block-dirty-bitmap-clear', 'data': {'node': device, 'name': bitmap}}
+
+                else:
+                    bitmap_action = {'type': 'block-dirty-bitmap-add',
+                                     'data': {'node': device, 'name': bitmap, 'persistent': True}}
+
+                cls.qmp(dom=dom, execute='transaction', arguments={'actions': [
+                    bitmap_action, {'type': 'drive-backup', 'data': backup}]})
+
+            else:
+                # 成功时位图被清空，失败时保留，下次备份仍包含这些块
+                backup['sync'] = 'incremental'
+                backup['bitmap'] = bitmap
+                cls.qmp(dom=dom, execute='drive-backup', arguments=backup)
+
+            cls.wait(dom=dom, job_id=job_id, progress=progress)
+
+        except:
+            if os.path.exists(target):
+                os.remove(target)
+
+            # 全量备份前位图已被清空(或新建)，此时失败，位图已不能反映上一次备份以来的变化。
+            # 删除位图，使下次备份必为全量，否则其将以更早的备份为基础增量，遗漏其间写入的块
+            if full:
+                try:
+                    cls.qmp(dom=dom, execute='block-dirty-bitmap-remove', arguments={'node': device, 'name': bitmap})
+
+                except:
+                    logger.error(traceback.format_exc())
+
+            raise
+
+        size = os.stat(target).st_blocks * 512
+        mode = 'full' if full else 'incremental'
+
+        Metrics.inc(name='jimvn_backup_bytes_total', value=size, labels={'mode': mode},
+                    _help='bytes written by disk backups')
+        logger.info(msg=u' '.join([u'磁盘', dev, u'已备份至', target, u'，方式', mode]))
+
+        return {'dev': dev, 'path': target, 'mode': mode, 'size': size}
+
+    @classmethod
+    def run(cls, dom=None, target_dir=None, devs=None, full=False, speed=0, progress=None):
+        """
+        依次备份 Guest 的各磁盘
+        :param progress: 进度回调 progress(done, total)，按磁盘数量均分
+        :return: 各磁盘的备份结果
+        """
+        assert isinstance(dom, libvirt.virDomain)
+
+        if not dom.isActive():
+            raise RuntimeError(u'增量备份需在 Guest 运行时进行。')
+
+        disks = cls.disks(dom=dom, devs=devs)
+        results = list()
+        begin = time.time()
+
+        for i, (dev, device, path) in enumerate(disks):
+            def _progress(done, total):
+                if progress is not None:
+                    progress(i * total + done, disks.__len__() * total)
+
+            results.append(cls.backup_disk(dom=dom, dev=dev, device=device, path=path, target_dir=target_dir,
+                                           full=full, speed=speed, progress=_progress))
+
+        Metrics.observe(name='jimvn_backup_seconds', value=time.time() - begin, _help='time spent backing up guests')
+        return results
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import json
+import pipes
+import base64
+import shutil
+import tempfile
+import traceback
+import xml.etree.ElementTree as ET
+
+import libvirt
+
+from initialize import config, logger
+from jimvn_exception import CommandExecFailed
+from status import OSTemplateInitializeOperateKind
+from utils import Utils
+
+
+__author__ = 'James Iter'
+__date__ = '2026/10/19'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2026 by James Iter.'
+
+
+class CloudInit(object):
+    """
+    cloud-init NoCloud 数据源。把模板初始化操作转换为 user-data，与 meta-data 一起打包为卷标为 cidata 的 ISO，
+    定义 Guest 时以光驱挂入，由 Guest 在首次启动时自行应用，无需离线挂载系统盘。
+    seed 中含有明文的初始化内容(如密码)，仅 root 可读。Guest 的 agent 首次连接后弹出光驱并删除 seed，
+    迁移前亦如此，使 Guest 不再依赖本节点的本地文件。
+    """
+
+    @staticmethod
+    def seed_path(uuid=None):
+        return os.path.join(config['cloud_init_seed_path'], uuid + '.iso')
+
+    @staticmethod
+    def user_data(os_template_initialize_operates=None):
+        """
+        JSON 是 YAML 的子集，故无需依赖 YAML 库。
+        cloud-init 的 write_files 总是先于 runcmd 执行，为保持初始化操作原有的先后顺序，写文件也转换为 runcmd 中的命令
+        """
+        runcmd = list()
+
+        for operate in os_template_initialize_operates:
+            if operate['kind'] == OSTemplateInitializeOperateKind.cmd.value:
+                runcmd.append(['sh', '-c', operate['command']])
+
+            elif operate['kind'] in [OSTemplateInitializeOperateKind.write_file.value,
+                                     OSTemplateInitializeOperateKind.append_file.value]:
+
+                content = operate['content']
+                if isinstance(content, unicode):
+                    content = content.encode('utf-8')
+
+                redirect = '>'
+                if operate['kind'] == OSTemplateInitializeOperateKind.append_file.value:
+                    redirect = '>>'
+
+                # 以 base64 传递内容，避免转义问题
+                runcmd.append(['sh', '-c', ' '.join([
+                    'mkdir -p', pipes.quote(os.path.dirname(operate['path'])), '&&',
+                    'echo', base64.b64encode(content), '| base64 -d', redirect, pipes.quote(operate['path'])])])
+
+        cloud_config = dict()
+
+        if runcmd:
+            cloud_config['runcmd'] = runcmd
+
+        return '\n'.join(['#cloud-config', json.dumps(cloud_config, indent=2), ''])
+
+    @staticmethod
+    def meta_data(uuid=None, name=None):
+        return json.dumps({'instance-id': uuid, 'local-hostname': name}, indent=2) + '\n'
+
+    @classmethod
+    def make_seed(cls, uuid=None, name=None, os_template_initialize_operates=None):
+        """
+        :return: seed 镜像路径
+        """
+        path = cls.seed_path(uuid=uuid)
+
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), 0700)
+
+        # 先以 0600 创建，genisoimage 写入已存在的文件时保留其权限
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600))
+        os.chmod(path, 0600)
+
+        tmp_dir = tempfile.mkdtemp(prefix='jimvn_cidata_')
+
+        try:
+            with open(os.path.join(tmp_dir, 'user-data'), 'w') as f:
+                f.write(cls.user_data(os_template_initialize_operates=os_template_initialize_operates))
+
+            with open(os.path.join(tmp_dir, 'meta-data'), 'w') as f:
+                f.write(cls.meta_data(uuid=uuid, name=name))
+
+            cmd = ' '.join(['genisoimage', '-output', path, '-volid', 'cidata', '-joliet', '-rock',
+                            os.path.join(tmp_dir, 'user-data'), os.path.join(tmp_dir, 'meta-data')])
+            exit_status, output = Utils.shell_cmd(cmd)
+
+            if exit_status != 0:
+                err = u' '.join([u'路径', path, u'生成 cloud-init seed 镜像时，命令执行退出异常：', str(output)])
+                raise CommandExecFailed(err)
+
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        return path
+
+    @staticmethod
+    def attach(xml=None, path=None):
+        """
+        :return: 挂入 seed 光驱后的域 XML
+        """
+        root = ET.fromstring(xml)
+        devices = root.find('devices')
+
+        # q35 机型没有 IDE 控制器
+        bus = 'ide'
+        os_type = root.find('os/type')
+        if os_type is not None and 'q35' in str(os_type.get('machine')):
+            bus = 'sata'
+
+        used = [disk.find('target').get('dev') for disk in devices.findall('disk')]
+        prefix = {'ide': 'hd', 'sata': 'sd'}[bus]
+        dev = [prefix + c for c in 'dcbefghijklmnopqrstuvwxyz' if prefix + c not in used][0]
+
+        disk = ET.SubElement(devices, 'disk', {'type': 'file', 'device': 'cdrom'})
+        ET.SubElement(disk, 'driver', {'name': 'qemu', 'type': 'raw'})
+        ET.SubElement(disk, 'source', {'file': path})
+        ET.SubElement(disk, 'target', {'dev': dev, 'bus': bus})
+        ET.SubElement(disk, 'readonly')
+
+        return ET.tostring(root)
+
+    @classmethod
+    def has_seed(cls, uuid=None):
+        return os.path.exists(cls.seed_path(uuid=uuid))
+
+    @classmethod
+    def detach(cls, dom=None):
+        """
+        弹出 seed 光驱中的介质，并删除 seed 镜像。
+        cloud-init 在首次启动的早期阶段(先于 guest agent 启动)即读取 seed 并缓存于 Guest 中，其后不再需要 seed。
+        光驱设备本身保留，空的光驱不影响迁移。
+        :return: 是否弹出了 seed
+        """
+        assert isinstance(dom, libvirt.virDomain)
+
+        path = cls.seed_path(uuid=dom.UUIDString())
+        ejected = False
+
+        for disk in ET.fromstring(dom.XMLDesc()).findall('devices/disk'):
+            source = disk.find('source')
+
+            if disk.get('device') != 'cdrom' or source is None or source.get('file') != path:
+                continue
+
+            disk.remove(source)
+
+            if disk.find('alias') is not None:
+                disk.remove(disk.find('alias'))
+
+            flags = libvirt.VIR_DOMAIN_AFFECT_CONFIG
+            if dom.isActive():
+                flags |= libvirt.VIR_DOMAIN_AFFECT_LIVE
+
+            dom.updateDeviceFlags(ET.tostring(disk), flags)
+            ejected = True
+
+        cls.remove_seed(uuid=dom.UUIDString())
+        return ejected
+
+    @classmethod
+    def detach_quietly(cls, dom=None):
+        # 用于事件回调中启动的线程，异常仅记录
+        try:
+            if cls.detach(dom=dom):
+                logger.info(msg=u' '.join([u'已弹出 Guest', dom.UUIDString(), u'的 cloud-init seed']))
+
+        except:
+            logger.error(traceback.format_exc())
+
+    @classmethod
+    def remove_seed(cls, uuid=None):
+        path = cls.seed_path(uuid=uuid)
+
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import errno
+import fcntl
+import ctypes
+import ctypes.util
+import threading
+import Queue
+
+from metrics import Metrics
+
+
+__author__ = 'James Iter'
+__date__ = '2026/10/19'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2026 by James Iter.'
+
+
+class LocalFile(object):
+    """
+    以文件描述符实现与 gfapi 文件对象一致的 lseek、read、write、ftruncate 接口
+    """
+
+    def __init__(self, path=None, flags=os.O_RDONLY, mode=0644):
+        self.fd = os.open(path, flags, mode)
+
+    def lseek(self, offset=None, whence=None):
+        return os.lseek(self.fd, offset, whence)
+
+    def read(self, length=None):
+        return os.read(self.fd, length)
+
+    def write(self, data=None):
+        written = 0
+
+        while written < data.__len__():
+            written += os.write(self.fd, data[written:])
+
+        return written
+
+    def ftruncate(self, length=None):
+        os.ftruncate(self.fd, length)
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class CopyEngine(object):
+    """
+    本地文件复制引擎。
+    依次尝试 reflink(XFS、Btrfs 上仅复制元数据)、内核态的 copy_file_range、sendfile，最后才退回到用户态读写。
+    借助 SEEK_DATA/SEEK_HOLE 跳过稀疏文件中的空洞，使目标文件保持稀疏。
+    """
+
+    # linux/fs.h: #define FICLONE _IOW(0x94, 9, int)
+    FICLONE = 0x40049409
+    # Python 2 的 os 模块未定义以下常量
+    SEEK_DATA = 3
+    SEEK_HOLE = 4
+
+    chunk_size = 64 * 1024 ** 2
+    # 经 gfapi 复制时，单次读写的大小
+    volume_io_size = 4 * 1024 ** 2
+    # 扇出复制时，每个目标待写入的块数上限。最慢的目标决定读取速度
+    fan_out_depth = 8
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+    # 以下错误码表示当前文件系统或内核不支持该复制方式，需降级
+    unsupported_errno = [errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY]
+
+    @classmethod
+    def reflink(cls, fd_src=None, fd_dst=None):
+        try:
+            fcntl.ioctl(fd_dst, cls.FICLONE, fd_src)
+            return True
+
+        except (IOError, OSError) as e:
+            if e.errno in cls.unsupported_errno:
+                return False
+
+            raise
+
+    @classmethod
+    def copy_file_range(cls, fd_src=None, fd_dst=None, offset=None, length=None):
+        if not hasattr(cls.libc, 'copy_file_range'):
+            raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+
+        off_src = ctypes.c_longlong(offset)
+        off_dst = ctypes.c_longlong(offset)
+
+        ret = cls.libc.copy_file_range(fd_src, ctypes.byref(off_src), fd_dst, ctypes.byref(off_dst),
+                                       ctypes.c_size_t(length), 0)
+
+        if ret < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        return ret
+
+    @classmethod
+    def sendfile(cls, fd_src=None, fd_dst=None, offset=None, length=None):
+        # sendfile 写入目标文件的当前偏移处
+        os.lseek(fd_dst, offset, os.SEEK_SET)
+        off_src = ctypes.c_longlong(offset)
+
+        ret = cls.libc.sendfile(fd_dst, fd_src, ctypes.byref(off_src), ctypes.c_size_t(length))
+
+        if ret < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        return ret
+
+    @staticmethod
+    def read_write(fd_src=None, fd_dst=None, offset=None, length=None):
+        os.lseek(fd_src, offset, os.SEEK_SET)
+        os.lseek(fd_dst, offset, os.SEEK_SET)
+        data = os.read(fd_src, length)
+        written = 0
+
+        # os.write 可能只写入部分数据，需写完整个缓冲区
+        while written < data.__len__():
+            written += os.write(fd_dst, data[written:])
+
+        return data.__len__()
+
+    @classmethod
+    def data_segments(cls, fd=None, size=None, lseek=None):
+        """
+        :param lseek: 用于非本地文件描述符(如 gfapi 文件)的 lseek(offset, whence) 函数
+        :return: 文件中含数据区段的列表 [(start, end), ...]。文件系统不支持 SEEK_DATA 时，视整个文件为数据
+        """
+        if lseek is None:
+            lseek = lambda _offset, whence: os.lseek(fd, _offset, whence)
+
+        segments = list()
+        offset = 0
+
+        while offset < size:
+            try:
+                start = lseek(offset, cls.SEEK_DATA)
+
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # 其后已无数据
+                    break
+
+                if e.errno in [errno.EINVAL, errno.ENOTSUP] and offset == 0:
+                    return [(0, size)]
+
+                raise
+
+            end = lseek(start, cls.SEEK_HOLE)
+            segments.append((start, min(end, size)))
+            offset = end
+
+        return segments
+
+    @classmethod
+    def copy(cls, src=None, dst=None, progress=None, meter=None):
+        """
+        :param progress: 进度回调 progress(done, total)，单位(字节)。空洞计入已完成的字节数
+        :param meter: 记账回调 meter(read, written)，参数为实际读取、写入的字节数。reflink 未读写数据，不记账
+        :return: 实际使用的复制方式
+        """
+        fd_src = os.open(src, os.O_RDONLY)
+
+        try:
+            fd_dst = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+
+            try:
+                size = os.fstat(fd_src).st_size
+
+                if cls.reflink(fd_src=fd_src, fd_dst=fd_dst):
+                    method = 'reflink'
+
+                    if progress is not None:
+                        progress(size, size)
+
+                else:
+                    method = cls.copy_segments(fd_src=fd_src, fd_dst=fd_dst, size=size, progress=progress,
+                                               meter=meter)
+
+            finally:
+                os.close(fd_dst)
+
+        finally:
+            os.close(fd_src)
+
+        Metrics.inc(name='jimvn_local_copy_bytes_total', value=size, labels={'method': method},
+                    _help='bytes copied by the local copy engine')
+
+        return method
+
+    @classmethod
+    def copy_segments(cls, fd_src=None, fd_dst=None, size=None, progress=None, meter=None):
+        # 先把目标文件截为最终大小，未写入的空洞保持稀疏
+        os.ftruncate(fd_dst, size)
+
+        methods = [cls.copy_file_range, cls.sendfile, cls.read_write]
+
+        for start, end in cls.data_segments(fd=fd_src, size=size):
+            offset = start
+
+            while offset < end:
+                length = min(cls.chunk_size, end - offset)
+
+                try:
+                    copied = methods[0](fd_src=fd_src, fd_dst=fd_dst, offset=offset, length=length)
+
+                except OSError as e:
+                    if e.errno not in cls.unsupported_errno or methods.__len__() < 2:
+                        raise
+
+                    methods.pop(0)
+                    continue
+
+                if copied == 0:
+                    # 源文件在复制过程中被截短
+                    break
+
+                offset += copied
+
+                if meter is not None:
+                    meter(read=copied, written=copied)
+
+                # 已跳过的空洞计入已完成
+                if progress is not None:
+                    progress(offset, size)
+
+        if progress is not None:
+            progress(size, size)
+
+        return methods[0].__name__
+
+    @classmethod
+    def copy_by_volume(cls, volume=None, src=None, dst=None, workers=4, progress=None, meter=None):
+        """
+        经 gfapi 在同一卷内复制文件。文件按区段切分后由多个工作线程以偏移读写并行复制，全零块不写入，目标文件保持稀疏。
+        :param volume: gfapi.Volume，或提供 stat、fopen 及文件对象 lseek、read、write、ftruncate 的等价对象
+        :param progress: 进度回调 progress(done, total)，单位(字节)
+        :param meter: 记账回调 meter(read, written)，参数为实际读取、写入的字节数。未写入的全零块不计入写入
+        """
+        size = volume.stat(src).st_size
+
+        with volume.fopen(dst, 'wb') as f_dst:
+            f_dst.ftruncate(size)
+
+        with volume.fopen(src, 'rb') as f_src:
+            segments = cls.data_segments(size=size, lseek=f_src.lseek)
+
+        q_range = Queue.Queue()
+        for start, end in segments:
+            for offset in range(start, end, cls.chunk_size):
+                q_range.put((offset, min(offset + cls.chunk_size, end)))
+
+        lock = threading.Lock()
+        state = {'done': size - sum([end - start for start, end in segments]), 'errors': list()}
+        zero_block = '\0' * cls.volume_io_size
+
+        def worker():
+            try:
+                with volume.fopen(src, 'rb') as _f_src:
+                    with volume.fopen(dst, 'r+b') as _f_dst:
+                        while not state['errors']:
+                            try:
+                                _start, _end = q_range.get_nowait()
+                            except Queue.Empty:
+                                return
+
+                            _offset = _start
+                            while _offset < _end:
+                                _f_src.lseek(_offset, os.SEEK_SET)
+                                data = _f_src.read(min(cls.volume_io_size, _end - _offset))
+
+                                if data.__len__() == 0:
+                                    break
+
+                                if meter is not None:
+                                    meter(read=data.__len__())
+
+                                if data != zero_block[:data.__len__()]:
+                                    _f_dst.lseek(_offset, os.SEEK_SET)
+                                    _f_dst.write(data)
+
+                                    if meter is not None:
+                                        meter(written=data.__len__())
+
+                                _offset += data.__len__()
+
+                            with lock:
+                                state['done'] += _end - _start
+
+                                if progress is not None:
+                                    progress(state['done'], size)
+
+            except Exception as e:
+                with lock:
+                    state['errors'].append(e)
+
+        threads = list()
+        for i in range(max(min(workers, q_range.qsize()), 1)):
+            t = threading.Thread(target=worker)
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            t.join()
+
+        if state['errors']:
+            raise state['errors'][0]
+
+        if progress is not None:
+            progress(size, size)
+
+        Metrics.inc(name='jimvn_volume_copy_bytes_total', value=size, _help='bytes copied through gfapi')
+
+    @classmethod
+    def fan_out(cls, f_src=None, f_dsts=None, size=None, progresses=None, meter=None):
+        """
+        读取一次源文件，以流水线的方式并行写入多个目标。每个目标由独立的线程写入，单个目标的失败不影响其它目标。
+        :param f_src: 源文件，需提供 lseek、read
+        :param f_dsts: 目标文件列表，需提供 lseek、write、ftruncate
+        :param progresses: 与目标一一对应的进度回调列表，元素可为 None
+        :param meter: 记账回调 meter(read, written)。源文件只读取一次，按读取一次及各目标的实际写入记账
+        :return: 与目标一一对应的异常列表，成功的目标为 None
+        """
+        segments = cls.data_segments(size=size, lseek=f_src.lseek)
+        hole = size - sum([end - start for start, end in segments])
+        errors = [None] * f_dsts.__len__()
+        queues = [Queue.Queue(maxsize=cls.fan_out_depth) for _ in f_dsts]
+        zero_block = '\0' * cls.volume_io_size
+
+        def writer(i):
+            done = hole
+
+            while True:
+                item = queues[i].get()
+
+                if item is None:
+                    return
+
+                # 已失败的目标只消费队列，不阻塞读取
+                if errors[i] is not None:
+                    continue
+
+                offset, data = item
+
+                try:
+                    if data != zero_block[:data.__len__()]:
+                        f_dsts[i].lseek(offset, os.SEEK_SET)
+                        f_dsts[i].write(data)
+
+                        if meter is not None:
+                            meter(written=data.__len__())
+
+                    done += data.__len__()
+
+                    if progresses[i] is not None:
+                        progresses[i](done, size)
+
+                except Exception as e:
+                    errors[i] = e
+
+        for i, f_dst in enumerate(f_dsts):
+            try:
+                f_dst.ftruncate(size)
+
+            except Exception as e:
+                errors[i] = e
+
+        threads = list()
+        for i in range(f_dsts.__len__()):
+            t = threading.Thread(target=writer, args=(i,))
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+
+        try:
+            for start, end in segments:
+                offset = start
+
+                while offset < end:
+                    f_src.lseek(offset, os.SEEK_SET)
+                    data = f_src.read(min(cls.volume_io_size, end - offset))
+
+                    if data.__len__() == 0:
+                        break
+
+                    if meter is not None:
+                        meter(read=data.__len__())
+
+                    for i, q in enumerate(queues):
+                        if errors[i] is None:
+                            q.put((offset, data))
+
+                    offset += data.__len__()
+
+        except Exception as e:
+            for i in range(errors.__len__()):
+                if errors[i] is None:
+                    errors[i] = e
+
+        finally:
+            for q in queues:
+                q.put(None)
+
+            for t in threads:
+                t.join()
+
+        for i, progress in enumerate(progresses):
+            if errors[i] is None and progress is not None:
+                progress(size, size)
+
+        Metrics.inc(name='jimvn_fan_out_saved_bytes_total', value=size * max(errors.count(None) - 1, 0),
+                    _help='template bytes not re-read thanks to fan-out copies')
+
+        return errors
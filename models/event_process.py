@@ -2,10 +2,13 @@
 # -*- coding: utf-8 -*-
 
 
+import threading
 import libvirt
 
 from models.initialize import guest_event_emit
 from models import Guest
+from models.guest_state import GuestStateTable
+from models.cloud_init import CloudInit
 
 
 __author__ = 'James Iter'
@@ -35,6 +38,17 @@ class EventProcess(object):
             # Guest 从本宿主机迁出完成后不做状态通知
             return
 
+        if event == libvirt.VIR_DOMAIN_EVENT_STARTED:
+            # 正常启动的 Guest，其 agent 尚未连接。待 agent 生命周期事件通知连接后，再上报为 Running
+            connected = None
+            if detail == libvirt.VIR_DOMAIN_EVENT_STARTED_BOOTED:
+                connected = False
+
+            GuestStateTable.set_agent(uuid=dom.UUIDString(), connected=connected)
+
+        elif event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
+            GuestStateTable.set_agent(uuid=dom.UUIDString(), connected=None)
+
         Guest.guest_state_report(dom=dom)
 
         if event == libvirt.VIR_DOMAIN_EVENT_DEFINED:
@@ -56,7 +70,7 @@ class EventProcess(object):
         elif event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
             if detail == libvirt.VIR_DOMAIN_EVENT_UNDEFINED_REMOVED:
                 # 删除一个 Guest 定义
-                pass
+                GuestStateTable.remove(uuid=dom.UUIDString())
             elif detail == libvirt.VIR_DOMAIN_EVENT_UNDEFINED_RENAMED:
                 # 变更 Guest 名称，待测试。猜测为 Guest 旧名称消失时触发
                 pass
@@ -200,6 +214,20 @@ class EventProcess(object):
         except libvirt.libvirtError as e:
             pass
 
+    @staticmethod
+    def guest_event_agent_lifecycle_callback(conn, dom, state, reason, opaque):
+        # guest agent 连接或断开时触发。以此代替对每个 Guest 周期性的 guest-ping
+        connected = state == libvirt.VIR_CONNECT_DOMAIN_EVENT_AGENT_LIFECYCLE_STATE_CONNECTED
+        GuestStateTable.set_agent(uuid=dom.UUIDString(), connected=connected)
+
+        Guest.guest_state_report(dom=dom)
+
+        # agent 连接时，首次启动已越过 cloud-init 读取 seed 的阶段，可弹出 seed。不在事件循环线程中调用 libvirt 接口
+        if connected and CloudInit.has_seed(uuid=dom.UUIDString()):
+            t = threading.Thread(target=CloudInit.detach_quietly, args=(dom,))
+            t.setDaemon(True)
+            t.start()
+
     @staticmethod
     def guest_event_device_added_callback(conn, dom, dev, opaque):
         Guest.update_xml(dom=dom)
@@ -218,6 +246,10 @@ class EventProcess(object):
             None, libvirt.VIR_DOMAIN_EVENT_ID_MIGRATION_ITERATION,
             cls.guest_event_migration_iteration_callback, None))
 
+        cls.guest_callbacks.append(cls.conn.domainEventRegisterAny(
+            None, libvirt.VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE,
+            cls.guest_event_agent_lifecycle_callback, None))
+
         cls.guest_callbacks.append(cls.conn.domainEventRegisterAny(
             None, libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_ADDED,
             cls.guest_event_device_added_callback, None))
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import time
+import threading
+
+from initialize import config, logger
+from metrics import Metrics
+from template_cache import TemplateCache
+from status import StorageMode
+
+
+__author__ = 'James Iter'
+__date__ = '2026/10/19'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2026 by James Iter.'
+
+
+class FanOutCopy(object):
+    """
+    扇出复制。短时间窗口内基于同一模板的多个创建请求合为一组，模板只读取一次，以流水线的方式写入组内所有目标。
+    每个 Guest 仍各自获得进度，各自成败。
+    只有在同一模板的上一个请求到达后的窗口内到达的请求才等待组员，孤立的请求立即复制；组满时组长提前结束等待。
+    """
+
+    lock = threading.Lock()
+    # (storage_mode, dfs_volume, 模板路径) -> [{'dst', 'progress', 'event', 'error'}, ...]
+    groups = dict()
+    # (storage_mode, dfs_volume, 模板路径) -> 最近一个请求的到达时间
+    arrivals = dict()
+
+    @staticmethod
+    def eligible(storage=None):
+        if config['fan_out_window'] <= 0:
+            return False
+
+        # 本地存储模式下模板读取廉价，且单独复制可使用 reflink
+        if storage.storage_mode not in [StorageMode.shared_mount.value, StorageMode.glusterfs.value]:
+            return False
+
+        # 模板缓存已使模板只经网络读取一次
+        return not TemplateCache.enabled()
+
+    @classmethod
+    def copy(cls, storage=None, src=None, dst=None, progress=None):
+        if not cls.eligible(storage=storage):
+            storage.copy_file(src=src, dst=dst, progress=progress)
+            return
+
+        key = (storage.storage_mode, storage.dfs_volume, src)
+        member = {'dst': dst, 'progress': progress, 'event': threading.Event(), 'error': None}
+
+        with cls.lock:
+            now = time.time()
+            # 窗口内已有同一模板的请求到达，说明正处于批量创建中，值得等待组员
+            burst = now - cls.arrivals.get(key, 0) < config['fan_out_window']
+            cls.arrivals[key] = now
+
+            group = cls.groups.get(key)
+            leader = group is None
+
+            if leader:
+                group = cls.groups[key] = list()
+
+            group.append(member)
+
+            # 组已满，或孤立的请求，之后到达的请求另起一组
+            if group.__len__() >= config['fan_out_max_destinations'] or (leader and not burst):
+                del cls.groups[key]
+
+                if not leader:
+                    # 唤醒组长
+                    group[0]['event'].set()
+
+        if not leader:
+            member['event'].wait()
+
+            if member['error'] is not None:
+                raise member['error']
+
+            return
+
+        try:
+            if burst:
+                # 组满时由最后一个组员唤醒
+                member['event'].wait(config['fan_out_window'])
+
+            with cls.lock:
+                if cls.groups.get(key) is group:
+                    del cls.groups[key]
+
+            cls.run(storage=storage, src=src, group=group)
+
+        finally:
+            for _member in group:
+                _member['event'].set()
+
+        if member['error'] is not None:
+            raise member['error']
+
+    @staticmethod
+    def run(storage=None, src=None, group=None):
+        if group.__len__() == 1:
+            try:
+                storage.copy_file(src=src, dst=group[0]['dst'], progress=group[0]['progress'])
+
+            except Exception as e:
+                group[0]['error'] = e
+
+            return
+
+        logger.info(msg=u' '.join([u'模板', src, u'扇出复制至', str(group.__len__()), u'个目标']))
+        Metrics.inc(name='jimvn_fan_out_groups_total', _help='fan-out copies performed')
+        Metrics.inc(name='jimvn_fan_out_destinations_total', value=group.__len__(),
+                    _help='destinations written by fan-out copies')
+
+        try:
+            errors = storage.fan_out_copy(src=src, dsts=[member['dst'] for member in group],
+                                          progresses=[member['progress'] for member in group])
+
+        except Exception as e:
+            errors = [e] * group.__len__()
+
+        for member, error in zip(group, errors):
+            member['error'] = error
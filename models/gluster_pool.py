@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import time
+import errno
+import threading
+import traceback
+import contextlib
+
+from gluster import gfapi
+
+from initialize import config, logger
+from metrics import Metrics
+
+
+__author__ = 'James Iter'
+__date__ = '2026/10/19'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2026 by James Iter.'
+
+
+class GlusterFSPool(object):
+    """
+    gfapi 连接池，按卷划分。句柄在首次使用时挂载，每个卷至多 glusterfs_pool_size 个句柄以便并行读写。
+    空闲较久的句柄在取用前做健康检查，连接类错误的句柄直接卸载丢弃，下次取用时重新挂载，长期空闲的句柄由引擎卸载。
+    """
+
+    lock = threading.Lock()
+    # 卷 -> {'cond', 'idle': [(gf, 归还时间)], 'mounted': 已挂载的句柄数}
+    volumes = dict()
+
+    # 表示连接已不可用的错误码
+    broken_errno = [errno.ENOTCONN, errno.EIO, errno.EBADF, errno.ESHUTDOWN, errno.ETIMEDOUT, errno.ECONNREFUSED,
+                    errno.ECONNRESET, errno.EHOSTUNREACH]
+
+    # 句柄空闲超过该时长(秒)，取用前做健康检查
+    health_check_after = 30
+
+    @classmethod
+    def state(cls, volume=None):
+        with cls.lock:
+            if volume not in cls.volumes:
+                cls.volumes[volume] = {'cond': threading.Condition(threading.Lock()), 'idle': list(), 'mounted': 0}
+
+            return cls.volumes[volume]
+
+    @staticmethod
+    def mount(volume=None):
+        gf = gfapi.Volume('127.0.0.1', volume)
+        gf.mount()
+
+        Metrics.inc(name='jimvn_glusterfs_mounts_total', labels={'volume': volume}, _help='gfapi handles mounted')
+        return gf
+
+    @staticmethod
+    def umount(volume=None, gf=None):
+        try:
+            gf.umount()
+
+        except:
+            logger.warn(traceback.format_exc())
+
+        Metrics.inc(name='jimvn_glusterfs_umounts_total', labels={'volume': volume}, _help='gfapi handles unmounted')
+
+    @classmethod
+    def healthy(cls, gf=None):
+        try:
+            gf.stat('/')
+            return True
+
+        except (OSError, IOError):
+            return False
+
+    @classmethod
+    def acquire(cls, volume=None):
+        state = cls.state(volume=volume)
+
+        while True:
+            with state['cond']:
+                while not state['idle'] and state['mounted'] >= config['glusterfs_pool_size']:
+                    state['cond'].wait()
+
+                if state['idle']:
+                    gf, ts = state['idle'].pop()
+
+                else:
+                    gf, ts = None, None
+                    # 先行占位，挂载在锁外进行
+                    state['mounted'] += 1
+
+            if gf is None:
+                try:
+                    return cls.mount(volume=volume)
+
+                except:
+                    cls.discard(volume=volume, gf=None)
+                    raise
+
+            if time.time() - ts < cls.health_check_after or cls.healthy(gf=gf):
+                return gf
+
+            logger.warn(u' '.join([u'卷', volume, u'的 gfapi 句柄健康检查失败，重新挂载']))
+            cls.discard(volume=volume, gf=gf)
+
+    @classmethod
+    def release(cls, volume=None, gf=None):
+        state = cls.state(volume=volume)
+
+        with state['cond']:
+            state['idle'].append((gf, time.time()))
+            state['cond'].notify()
+
+    @classmethod
+    def discard(cls, volume=None, gf=None):
+        state = cls.state(volume=volume)
+
+        if gf is not None:
+            cls.umount(volume=volume, gf=gf)
+
+        with state['cond']:
+            state['mounted'] -= 1
+            state['cond'].notify()
+
+    @classmethod
+    @contextlib.contextmanager
+    def handle(cls, volume=None):
+        gf = cls.acquire(volume=volume)
+
+        try:
+            yield gf
+
+        except (OSError, IOError) as e:
+            if e.errno in cls.broken_errno:
+                cls.discard(volume=volume, gf=gf)
+
+            else:
+                cls.release(volume=volume, gf=gf)
+
+            raise
+
+        except:
+            cls.release(volume=volume, gf=gf)
+            raise
+
+        else:
+            cls.release(volume=volume, gf=gf)
+
+    @classmethod
+    def reap(cls):
+        """
+        卸载空闲超过 glusterfs_pool_idle_timeout 的句柄
+        """
+        with cls.lock:
+            volumes = cls.volumes.items()
+
+        for volume, state in volumes:
+            expired = list()
+
+            with state['cond']:
+                for item in list(state['idle']):
+                    if time.time() - item[1] > config['glusterfs_pool_idle_timeout']:
+                        state['idle'].remove(item)
+                        expired.append(item[0])
+
+            for gf in expired:
+                cls.discard(volume=volume, gf=gf)
+
+            with state['cond']:
+                Metrics.set(name='jimvn_glusterfs_handles', value=state['mounted'], labels={'volume': volume},
+                            _help='gfapi handles mounted per volume')
+                Metrics.set(name='jimvn_glusterfs_handles_idle', value=state['idle'].__len__(),
+                            labels={'volume': volume}, _help='idle gfapi handles per volume')
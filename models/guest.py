@@ -3,26 +3,33 @@
 
 
 import os
+import uuid
 import traceback
 import jimit as ji
-import subprocess
-import signal
 import time
-import re
-import fcntl
+import threading
 
-import guestfs
 import libvirt
 import xml.etree.ElementTree as ET
 import libvirt_qemu
 import json
 import base64
 
-from initialize import log_emit, guest_event_emit, q_creating_guest, response_emit
+from initialize import config, log_emit, guest_event_emit, response_emit
 from models.jimvn_exception import CommandExecFailed
-from models.status import OSTemplateInitializeOperateKind, StorageMode
-from models.utils import Utils
+from models.status import OSTemplateInitializeOperateKind, StorageMode, GuestInitializeMode, SnapshotMode
+from models.utils import SSHPool
 from models.storage import Storage
+from models.storage_scheduler import StorageScheduler
+from models.qemu_img import QemuImg
+from models.backup import IncrementalBackup
+from models.guest_state import GuestStateTable
+from models.progress import ProgressTracker
+from models.guestfs_pool import GuestFSPool
+from models.cloud_init import CloudInit
+from models.warm_pool import WarmImagePool
+from models.fan_out import FanOutCopy
+from models.metrics import Metrics, StageTimer
 from models import GuestState
 
 
@@ -33,24 +40,38 @@ __copyright__ = '(c) 2017 by James Iter.'
 
 
 class Guest(object):
+    # 本节点同时进行的快照转模板数量上限
+    convert_slots = threading.BoundedSemaphore(config['convert_concurrency'])
+    # 各 Guest 的备份锁，uuid -> threading.Lock。同一 Guest 的备份共用同一个脏位图，不可并行
+    backup_locks = dict()
+    backup_locks_lock = threading.Lock()
+
     def __init__(self, **kwargs):
         self.uuid = kwargs.get('uuid', None)
         self.name = kwargs.get('name', None)
         self.password = kwargs.get('password', None)
         # 模板镜像路径
         self.template_path = kwargs.get('template_path', None)
-        # 不提供链接克隆(完整克隆，后期可以在模板目录，直接删除模板文件。从理论上讲，基于完整克隆的 Guest 读写速度、快照都应该快于链接克隆。)
-        # self.clone = True
+        # 默认使用完整克隆(后期可以在模板目录，直接删除模板文件。从理论上讲，基于完整克隆的 Guest 读写速度、快照都应该快于链接克隆。)
+        # 链接克隆以模板为只读的后端镜像，创建近乎瞬时完成。删除模板前，需通过 flatten 将其转为完整镜像
+        self.linked_clone = kwargs.get('linked_clone', False)
         # Guest 系统盘及数据磁盘
         self.disk = kwargs.get('disk', None)
         self.xml = kwargs.get('xml', None)
         # Guest 系统镜像路径，不包含 dfs 卷标
         self.system_image_path = self.disk['path']
-        self.g = guestfs.GuestFS(python_return_dict=True)
         self.storage = Storage(storage_mode=kwargs.get('storage_mode', None), dfs_volume=kwargs.get('dfs_volume', None))
 
-    def generate_system_image(self):
-        self.storage.copy_file(src=self.template_path, dst=self.system_image_path)
+    def generate_system_image(self, progress=None):
+        if self.linked_clone:
+            self.storage.make_linked_clone(backing=self.template_path, path=self.system_image_path)
+
+        elif WarmImagePool.claim(storage=self.storage, template_path=self.template_path, dst=self.system_image_path):
+            if progress is not None:
+                progress(1, 1)
+
+        else:
+            FanOutCopy.copy(storage=self.storage, src=self.template_path, dst=self.system_image_path, progress=progress)
 
     def define_by_xml(self, conn=None):
         return conn.defineXML(xml=self.xml)
@@ -72,52 +93,63 @@ class Guest(object):
         self.xml = dom.XMLDesc()
         root = ET.fromstring(self.xml)
 
-        for dev in root.findall('devices/disk'):
-            filename = dev.find('source').get('file')
-            _format = dev.find('driver').attrib['type']
+        begin = time.time()
+        g = GuestFSPool.acquire()
+        labels = list()
 
-            if filename is None:
-                filename = dev.find('source').get('name')
-                protocol = dev.find('source').get('protocol')
-                server = dev.find('source/host').get('name')
-                self.g.add_drive(filename=filename, format=_format, protocol=protocol, server=[server])
+        try:
+            # 以热插拔的方式挂入 Guest 的磁盘，使池中常驻的 appliance 可被复用
+            for i, dev in enumerate(root.findall('devices/disk')):
+                filename = dev.find('source').get('file')
+                _format = dev.find('driver').attrib['type']
+                label = GuestFSPool.label(index=i)
+
+                if filename is None:
+                    filename = dev.find('source').get('name')
+                    protocol = dev.find('source').get('protocol')
+                    server = dev.find('source/host').get('name')
+                    g.add_drive(filename=filename, format=_format, protocol=protocol, server=[server], label=label)
 
-            else:
-                self.g.add_drive(filename=filename, format=_format, protocol='file')
+                else:
+                    g.add_drive(filename=filename, format=_format, protocol='file', label=label)
 
-        self.g.launch()
-        self.g.mount(self.g.inspect_os()[0], '/')
+                labels.append(label)
 
-        for os_template_initialize_operate in os_template_initialize_operates:
-            if os_template_initialize_operate['kind'] == OSTemplateInitializeOperateKind.cmd.value:
+            g.mount(g.inspect_os()[0], '/')
 
-                # 暂不支持 Windows 命令
-                if is_windows:
-                    continue
+            for os_template_initialize_operate in os_template_initialize_operates:
+                if os_template_initialize_operate['kind'] == OSTemplateInitializeOperateKind.cmd.value:
 
-                self.g.sh(os_template_initialize_operate['command'])
+                    # 暂不支持 Windows 命令
+                    if is_windows:
+                        continue
 
-            elif os_template_initialize_operate['kind'] == OSTemplateInitializeOperateKind.write_file.value:
+                    g.sh(os_template_initialize_operate['command'])
 
-                content = os_template_initialize_operate['content']
-                if is_windows:
-                    content = content.replace('\r', '').replace('\n', '\r\n')
+                elif os_template_initialize_operate['kind'] == OSTemplateInitializeOperateKind.write_file.value:
 
-                self.g.write(os_template_initialize_operate['path'], content)
+                    content = os_template_initialize_operate['content']
+                    if is_windows:
+                        content = content.replace('\r', '').replace('\n', '\r\n')
 
-            elif os_template_initialize_operate['kind'] == OSTemplateInitializeOperateKind.append_file.value:
+                    g.write(os_template_initialize_operate['path'], content)
 
-                content = os_template_initialize_operate['content']
-                if is_windows:
-                    content = content.replace('\r', '').replace('\n', '\r\n')
+                elif os_template_initialize_operate['kind'] == OSTemplateInitializeOperateKind.append_file.value:
 
-                self.g.write_append(os_template_initialize_operate['path'], content)
+                    content = os_template_initialize_operate['content']
+                    if is_windows:
+                        content = content.replace('\r', '').replace('\n', '\r\n')
 
-            else:
-                continue
+                    g.write_append(os_template_initialize_operate['path'], content)
+
+                else:
+                    continue
 
-        self.g.shutdown()
-        self.g.close()
+        finally:
+            GuestFSPool.release(g=g, labels=labels)
+
+        Metrics.set(name='jimvn_guestfs_initialize_seconds', value=round(time.time() - begin, 3),
+                    _help='seconds taken by the latest guest template initialization')
 
         return True
 
@@ -126,37 +158,53 @@ class Guest(object):
         dom.create()
 
     @staticmethod
-    def get_state(dom=None):
-        def is_running(_dom=None):
-            running = False
+    def ping_agent(dom=None):
+        try:
+            libvirt_qemu.qemuAgentCommand(dom, json.dumps({
+                    'execute': 'guest-ping',
+                    'arguments': {
+                    }
+                }),
+                config['guest_agent_ping_timeout'],
+                libvirt_qemu.VIR_DOMAIN_QEMU_AGENT_COMMAND_NOWAIT)
+
+            return True
+
+        except:
+            return False
+
+    @staticmethod
+    def get_agent_state(dom=None):
+        """
+        从 libvirt 维护的 guest agent 通道状态中，获取 agent 是否已连接。该方式不与 agent 发生通讯。
+        :return: True 已连接，False 未连接，None 未知(libvirt 版本过低或未配置 agent 通道)
+        """
+        assert isinstance(dom, libvirt.virDomain)
 
-            try:
-                exec_ret = libvirt_qemu.qemuAgentCommand(_dom, json.dumps({
-                                'execute': 'guest-ping',
-                                'arguments': {
-                                }
-                            }),
-                            3,
-                            libvirt_qemu.VIR_DOMAIN_QEMU_AGENT_COMMAND_NOWAIT)
+        root = ET.fromstring(dom.XMLDesc())
 
-                running = True
+        for channel in root.findall('devices/channel'):
+            target = channel.find('target')
 
-            except:
-                pass
+            if target is None or target.get('name') != 'org.qemu.guest_agent.0':
+                continue
 
-            return running
+            if target.get('state') is None:
+                return None
 
-        assert isinstance(dom, libvirt.virDomain)
+            return target.get('state') == 'connected'
 
-        _uuid = dom.UUIDString()
-        state, maxmem, mem, ncpu, cputime = dom.info()
+        return None
+
+    @staticmethod
+    def state_from_libvirt(state=None, agent_connected=None):
         # state 参考链接：
         # http://libvirt.org/docs/libvirt-appdev-guide-python/en-US/html/libvirt_application_development_guide_using_python-Guest_Domains-Information-State.html
         # http://stackoverflow.com/questions/4986076/alternative-to-virsh-libvirt
 
         if state == libvirt.VIR_DOMAIN_RUNNING:
 
-            if is_running(_dom=dom):
+            if agent_connected:
                 state = GuestState.running.value
 
             else:
@@ -186,51 +234,73 @@ class Guest(object):
         return state
 
     @staticmethod
-    def guest_state_report(dom=None):
-        try:
-            _uuid = dom.UUIDString()
-            state = Guest.get_state(dom=dom)
+    def get_state(dom=None, reconcile=False):
+        """
+        guest agent 的连接状态，优先取自由 agent 生命周期事件维护的状态表。
+        状态未知或校准时，读取 libvirt 维护的 agent 通道状态，仍未知才使用有超时限制的 guest-ping。
+        """
+        assert isinstance(dom, libvirt.virDomain)
 
-            log = u' '.join([u'域', dom.name(), u', UUID', _uuid, u'的状态改变为'])
+        _uuid = dom.UUIDString()
+        state, maxmem, mem, ncpu, cputime = dom.info()
 
-            if state == GuestState.running.value:
-                log += u' Running。'
-                guest_event_emit.running(uuid=_uuid)
+        agent_connected = None
 
-            elif state == GuestState.booting.value:
-                log += u' Booting。'
-                guest_event_emit.booting(uuid=_uuid)
+        if state == libvirt.VIR_DOMAIN_RUNNING:
+            agent_connected = GuestStateTable.agent_connected(uuid=_uuid)
 
-            elif state == GuestState.blocked.value:
-                log += u' Blocked。'
-                guest_event_emit.blocked(uuid=_uuid)
+            if reconcile or agent_connected is None:
+                agent_connected = Guest.get_agent_state(dom=dom)
 
-            elif state == GuestState.paused.value:
-                log += u' Paused。'
-                guest_event_emit.paused(uuid=_uuid)
+                if agent_connected is None:
+                    agent_connected = Guest.ping_agent(dom=dom)
 
-            elif state == GuestState.shutdown.value:
-                log += u' Shutdown。'
-                guest_event_emit.shutdown(uuid=_uuid)
+                GuestStateTable.set_agent(uuid=_uuid, connected=agent_connected)
 
-            elif state == GuestState.shutoff.value:
-                log += u' Shutoff。'
-                guest_event_emit.shutoff(uuid=_uuid)
+        return Guest.state_from_libvirt(state=state, agent_connected=agent_connected)
 
-            elif state == GuestState.crashed.value:
-                log += u' Crashed。'
-                guest_event_emit.crashed(uuid=_uuid)
+    @staticmethod
+    def emit_state(uuid=None, state=None):
+        """
+        以原有的逐 Guest 状态事件上报
+        """
+        if state == GuestState.running.value:
+            guest_event_emit.running(uuid=uuid)
 
-            elif state == GuestState.pm_suspended.value:
-                log += u' PM_Suspended。'
-                guest_event_emit.pm_suspended(uuid=_uuid)
+        elif state == GuestState.booting.value:
+            guest_event_emit.booting(uuid=uuid)
 
-            else:
-                log += u' NO_State。'
+        elif state == GuestState.blocked.value:
+            guest_event_emit.blocked(uuid=uuid)
 
-                guest_event_emit.no_state(uuid=_uuid)
+        elif state == GuestState.paused.value:
+            guest_event_emit.paused(uuid=uuid)
 
-            log_emit.info(msg=log)
+        elif state == GuestState.shutdown.value:
+            guest_event_emit.shutdown(uuid=uuid)
+
+        elif state == GuestState.shutoff.value:
+            guest_event_emit.shutoff(uuid=uuid)
+
+        elif state == GuestState.crashed.value:
+            guest_event_emit.crashed(uuid=uuid)
+
+        elif state == GuestState.pm_suspended.value:
+            guest_event_emit.pm_suspended(uuid=uuid)
+
+        else:
+            guest_event_emit.no_state(uuid=uuid)
+
+    @staticmethod
+    def guest_state_report(dom=None, state=None):
+        """
+        记录 Guest 的最新状态，由 guest_state_flush_engine 在去抖窗口结束时合并上报
+        """
+        try:
+            if state is None:
+                state = Guest.get_state(dom=dom)
+
+            GuestStateTable.mark(uuid=dom.UUIDString(), state=state, name=dom.name())
 
         except Exception as e:
             log_emit.warn(e.message)
@@ -248,52 +318,79 @@ class Guest(object):
 
     @staticmethod
     def create(conn, msg):
+        # 各阶段耗时随响应返回，并计入本节点的直方图
+        timer = StageTimer(name='jimvn_guest_create_stage_seconds', _help='guest creation duration by stage')
+
         try:
             guest = Guest(uuid=msg['uuid'], name=msg['name'], template_path=msg['template_path'], disk=msg['disks'][0],
-                          xml=msg['xml'], storage_mode=msg['storage_mode'], dfs_volume=msg['dfs_volume'])
+                          xml=msg['xml'], storage_mode=msg['storage_mode'], dfs_volume=msg['dfs_volume'],
+                          linked_clone=msg.get('linked_clone', config['linked_clone']))
 
-            q_creating_guest.put({
-                'storage_mode': guest.storage.storage_mode,
-                'dfs_volume': guest.storage.dfs_volume,
-                'uuid': guest.uuid,
-                'template_path': guest.template_path,
-                'system_image_path': guest.system_image_path
-            })
+            # 生成系统镜像的进度，映射为创建进度的 0 ~ 90
+            ProgressTracker.start(key=guest.uuid,
+                                  emit=lambda percent: guest_event_emit.creating(uuid=msg['uuid'],
+                                                                                 progress=int(percent * 0.9)))
 
-            guest.generate_system_image()
+            with timer.stage('generate_system_image'):
+                guest.generate_system_image(progress=ProgressTracker.callback(key=guest.uuid))
 
-            dom = guest.define_by_xml(conn=conn)
-            assert isinstance(dom, libvirt.virDomain)
+            ProgressTracker.finish(key=guest.uuid)
+
+            # cloud-init 仅适用于 Linux 模板。Windows 模板仍经 libguestfs 离线初始化
+            cloud_init = msg.get('initialize_mode', config['guest_initialize_mode']) == \
+                GuestInitializeMode.cloud_init.value and str(msg['os_type']).lower().find('windows') < 0
+
+            if cloud_init:
+                with timer.stage('cloud_init_seed'):
+                    seed_path = CloudInit.make_seed(
+                        uuid=guest.uuid, name=guest.name,
+                        os_template_initialize_operates=msg['os_template_initialize_operates'])
+                    guest.xml = CloudInit.attach(xml=guest.xml, path=seed_path)
+
+            with timer.stage('define'):
+                dom = guest.define_by_xml(conn=conn)
+                assert isinstance(dom, libvirt.virDomain)
 
             log = u' '.join([u'域', guest.name, u', UUID', guest.uuid, u'定义成功.'])
             log_emit.info(msg=log)
 
             guest_event_emit.creating(uuid=guest.uuid, progress=92)
 
-            disk_info = guest.storage.image_info(path=guest.system_image_path)
+            with timer.stage('image_info'):
+                disk_info = guest.storage.image_info(path=guest.system_image_path)
 
             # 由该线程最顶层的异常捕获机制，处理其抛出的异常
-            guest.execute_os_template_initialize_operates(
-                dom=conn.lookupByUUIDString(uuidstr=guest.uuid),
-                os_template_initialize_operates=msg['os_template_initialize_operates'], os_type=msg['os_type'])
+            if not cloud_init:
+                with timer.stage('initialize'):
+                    guest.execute_os_template_initialize_operates(
+                        dom=conn.lookupByUUIDString(uuidstr=guest.uuid),
+                        os_template_initialize_operates=msg['os_template_initialize_operates'],
+                        os_type=msg['os_type'])
 
             extend_data = dict()
             extend_data.update({'disk_info': disk_info})
 
             guest_event_emit.creating(uuid=guest.uuid, progress=97)
 
-            dom.create()
+            with timer.stage('start'):
+                dom.create()
+
             log = u' '.join([u'域', guest.name, u', UUID', guest.uuid, u'启动成功.'])
             log_emit.info(msg=log)
 
-            Guest.quota(dom=dom, msg=msg)
+            with timer.stage('quota'):
+                Guest.quota(dom=dom, msg=msg)
+
+            extend_data.update({'timing': timer.report()})
 
             response_emit.success(_object=msg['_object'], action=msg['action'], uuid=msg['uuid'],
                                   data=extend_data, passback_parameters=msg.get('passback_parameters'))
 
         except:
+            ProgressTracker.fail(key=msg.get('uuid'), reason=traceback.format_exc().splitlines()[-1])
             log_emit.error(traceback.format_exc())
             response_emit.failure(_object=msg['_object'], action=msg.get('action'), uuid=msg.get('uuid'),
+                                  data={'timing': timer.report()},
                                   passback_parameters=msg.get('passback_parameters'))
 
     @classmethod
@@ -357,28 +454,143 @@ class Guest(object):
         if dom.isActive():
             dom.destroy()
 
-        dom.undefine()
+        # 外部快照的元数据随 Guest 一并删除，否则 undefine 会失败
+        dom.undefineFlags(libvirt.VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA)
 
-        system_image = None
+        dfs_volume, path = cls.get_disk_path(root=root, storage_mode=msg['storage_mode'])
+        storage = Storage(storage_mode=msg['storage_mode'], dfs_volume=dfs_volume)
+
+        # 删除系统盘的整条镜像链：外部快照的 overlay 及系统盘本身。
+        # 它们的文件名均以磁盘 uuid 为首段，链接克隆的模板则不是，留待其它克隆使用
+        disk_uuid = os.path.basename(path).split('.')[0]
+
+        for layer in storage.backing_chain(path=path):
+            if os.path.basename(layer).split('.')[0] != disk_uuid:
+                break
+
+            storage.delete_image(path=layer)
+
+        CloudInit.remove_seed(uuid=dom.UUIDString())
+
+    @staticmethod
+    def get_disk_path(root=None, storage_mode=None, dev='vda'):
+        """
+        :return: (dfs_volume, 不包含 dfs 卷标的镜像路径)
+        """
+        disk = None
         dfs_volume = None
         path = None
 
         for _disk in root.findall('devices/disk'):
-            if 'vda' == _disk.find('target').get('dev'):
-                system_image = _disk
+            if dev == _disk.find('target').get('dev'):
+                disk = _disk
 
-        if msg['storage_mode'] in [StorageMode.ceph.value, StorageMode.glusterfs.value]:
-            # 签出系统镜像路径
-            path_list = system_image.find('source').attrib['name'].split('/')
+        if storage_mode in [StorageMode.ceph.value, StorageMode.glusterfs.value]:
+            # 签出镜像路径
+            path_list = disk.find('source').attrib['name'].split('/')
 
-            if msg['storage_mode'] == StorageMode.glusterfs.value:
+            if storage_mode == StorageMode.glusterfs.value:
                 dfs_volume = path_list[0]
                 path = '/'.join(path_list[1:])
 
-        elif msg['storage_mode'] in [StorageMode.local.value, StorageMode.shared_mount.value]:
-            path = system_image.find('source').attrib['file']
+        elif storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            path = disk.find('source').attrib['file']
+
+        return dfs_volume, path
+
+    @staticmethod
+    def wait_block_job(dom=None, disk=None, interval=1, progress=None, timeout=None):
+        """
+        等待块设备作业结束。活动层提交(active commit)的作业在数据同步完成后不会自行结束，而是等待 pivot，此时即返回
+        :param progress: 进度回调 progress(done, total)
+        :param timeout: 单位(秒)，默认为 block_job_timeout，0 表示不限。超时后取消作业并抛出异常
+        """
+        assert isinstance(dom, libvirt.virDomain)
+
+        if timeout is None:
+            timeout = config['block_job_timeout']
+
+        deadline = time.time() + timeout if timeout else None
+
+        while True:
+            info = dom.blockJobInfo(disk, 0)
+
+            if not info:
+                return
+
+            if progress is not None and info['end'] > 0:
+                progress(info['cur'], info['end'])
+
+            if info['type'] == libvirt.VIR_DOMAIN_BLOCK_JOB_TYPE_ACTIVE_COMMIT and 0 < info['end'] == info['cur']:
+                return
+
+            if deadline is not None and time.time() > deadline:
+                # https://libvirt.org/html/libvirt-libvirt-domain.html#virDomainBlockJobAbort
+                dom.blockJobAbort(disk, 0)
+                raise RuntimeError(u' '.join([u'磁盘', disk, u'的块设备作业超过', str(timeout), u'秒仍未结束，已取消。']))
+
+            time.sleep(interval)
+
+    @staticmethod
+    def disk_chain(root=None, dev=None):
+        """
+        :return: 磁盘的镜像链 [(index, 镜像路径), ...]，首项为活动层，其 index 为 None。
+                 文件型磁盘的路径为文件路径，GlusterFS 磁盘的为 '卷/路径'
+        """
+        for disk in root.findall('devices/disk'):
+            if disk.find('target').get('dev') != dev:
+                continue
+
+            chain = list()
+            element = disk
+
+            while element is not None and element.find('source') is not None:
+                source = element.find('source')
+                chain.append((element.get('index'), source.get('file') or source.get('name')))
+                element = element.find('backingStore')
+
+            return chain
+
+        return list()
+
+    @staticmethod
+    def overlay_path(path=None, name=None):
+        # 保持磁盘 uuid 为文件名的首段，以免影响按 disk_uuid 关联的性能数据
+        return os.path.join(os.path.dirname(path), '.'.join([os.path.basename(path).split('.')[0], name, 'qcow2']))
 
-        Storage(storage_mode=msg['storage_mode'], dfs_volume=dfs_volume).delete_image(path=path)
+    @classmethod
+    def flatten(cls, dom=None, msg=None):
+        """
+        将链接克隆的系统盘转为完整镜像。运行中的 Guest 使用 block pull 在线合并，否则离线 rebase
+        """
+        extend_data = dict()
+
+        try:
+            assert isinstance(dom, libvirt.virDomain)
+            assert isinstance(msg, dict)
+
+            dev = msg.get('device_node', 'vda')
+
+            if dom.isActive():
+                # https://libvirt.org/html/libvirt-libvirt-domain.html#virDomainBlockPull
+                dom.blockPull(dev, int(msg.get('bandwidth', 0)), 0)
+                cls.wait_block_job(dom=dom, disk=dev)
+
+            else:
+                dfs_volume, path = cls.get_disk_path(root=ET.fromstring(dom.XMLDesc()),
+                                                     storage_mode=msg['storage_mode'], dev=dev)
+                Storage(storage_mode=msg['storage_mode'], dfs_volume=dfs_volume).flatten_image(path=path)
+
+            log = u' '.join([u'域', dom.name(), u', UUID', dom.UUIDString(), u'的磁盘', dev, u'已转为完整镜像。'])
+            log_emit.info(msg=log)
+
+            response_emit.success(_object=msg['_object'], action=msg['action'], uuid=msg['uuid'],
+                                  data=extend_data, passback_parameters=msg.get('passback_parameters'))
+
+        except:
+            log_emit.error(traceback.format_exc())
+            response_emit.failure(_object=msg['_object'], action=msg.get('action'), uuid=msg.get('uuid'),
+                                  data=extend_data, passback_parameters=msg.get('passback_parameters'))
 
     @classmethod
     def reset_password(cls, dom=None, msg=None):
@@ -500,22 +712,95 @@ class Guest(object):
 
         return ret_s
 
-    @staticmethod
-    def create_snapshot(dom=None, msg=None):
+    @classmethod
+    def external_snapshot_xml(cls, root=None, name=None):
+        snapshot = ET.Element('domainsnapshot')
+        ET.SubElement(snapshot, 'name').text = name
+        disks = ET.SubElement(snapshot, 'disks')
+
+        for disk in root.findall('devices/disk'):
+            dev = disk.find('target').get('dev')
+
+            if disk.get('device') != 'disk' or disk.find('source') is None:
+                ET.SubElement(disks, 'disk', {'name': dev, 'snapshot': 'no'})
+                continue
+
+            element = ET.SubElement(disks, 'disk', {'name': dev, 'snapshot': 'external', 'type': disk.get('type')})
+            ET.SubElement(element, 'driver', {'type': 'qcow2'})
+            source = disk.find('source')
+
+            if disk.get('type') == 'network':
+                _source = ET.SubElement(element, 'source', {
+                    'protocol': source.get('protocol'), 'name': cls.overlay_path(path=source.get('name'), name=name)})
+
+                for host in source.findall('host'):
+                    _source.append(host)
+
+            else:
+                ET.SubElement(element, 'source', {'file': cls.overlay_path(path=source.get('file'), name=name)})
+
+        return ET.tostring(snapshot)
+
+    @classmethod
+    def create_external_snapshot(cls, dom=None):
+        """
+        创建仅含磁盘的外部快照。原镜像成为只读的快照点，Guest 此后写入新的 overlay。
+        运行中的 Guest 经 Guest Agent 冻结文件系统，冻结期间仅需切换 overlay，不保存内存
+        """
+        # 毫秒时间戳使快照名仍按创建时间排序，随机后缀避免同一时刻的快照重名
+        name = '-'.join([str(int(time.time() * 1000)), uuid.uuid4().hex[:8]])
+        snap_xml = cls.external_snapshot_xml(root=ET.fromstring(dom.XMLDesc()), name=name)
+
+        snap_flags = 0
+        snap_flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY
+        snap_flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC
+
+        frozen = False
+
+        if dom.isActive():
+            try:
+                # https://libvirt.org/html/libvirt-libvirt-domain.html#virDomainFSFreeze
+                dom.fsFreeze()
+                frozen = True
+
+            except libvirt.libvirtError, e:
+                log_emit.warn(u' '.join([u'域', dom.name(), u'冻结文件系统失败，快照仅保证崩溃一致性：',
+                                         e.get_error_message()]))
+
+        begin = time.time()
+
+        try:
+            return dom.snapshotCreateXML(xmlDesc=snap_xml, flags=snap_flags)
+
+        finally:
+            if frozen:
+                dom.fsThaw()
+
+            Metrics.observe(name='jimvn_snapshot_freeze_seconds', value=time.time() - begin,
+                            buckets=[0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5],
+                            _help='time guests spent frozen while creating snapshots')
+
+    @classmethod
+    def create_snapshot(cls, dom=None, msg=None):
         extend_data = dict()
 
         try:
             assert isinstance(dom, libvirt.virDomain)
             assert isinstance(msg, dict)
-            snap_xml = """
-                <domainsnapshot>
-                </domainsnapshot>
-            """
 
-            snap_flags = 0
-            snap_flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC
+            if msg.get('snapshot_mode', config['snapshot_mode']) == SnapshotMode.external.value:
+                ret = cls.create_external_snapshot(dom=dom)
 
-            ret = dom.snapshotCreateXML(xmlDesc=snap_xml, flags=snap_flags)
+            else:
+                snap_xml = """
+                    <domainsnapshot>
+                    </domainsnapshot>
+                """
+
+                snap_flags = 0
+                snap_flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC
+
+                ret = dom.snapshotCreateXML(xmlDesc=snap_xml, flags=snap_flags)
 
             parent_id = ''
 
@@ -538,7 +823,88 @@ class Guest(object):
                                   data=extend_data, passback_parameters=msg.get('passback_parameters'))
 
     @staticmethod
-    def delete_snapshot(dom=None, msg=None):
+    def external_snapshot_disks(snapshot=None):
+        """
+        :return: 外部快照所含磁盘的 [(dev, overlay 路径), ...]。内部快照返回空列表
+        """
+        disks = list()
+
+        for disk in ET.fromstring(snapshot.getXMLDesc()).findall('disks/disk'):
+            if disk.get('snapshot') != 'external':
+                continue
+
+            source = disk.find('source')
+            disks.append((disk.get('name'), source.get('file') or source.get('name')))
+
+        return disks
+
+    @classmethod
+    def commit_external_snapshot(cls, dom=None, snapshot=None, disks=None, msg=None):
+        """
+        删除外部快照：把快照创建的 overlay 在线提交(block commit)至其后端镜像，再删除 overlay 及快照元数据。
+        overlay 为活动层时，提交完成后 pivot 至后端镜像，Guest 仅在 pivot 时短暂停顿
+        """
+        if not dom.isActive():
+            raise RuntimeError(u'外部快照需在 Guest 运行时删除。')
+
+        key = msg['uuid']
+
+        def emit(percent):
+            guest_event_emit.snapshot_deleting(uuid=key, progress=percent)
+
+        ProgressTracker.start(key=key, emit=emit)
+        begin = time.time()
+
+        for i, (dev, overlay) in enumerate(disks):
+            chain = cls.disk_chain(root=ET.fromstring(dom.XMLDesc()), dev=dev)
+            paths = [item[1] for item in chain]
+
+            # overlay 已不在镜像链中，或没有后端镜像可提交
+            if overlay not in paths or paths.index(overlay) + 1 >= paths.__len__():
+                continue
+
+            position = paths.index(overlay)
+            active = position == 0
+
+            commit_flags = 0
+            commit_flags |= libvirt.VIR_DOMAIN_BLOCK_COMMIT_SHALLOW
+
+            if active:
+                commit_flags |= libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE
+
+            top = None
+
+            if not active:
+                # 较早的 libvirt 不为镜像链标注 index，以路径指定
+                top = overlay if chain[position][0] is None else ''.join([dev, '[', chain[position][0], ']'])
+
+            def progress(done, total):
+                ProgressTracker.update(key=key, done=i * total + done, total=disks.__len__() * total)
+
+            # https://libvirt.org/html/libvirt-libvirt-domain.html#virDomainBlockCommit
+            dom.blockCommit(dev, None, top, int(msg.get('bandwidth', 0)), commit_flags)
+            cls.wait_block_job(dom=dom, disk=dev, progress=progress)
+
+            if active:
+                dom.blockJobAbort(dev, libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
+                cls.wait_block_job(dom=dom, disk=dev)
+
+            if overlay.startswith('/'):
+                storage = Storage(storage_mode=msg.get('storage_mode', StorageMode.local.value), dfs_volume=None)
+                storage.delete_image(path=overlay)
+
+            else:
+                storage = Storage(storage_mode=StorageMode.glusterfs.value, dfs_volume=overlay.split('/')[0])
+                storage.delete_image(path='/'.join(overlay.split('/')[1:]))
+
+        snapshot.delete(flags=libvirt.VIR_DOMAIN_SNAPSHOT_DELETE_METADATA_ONLY)
+        ProgressTracker.finish(key=key)
+
+        Metrics.observe(name='jimvn_block_commit_seconds', value=time.time() - begin,
+                        _help='time spent committing external snapshots')
+
+    @classmethod
+    def delete_snapshot(cls, dom=None, msg=None):
         extend_data = dict()
 
         try:
@@ -546,12 +912,71 @@ class Guest(object):
             assert isinstance(msg, dict)
 
             snapshot = dom.snapshotLookupByName(name=msg['snapshot_id'])
-            snapshot.delete()
+            disks = cls.external_snapshot_disks(snapshot=snapshot)
+
+            if disks:
+                cls.commit_external_snapshot(dom=dom, snapshot=snapshot, disks=disks, msg=msg)
+
+            else:
+                snapshot.delete()
 
             response_emit.success(_object=msg['_object'], action=msg['action'], uuid=msg['uuid'],
                                   data=extend_data, passback_parameters=msg.get('passback_parameters'))
 
         except:
+            ProgressTracker.fail(key=msg.get('uuid'), reason=traceback.format_exc().splitlines()[-1])
+            log_emit.error(traceback.format_exc())
+            response_emit.failure(_object=msg['_object'], action=msg.get('action'), uuid=msg.get('uuid'),
+                                  data=extend_data, passback_parameters=msg.get('passback_parameters'))
+
+    @staticmethod
+    def backup(dom=None, msg=None):
+        """
+        导出自上次备份以来变化的块至 msg['target_dir']。msg 中 full 为真时强制全量备份
+        """
+        extend_data = dict()
+
+        try:
+            assert isinstance(dom, libvirt.virDomain)
+            assert isinstance(msg, dict)
+
+            key = msg['uuid']
+
+            def emit(percent):
+                guest_event_emit.backing_up(uuid=key, progress=percent)
+
+            with Guest.backup_locks_lock:
+                lock = Guest.backup_locks.setdefault(dom.UUIDString(), threading.Lock())
+
+            # 不经下方的异常处理，以免将进行中的备份进度标记为失败
+            if not lock.acquire(False):
+                log_emit.warn(u' '.join([u'域', dom.name(), u'的备份正在进行中，忽略本次备份请求。']))
+                response_emit.failure(_object=msg['_object'], action=msg.get('action'), uuid=msg.get('uuid'),
+                                      data=extend_data, passback_parameters=msg.get('passback_parameters'))
+                return
+
+            try:
+                ProgressTracker.start(key=key, emit=emit)
+
+                devs = None
+
+                if 'device_node' in msg:
+                    devs = [msg['device_node']]
+
+                extend_data['backups'] = IncrementalBackup.run(
+                    dom=dom, target_dir=msg['target_dir'], devs=devs, full=msg.get('full', False),
+                    speed=int(msg.get('bandwidth', 0)) * 1024 ** 2, progress=ProgressTracker.callback(key=key))
+
+                ProgressTracker.finish(key=key)
+
+            finally:
+                lock.release()
+
+            response_emit.success(_object=msg['_object'], action=msg['action'], uuid=msg['uuid'],
+                                  data=extend_data, passback_parameters=msg.get('passback_parameters'))
+
+        except:
+            ProgressTracker.fail(key=msg.get('uuid'), reason=traceback.format_exc().splitlines()[-1])
             log_emit.error(traceback.format_exc())
             response_emit.failure(_object=msg['_object'], action=msg.get('action'), uuid=msg.get('uuid'),
                                   data=extend_data, passback_parameters=msg.get('passback_parameters'))
@@ -568,6 +993,9 @@ class Guest(object):
             snap_flags |= libvirt.VIR_DOMAIN_SNAPSHOT_REVERT_FORCE
             snapshot = dom.snapshotLookupByName(name=msg['snapshot_id'])
 
+            if Guest.external_snapshot_disks(snapshot=snapshot):
+                raise RuntimeError(u'不支持恢复至外部快照。')
+
             try:
                 dom.revertToSnapshot(snap=snapshot, flags=0)
 
@@ -597,9 +1025,33 @@ class Guest(object):
                                   data=extend_data, passback_parameters=msg.get('passback_parameters'))
 
     @staticmethod
-    def convert_snapshot(msg=None):
+    def convert_options(msg=None):
+        """
+        qemu-img convert 的性能选项，指令中的同名键优先于配置
+        :return: 参数列表
+        """
+        coroutines = msg.get('convert_coroutines', config['convert_coroutines'])
+        out_of_order = msg.get('convert_out_of_order', config['convert_out_of_order'])
+        compress = msg.get('convert_compress', config['convert_compress'])
+        cache = msg.get('convert_cache', config['convert_cache'])
+
+        # qemu-img 允许的并行协程数为 1 至 16
+        options = ['-m', str(min(max(int(coroutines), 1), 16))]
 
-        pattern_progress = re.compile(r'\((\d+(\.\d+)?)/100%\)')
+        # 乱序写与压缩互斥
+        if compress:
+            options.append('-c')
+
+        elif out_of_order:
+            options.append('-W')
+
+        if cache:
+            options.extend(['-t', cache])
+
+        return options
+
+    @staticmethod
+    def convert_snapshot(msg=None):
 
         extend_data = dict()
 
@@ -609,52 +1061,57 @@ class Guest(object):
             snapshot_path = msg['snapshot_path']
             template_path = msg['template_path']
 
-            if msg['storage_mode'] == StorageMode.glusterfs.value:
-
-                storage = Storage(storage_mode=msg['storage_mode'], dfs_volume=msg['dfs_volume'])
+            storage = Storage(storage_mode=msg['storage_mode'], dfs_volume=msg['dfs_volume'])
+            virtual_size = storage.image_info(path=snapshot_path)['virtual-size']
 
-                if not storage.gf.isdir(os.path.dirname(template_path)):
-                    storage.gf.makedirs(os.path.dirname(template_path), 0755)
+            if msg['storage_mode'] == StorageMode.glusterfs.value:
+                storage.makedirs(path=os.path.dirname(template_path))
 
                 snapshot_path = '/'.join(['gluster://127.0.0.1', msg['dfs_volume'], snapshot_path])
                 template_path = '/'.join(['gluster://127.0.0.1', msg['dfs_volume'], template_path])
 
-            cmd = ' '.join(['/usr/bin/qemu-img', 'convert', '--force-share', '-O', 'qcow2', '-s', msg['snapshot_id'],
-                            snapshot_path, template_path])
+            begin = time.time()
+
+            # 限制本节点同时进行的转换数量
+            with Guest.convert_slots:
+                Metrics.observe(name='jimvn_snapshot_convert_wait_seconds', value=time.time() - begin,
+                                _help='time snapshot conversions waited for a node slot')
 
-            qemu_img_convert = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                with StorageScheduler.job(storage=storage, kind=StorageScheduler.bulk, name='convert_snapshot'):
+                    begin = time.time()
 
-            fcntl.fcntl(qemu_img_convert.stdout, fcntl.F_SETFL,
-                        fcntl.fcntl(qemu_img_convert.stdout, fcntl.F_GETFL) | os.O_NONBLOCK)
+                    def emit(percent):
+                        # 单位(Byte/s)，以已转换的虚拟容量计
+                        throughput = int(virtual_size * percent / 100 / max(time.time() - begin, 0.001))
+                        guest_event_emit.snapshot_converting(
+                            uuid=msg['uuid'], os_template_image_id=msg['os_template_image_id'], progress=percent,
+                            throughput=throughput)
 
-            while qemu_img_convert.returncode is None:
-                line = None
+                    ProgressTracker.start(key=msg['uuid'], emit=emit)
 
-                try:
-                    line = qemu_img_convert.stdout.readline()
-                except IOError as e:
-                    pass
+                    exit_status, output = QemuImg.run(
+                        args=['convert', '--force-share', '-p', '-O', 'qcow2'] + Guest.convert_options(msg=msg) +
+                             ['-s', msg['snapshot_id'], snapshot_path, template_path],
+                        progress=ProgressTracker.callback(key=msg['uuid']), timeout=config['qemu_img_bulk_timeout'])
 
-                if line is not None:
-                    p = pattern_progress.match(line.strip())
+                    if exit_status != 0:
+                        raise CommandExecFailed(u' '.join([u'创建自定义模板失败，命令执行退出异常：', output]))
 
-                    if p is not None:
-                        fields = p.groups()
-                        guest_event_emit.snapshot_converting(uuid=msg['uuid'],
-                                                             os_template_image_id=msg['os_template_image_id'],
-                                                             progress=int(fields[0].split('.')[0]))
+                    ProgressTracker.finish(key=msg['uuid'])
 
-                time.sleep(0.5)
-                qemu_img_convert.send_signal(signal.SIGUSR1)
-                qemu_img_convert.poll()
+            elapsed = time.time() - begin
+            extend_data['throughput'] = int(virtual_size / elapsed) if elapsed > 0 else None
 
-            if qemu_img_convert.returncode != 0:
-                raise CommandExecFailed(u'创建自定义模板失败，命令执行退出异常。')
+            Metrics.observe(name='jimvn_snapshot_convert_seconds', value=elapsed,
+                            _help='time spent converting snapshots to templates')
+            Metrics.inc(name='jimvn_snapshot_convert_bytes_total', value=virtual_size,
+                        _help='virtual bytes converted from snapshots to templates')
 
             response_emit.success(_object=msg['_object'], action=msg['action'], uuid=msg['uuid'],
                                   data=extend_data, passback_parameters=msg.get('passback_parameters'))
 
         except:
+            ProgressTracker.fail(key=msg.get('uuid'), reason=traceback.format_exc().splitlines()[-1])
             log_emit.error(traceback.format_exc())
             response_emit.failure(_object=msg['_object'], action=msg.get('action'), uuid=msg.get('uuid'),
                                   data=extend_data, passback_parameters=msg.get('passback_parameters'))
@@ -737,6 +1194,82 @@ class Guest(object):
             response_emit.failure(_object=msg['_object'], action=msg.get('action'), uuid=msg.get('uuid'),
                                   data=extend_data, passback_parameters=msg.get('passback_parameters'))
 
+    @staticmethod
+    def prepare_remote_disks(hostname=None, root=None, preallocation=None):
+        """
+        在目标宿主机上预先创建本地存储的磁盘。先检查目标各文件系统的可用空间，再经复用的 SSH 连接并行创建
+        :param preallocation: qemu-img 的 preallocation 选项，off、metadata、falloc 或 full
+        """
+        disks = list()
+
+        for _disk in root.findall('devices/disk'):
+            _file_path = _disk.find('source').get('file') if _disk.find('source') is not None else None
+
+            if _disk.get('device') != 'disk' or _file_path is None:
+                continue
+
+            disk_info = Storage.image_info_by_local(path=_file_path)
+
+            # 预分配空间的方式需要完整的虚拟容量。否则只需迁移时写入的数据量，
+            # 迁移把整条镜像链(外部快照的 overlay、链接克隆的模板等)合并写入目标磁盘，需汇总各层的实际占用
+            if preallocation in ['falloc', 'full']:
+                required = disk_info['virtual-size']
+
+            else:
+                chain = Storage(storage_mode=StorageMode.local.value, dfs_volume=None).backing_chain(path=_file_path)
+                required = min(sum([Storage.image_info_by_local(path=path)['actual-size'] for path in chain]),
+                               disk_info['virtual-size'])
+
+            disks.append((_file_path, disk_info['virtual-size'], required))
+
+        # 以目标上的文件系统汇总所需空间
+        required = dict()
+        available = dict()
+
+        for _dir in set([os.path.dirname(item[0]) for item in disks]):
+            exit_status, stdout, stderr = SSHPool.exec_command(
+                hostname=hostname, user='root', cmd=' '.join(['mkdir -p', _dir, '&& df -P -B1', _dir, '| tail -n 1']),
+                timeout=config['ssh_command_timeout'])
+
+            if exit_status != 0:
+                raise CommandExecFailed(u' '.join([u'获取目标宿主机', hostname, u'的目录', _dir, u'可用空间失败：', stderr]))
+
+            fields = stdout.split()
+            available[fields[0]] = int(fields[3])
+            required[fields[0]] = required.get(fields[0], 0) + \
+                sum([item[2] for item in disks if os.path.dirname(item[0]) == _dir])
+
+        for filesystem, size in required.items():
+            if size > available[filesystem]:
+                raise RuntimeError(u' '.join([u'目标宿主机', hostname, u'的文件系统', filesystem, u'可用空间不足，需要',
+                                              str(size), u'字节，可用', str(available[filesystem]), u'字节。']))
+
+        errors = list()
+
+        def create(path, size):
+            try:
+                exit_status, stdout, stderr = SSHPool.exec_command(
+                    hostname=hostname, user='root', cmd=' '.join(['qemu-img', 'create', '-f', 'qcow2', '-o',
+                                                                  'preallocation=' + preallocation, path, str(size)]),
+                    timeout=config['ssh_command_timeout'])
+
+                if exit_status != 0:
+                    errors.append(u' '.join([u'目标宿主机', hostname, u'创建磁盘', path, u'失败：', stderr]))
+
+            except Exception as e:
+                errors.append(u' '.join([u'目标宿主机', hostname, u'创建磁盘', path, u'失败：', unicode(e)]))
+
+        threads = [threading.Thread(target=create, args=(item[0], item[1])) for item in disks]
+
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        if errors:
+            raise CommandExecFailed(u'\n'.join(errors))
+
     @staticmethod
     def migrate(dom=None, msg=None):
         assert isinstance(dom, libvirt.virDomain)
@@ -749,6 +1282,12 @@ class Guest(object):
             libvirt.VIR_MIGRATE_PEER2PEER | \
             libvirt.VIR_MIGRATE_AUTO_CONVERGE
 
+        # cloud-init seed 位于本节点的本地目录，在 Guest 读取(guest agent 连接时弹出)之前，迁移将使其丢失初始化配置
+        if CloudInit.has_seed(uuid=dom.UUIDString()):
+            err = u'Guest 的 cloud-init seed 尚未被读取，暂不能迁移。'
+            log_emit.warn(err)
+            raise RuntimeError('Cloud-init seed of the guest has not been consumed yet.')
+
         root = ET.fromstring(dom.XMLDesc())
 
         if msg['storage_mode'] == StorageMode.local.value:
@@ -762,20 +1301,8 @@ class Guest(object):
                 log_emit.warn(err)
                 raise RuntimeError('Nonsupport offline migrate with storage of non sharing mode.')
 
-            ssh_client = Utils.ssh_client(hostname=msg['duri'].split('/')[2], user='root')
-
-            for _disk in root.findall('devices/disk'):
-                _file_path = _disk.find('source').get('file')
-                disk_info = Storage.image_info_by_local(path=_file_path)
-                disk_size = disk_info['virtual-size']
-                stdin, stdout, stderr = ssh_client.exec_command(
-                    ' '.join(['qemu-img', 'create', '-f', 'qcow2', _file_path, str(disk_size)]))
-
-                for line in stdout:
-                    log_emit.info(line)
-
-                for line in stderr:
-                    log_emit.error(line)
+            Guest.prepare_remote_disks(hostname=msg['duri'].split('/')[2], root=root,
+                                       preallocation=msg.get('preallocation', config['migrate_preallocation']))
 
         elif msg['storage_mode'] in [StorageMode.shared_mount.value, StorageMode.ceph.value,
                                      StorageMode.glusterfs.value]:
@@ -790,7 +1317,7 @@ class Guest(object):
         if dom.migrateToURI(duri=msg['duri'], flags=flags) == 0:
             if msg['storage_mode'] == StorageMode.local.value:
                 for _disk in root.findall('devices/disk'):
-                    _file_path = _disk.find('source').get('file')
+                    _file_path = _disk.find('source').get('file') if _disk.find('source') is not None else None
                     if _file_path is not None:
                         os.remove(_file_path)
 
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import threading
+from collections import OrderedDict
+
+import jimit as ji
+
+
+__author__ = 'James Iter'
+__date__ = '2026/10/19'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2026 by James Iter.'
+
+
+class GuestStateTable(object):
+    """
+    Guest 状态表。由 libvirt 生命周期事件、guest agent 生命周期事件驱动更新，低频的状态校准仅用于修正遗漏的事件。
+    """
+
+    lock = threading.Lock()
+    # uuid -> {'state': GuestState, 'timestamp': 状态变更时间}
+    states = dict()
+    # uuid -> guest agent 是否已连接
+    agents = dict()
+    # 去抖窗口内待上报的 Guest，uuid -> {'uuid', 'name', 'state', 'timestamp'}
+    pending = OrderedDict()
+
+    @classmethod
+    def update(cls, uuid=None, state=None):
+        """
+        :return: 状态是否发生了变化
+        """
+        with cls.lock:
+            if uuid in cls.states and cls.states[uuid]['state'] == state:
+                return False
+
+            cls.states[uuid] = {'state': state, 'timestamp': ji.Common.ts()}
+            return True
+
+    @classmethod
+    def mark(cls, uuid=None, state=None, name=None):
+        """
+        记录 Guest 的最新状态，并放入待上报队列。同一 Guest 在上报前的多次变化，只保留最后一次
+        """
+        with cls.lock:
+            if uuid not in cls.states or cls.states[uuid]['state'] != state:
+                cls.states[uuid] = {'state': state, 'timestamp': ji.Common.ts()}
+
+            cls.pending.pop(uuid, None)
+            cls.pending[uuid] = {'uuid': uuid, 'name': name, 'state': state,
+                                 'timestamp': cls.states[uuid]['timestamp']}
+
+    @classmethod
+    def pop_pending(cls):
+        with cls.lock:
+            guests = cls.pending.values()
+            cls.pending = OrderedDict()
+
+        return guests
+
+    @classmethod
+    def get(cls, uuid=None):
+        with cls.lock:
+            if uuid not in cls.states:
+                return None
+
+            return dict(cls.states[uuid])
+
+    @classmethod
+    def set_agent(cls, uuid=None, connected=None):
+        with cls.lock:
+            if connected is None:
+                cls.agents.pop(uuid, None)
+
+            else:
+                cls.agents[uuid] = connected
+
+    @classmethod
+    def agent_connected(cls, uuid=None):
+        """
+        :return: True 已连接，False 未连接，None 未知
+        """
+        with cls.lock:
+            return cls.agents.get(uuid)
+
+    @classmethod
+    def remove(cls, uuid=None):
+        with cls.lock:
+            cls.states.pop(uuid, None)
+            cls.agents.pop(uuid, None)
+
+    @classmethod
+    def retain(cls, uuids=None):
+        """
+        清除已不在本宿主机上的 Guest
+        """
+        with cls.lock:
+            for uuid in cls.states.keys():
+                if uuid not in uuids:
+                    del cls.states[uuid]
+
+            for uuid in cls.agents.keys():
+                if uuid not in uuids:
+                    del cls.agents[uuid]
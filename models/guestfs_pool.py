@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import time
+import string
+import threading
+import traceback
+import Queue
+
+import guestfs
+
+from initialize import config, logger
+from metrics import Metrics
+
+
+__author__ = 'James Iter'
+__date__ = '2026/10/19'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2026 by James Iter.'
+
+
+class GuestFSPool(object):
+    """
+    libguestfs 设备池。每次 launch 都会启动一个 appliance 虚拟机，耗时数秒且占用数百 MB 内存。
+    池中的 appliance 启动后常驻，初始化 Guest 时以热插拔的方式挂入其磁盘，操作完成后拔出，供下一个 Guest 复用。
+    guestfs_pool_size 为 0 时，退回到每次新建并启动 appliance 的方式。
+    """
+
+    lock = threading.Lock()
+    idle = Queue.Queue()
+    # 已启动(含正在使用中)的 appliance 数量
+    launched = 0
+    # 最近若干次 launch 耗时的平均值(秒)，用于估算复用所节省的时间
+    launch_seconds = None
+
+    @staticmethod
+    def size():
+        return config['guestfs_pool_size']
+
+    @classmethod
+    def launch(cls):
+        g = guestfs.GuestFS(python_return_dict=True)
+
+        # 未添加磁盘即启动，之后的磁盘均以热插拔的方式挂入。只有 libvirt 后端支持热插拔，
+        # 不受环境变量 LIBGUESTFS_BACKEND 影响
+        g.set_backend('libvirt')
+
+        if not g.get_backend().startswith('libvirt'):
+            g.close()
+            raise RuntimeError(u'libguestfs 的 libvirt 后端不可用，无法热插拔磁盘。')
+
+        begin = time.time()
+        g.launch()
+        elapsed = time.time() - begin
+
+        with cls.lock:
+            if cls.launch_seconds is None:
+                cls.launch_seconds = elapsed
+
+            else:
+                cls.launch_seconds = cls.launch_seconds * 0.8 + elapsed * 0.2
+
+        Metrics.inc(name='jimvn_guestfs_launches_total', _help='libguestfs appliances launched')
+        Metrics.set(name='jimvn_guestfs_launch_seconds', value=round(elapsed, 3),
+                    _help='seconds taken by the latest libguestfs appliance launch')
+
+        return g
+
+    @classmethod
+    def warm(cls):
+        """
+        预先启动 appliance，直至池满
+        """
+        while True:
+            with cls.lock:
+                if cls.launched >= cls.size():
+                    return
+
+                cls.launched += 1
+
+            try:
+                cls.idle.put(cls.launch())
+
+            except:
+                with cls.lock:
+                    cls.launched -= 1
+
+                logger.warn(traceback.format_exc())
+                return
+
+    @classmethod
+    def acquire(cls, timeout=None):
+        """
+        :return: 已启动的 appliance。池满且均在使用中时，等待其它 Guest 归还
+        """
+        if cls.size() < 1:
+            return cls.launch()
+
+        while True:
+            try:
+                g = cls.idle.get_nowait()
+
+            except Queue.Empty:
+                break
+
+            if cls.healthy(g=g):
+                cls.saved()
+                return g
+
+            cls.discard(g=g)
+
+        with cls.lock:
+            grow = cls.launched < cls.size()
+
+            if grow:
+                cls.launched += 1
+
+        if grow:
+            try:
+                return cls.launch()
+
+            except:
+                with cls.lock:
+                    cls.launched -= 1
+
+                raise
+
+        g = cls.idle.get(timeout=timeout)
+
+        if not cls.healthy(g=g):
+            # 关闭失效的 appliance，由本次 acquire 重新启动
+            cls.discard(g=g)
+            return cls.acquire(timeout=timeout)
+
+        cls.saved()
+        return g
+
+    @staticmethod
+    def healthy(g=None):
+        """
+        空闲的 appliance 可能已异常退出(如 qemu 进程被杀)，取出时先探测其守护进程
+        """
+        try:
+            g.ping_daemon()
+            return True
+
+        except:
+            logger.warn(traceback.format_exc())
+            Metrics.inc(name='jimvn_guestfs_unhealthy_total', _help='pooled libguestfs appliances found dead')
+            return False
+
+    @classmethod
+    def saved(cls):
+        Metrics.inc(name='jimvn_guestfs_reuses_total', _help='libguestfs appliances reused from the pool')
+
+        if cls.launch_seconds is not None:
+            Metrics.inc(name='jimvn_guestfs_saved_seconds_total', value=round(cls.launch_seconds, 3),
+                        _help='estimated appliance launch seconds saved by the pool')
+
+    @classmethod
+    def release(cls, g=None, labels=None):
+        """
+        卸载文件系统并拔出热插拔的磁盘后归还。清理失败的 appliance 直接关闭，由后续的 acquire 重新启动
+        """
+        if cls.size() < 1:
+            cls.close(g=g)
+            return
+
+        try:
+            g.umount_all()
+            g.sync()
+
+            for label in labels or list():
+                g.remove_drive(label)
+
+            cls.idle.put(g)
+
+        except:
+            logger.warn(traceback.format_exc())
+            cls.discard(g=g)
+
+    @classmethod
+    def discard(cls, g=None):
+        if cls.size() > 0:
+            with cls.lock:
+                cls.launched -= 1
+
+        # 被丢弃的 appliance 可能已失效，关闭时的异常仅记录
+        try:
+            cls.close(g=g)
+
+        except:
+            logger.warn(traceback.format_exc())
+
+    @staticmethod
+    def close(g=None):
+        try:
+            g.shutdown()
+
+        finally:
+            g.close()
+
+    @staticmethod
+    def label(index=None):
+        # 磁盘标签仅可由字母组成
+        label = ''
+        index += 1
+
+        while index > 0:
+            index, remainder = divmod(index - 1, 26)
+            label = string.ascii_lowercase[remainder] + label
+
+        return 'd' + label
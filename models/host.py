@@ -5,7 +5,6 @@
 import os
 import time
 import traceback
-import Queue
 import libvirt
 import json
 import subprocess
@@ -16,12 +15,25 @@ import psutil
 import cpuinfo
 import dmidecode
 import threading
+import socket
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 from initialize import config, logger, r, log_emit, response_emit, host_event_emit, guest_collection_performance_emit, \
-    threads_status, host_collection_performance_emit, guest_event_emit, q_creating_guest
+    threads_status, host_collection_performance_emit, guest_state_emit
 from guest import Guest
+from guest_state import GuestStateTable
 from storage import Storage
+from pressure import Pressure
+from metrics import Metrics
+from template_cache import TemplateCache
+from progress import ProgressTracker
+from warm_pool import WarmImagePool
+from gluster_pool import GlusterFSPool
+from trash import Trash
+from image_allocation import ImageAllocation
 from utils import Utils, QGA
+from status import GuestState
 
 
 __author__ = 'James Iter'
@@ -46,12 +58,14 @@ class Host(object):
         self.interfaces = dict()
         self.disks = dict()
         # host, guest 性能收集统计周期，单位(秒)
-        self.interval = 60
+        self.interval = config['performance_collection_interval']
         self.last_host_traffic = dict()
         self.last_host_disk_io = dict()
         self.last_guest_cpu_time = dict()
         self.last_guest_traffic = dict()
         self.last_guest_disk_io = dict()
+        # 状态校准中尚未返回的异步任务，uuid -> AsyncResult
+        self.reconcile_pending = dict()
         self.ts = ji.Common.ts()
         self.version = config['version']
 
@@ -184,6 +198,12 @@ class Host(object):
                         t.start()
                         continue
 
+                    elif msg['action'] == 'flatten':
+                        t = threading.Thread(target=Guest.flatten, args=(self.dom, msg))
+                        t.setDaemon(False)
+                        t.start()
+                        continue
+
                     elif msg['action'] == 'migrate':
                         Guest().migrate(dom=self.dom, msg=msg)
 
@@ -197,6 +217,19 @@ class Host(object):
                         Storage(storage_mode=msg['storage_mode'], dfs_volume=msg['dfs_volume']).delete_image(
                             path=msg['image_path'])
 
+                    elif msg['action'] == 'undelete':
+                        Storage(storage_mode=msg['storage_mode'], dfs_volume=msg['dfs_volume']).undelete_image(
+                            path=msg['image_path'])
+
+                    elif msg['action'] == 'backup':
+                        self.refresh_dom_mapping()
+                        self.dom = self.dom_mapping_by_uuid[msg['guest_uuid']]
+
+                        t = threading.Thread(target=Guest.backup, args=(self.dom, msg))
+                        t.setDaemon(False)
+                        t.start()
+                        continue
+
                     elif msg['action'] == 'resize':
                         mounted = True if msg['guest_uuid'].__len__() == 36 else False
 
@@ -305,12 +338,9 @@ class Host(object):
     @staticmethod
     def guest_creating_progress_report_engine():
         """
-        Guest 创建进度上报引擎
+        Guest 创建进度上报引擎。进度由复制引擎直接推送给 ProgressTracker，该引擎只补发被节流的进度并检测停滞的复制
         """
 
-        list_creating_guest = list()
-        template_size = dict()
-
         while True:
             if Utils.exit_flag:
                 msg = 'Thread guest_creating_progress_report_engine say bye-bye'
@@ -319,34 +349,10 @@ class Host(object):
                 return
 
             try:
-                try:
-                    payload = q_creating_guest.get(timeout=config['engine_cycle_interval'])
-                    list_creating_guest.append(payload)
-                    q_creating_guest.task_done()
-                except Queue.Empty as e:
-                    pass
-
-                # 当有 Guest 被创建时，略微等待一下，避免复制模板的动作还没开始，就开始计算进度。这样会产生找不到镜像路径的异常。
-                time.sleep(1)
-
+                time.sleep(config['engine_cycle_interval'])
                 threads_status['guest_creating_progress_report_engine'] = {'timestamp': ji.Common.ts()}
 
-                for i, guest in enumerate(list_creating_guest):
-
-                    template_path = guest['template_path']
-
-                    storage = Storage(storage_mode=guest['storage_mode'], dfs_volume=guest['dfs_volume'])
-
-                    if template_path not in template_size:
-                        template_size[template_path] = float(storage.getsize(path=template_path))
-
-                    system_image_size = storage.getsize(path=guest['system_image_path'])
-                    progress = system_image_size / template_size[template_path]
-
-                    guest_event_emit.creating(uuid=guest['uuid'], progress=int(progress * 90))
-
-                    if progress >= 1:
-                        del list_creating_guest[i]
+                ProgressTracker.flush()
 
             except:
                 log_emit.warn(traceback.format_exc())
@@ -375,34 +381,124 @@ class Host(object):
             if os.path.islink(disk.device):
                 self.disks[disk.mountpoint]['real_device'] = os.path.realpath(disk.device)
 
+    def reconcile_guest_state(self, pool=None):
+        """
+        并行校准所有 Guest 的状态，单次校准的总耗时受 guest_state_reconcile_timeout 限制
+        """
+        self.refresh_dom_mapping()
+        GuestStateTable.retain(uuids=self.dom_mapping_by_uuid.keys())
+
+        results = dict()
+        skipped_uuids = list()
+
+        for uuid, dom in self.dom_mapping_by_uuid.items():
+            # 上一轮超时的任务仍在执行时跳过该 Guest，避免卡住的 Guest 在线程池队列中持续堆积任务
+            if uuid in self.reconcile_pending and not self.reconcile_pending[uuid].ready():
+                skipped_uuids.append(uuid)
+                continue
+
+            results[uuid] = pool.apply_async(Guest.get_state, kwds={'dom': dom, 'reconcile': True})
+
+        self.reconcile_pending = dict([(uuid, self.reconcile_pending[uuid]) for uuid in skipped_uuids])
+
+        deadline = time.time() + config['guest_state_reconcile_timeout']
+        timeout_uuids = list()
+
+        for uuid, result in results.items():
+            try:
+                state = result.get(timeout=max(deadline - time.time(), 0.01))
+
+            except multiprocessing.TimeoutError:
+                timeout_uuids.append(uuid)
+                self.reconcile_pending[uuid] = result
+                continue
+
+            except libvirt.libvirtError as e:
+                # 校准过程中被删除或迁出的 Guest
+                logger.warn(e.message)
+                continue
+
+            current = GuestStateTable.get(uuid=uuid)
+            if current is not None and current['state'] == state:
+                continue
+
+            Guest.guest_state_report(dom=self.dom_mapping_by_uuid[uuid], state=state)
+
+        if timeout_uuids.__len__() > 0:
+            log_emit.warn(u' '.join([u'校准 Guest 状态超时：', u', '.join(timeout_uuids)]))
+
+        if skipped_uuids.__len__() > 0:
+            log_emit.warn(u' '.join([u'上一轮校准仍未返回，跳过 Guest：', u', '.join(skipped_uuids)]))
+
     # 使用时，创建独立的实例来避开 多线程 的问题
     def guest_state_report_engine(self):
         """
-        Guest 状态上报引擎
+        Guest 状态校准引擎。Guest 状态由生命周期事件及 agent 生命周期事件驱动上报，该引擎仅低频地修正遗漏的事件
         """
-        guest_state_mapping = dict()
+        pool = ThreadPool(processes=config['guest_state_reconcile_workers'])
+        last_reconcile = 0
 
         while True:
             if Utils.exit_flag:
+                pool.terminate()
                 msg = 'Thread guest_state_report_engine say bye-bye'
                 print msg
                 logger.info(msg=msg)
                 return
 
             try:
-                # 3 秒钟更新一次
-                time.sleep(config['engine_cycle_interval'] * 3)
+                time.sleep(config['engine_cycle_interval'])
                 threads_status['guest_state_report_engine'] = {'timestamp': ji.Common.ts()}
-                self.refresh_dom_mapping()
 
-                for uuid, dom in self.dom_mapping_by_uuid.items():
-                    state = Guest.get_state(dom=dom)
+                if ji.Common.ts() - last_reconcile < config['guest_state_reconcile_interval']:
+                    continue
 
-                    if uuid in guest_state_mapping and guest_state_mapping[uuid] == state:
-                        continue
+                last_reconcile = ji.Common.ts()
+                self.reconcile_guest_state(pool=pool)
 
-                    guest_state_mapping[uuid] = state
-                    Guest.guest_state_report(dom=dom)
+            except:
+                log_emit.warn(traceback.format_exc())
+
+    @staticmethod
+    def guest_state_flush_engine():
+        """
+        Guest 状态上报引擎。去抖窗口内同一 Guest 的多次状态变化只上报最后一次。
+        默认将所有 Guest 合并为一条消息上报。guest_state_batch_report 为假时，逐个发射原有的状态事件
+        """
+
+        while True:
+            if Utils.exit_flag:
+                msg = 'Thread guest_state_flush_engine say bye-bye'
+                print msg
+                logger.info(msg=msg)
+                return
+
+            try:
+                time.sleep(config['guest_state_debounce_window'])
+                threads_status['guest_state_flush_engine'] = {'timestamp': ji.Common.ts()}
+
+                guests = GuestStateTable.pop_pending()
+
+                if guests.__len__() < 1:
+                    continue
+
+                if config['guest_state_batch_report']:
+                    guest_state_emit.batch(guests=[{'uuid': guest['uuid'], 'state': guest['state'],
+                                                    'timestamp': guest['timestamp']} for guest in guests])
+
+                else:
+                    for guest in guests:
+                        Guest.emit_state(uuid=guest['uuid'], state=guest['state'])
+
+                summary = dict()
+                for guest in guests:
+                    name = GuestState(guest['state']).name
+                    summary[name] = summary.get(name, 0) + 1
+                    logger.debug(msg=u' '.join([u'域', guest['name'], u', UUID', guest['uuid'], u'的状态改变为', name]))
+
+                log = u' '.join([str(guests.__len__()), u'个 Guest 的状态发生改变：',
+                                 u', '.join([u': '.join([k, str(v)]) for k, v in summary.items()])])
+                log_emit.info(msg=log)
 
             except:
                 log_emit.warn(traceback.format_exc())
@@ -440,17 +536,53 @@ class Host(object):
                                                    'interfaces': self.interfaces, 'disks': self.disks,
                                                    'system_load': os.getloadavg(), 'boot_time': boot_time,
                                                    'memory_available': psutil.virtual_memory().available,
-                                                   'threads_status': threads_status, 'version': self.version})
+                                                   'threads_status': threads_status, 'version': self.version,
+                                                   'template_cache': TemplateCache.stats(),
+                                                   'warm_image_pool': WarmImagePool.stats(),
+                                                   'trash': Trash.stats()})
 
             except:
                 log_emit.warn(traceback.format_exc())
 
     def refresh_guest_state(self):
+        """
+        以一次批量状态查询，生成本节点所有 Guest 的状态快照并上报。过程中不与 guest agent 通讯，也不逐个读取 XMLDesc
+        """
         try:
-            self.refresh_dom_mapping()
+            guests = list()
+
+            for dom, stats in self.conn.getAllDomainStats(stats=libvirt.VIR_DOMAIN_STATS_STATE):
+                _uuid = dom.UUIDString()
+                agent_connected = None
 
-            for dom in self.dom_mapping_by_uuid.values():
-                Guest.guest_state_report(dom=dom)
+                if stats['state.state'] == libvirt.VIR_DOMAIN_RUNNING:
+                    # agent 的连接状态取自 agent 生命周期事件及状态校准维护的缓存，不逐个查询 XMLDesc
+                    agent_connected = GuestStateTable.agent_connected(uuid=_uuid)
+
+                    if agent_connected is None:
+                        # 缓存中尚无记录时，沿用状态表中已有的 running 状态，其余视为 booting，由状态校准修正
+                        current = GuestStateTable.get(uuid=_uuid)
+                        agent_connected = current is not None and current['state'] == GuestState.running.value
+
+                state = Guest.state_from_libvirt(state=stats['state.state'], agent_connected=agent_connected)
+                GuestStateTable.update(uuid=_uuid, state=state)
+
+                guests.append({'uuid': _uuid, 'state': state,
+                               'timestamp': GuestStateTable.get(uuid=_uuid)['timestamp']})
+
+            if config['guest_state_snapshot_report']:
+                chunk_size = config['guest_state_snapshot_chunk_size']
+                chunks = max((guests.__len__() + chunk_size - 1) / chunk_size, 1)
+
+                for i in range(chunks):
+                    guest_state_emit.snapshot(guests=guests[i * chunk_size: (i + 1) * chunk_size], chunk=i,
+                                              chunks=chunks)
+
+            else:
+                for guest in guests:
+                    Guest.emit_state(uuid=guest['uuid'], state=guest['state'])
+
+            log_emit.info(msg=u' '.join([u'已上报', str(guests.__len__()), u'个 Guest 的状态快照。']))
 
         except:
             log_emit.warn(traceback.format_exc())
@@ -510,7 +642,9 @@ class Host(object):
             if cpu_memory.__len__() > 0:
                 data.append(cpu_memory)
 
-        if data.__len__() > 0:
+        Metrics.collect(scope='guest', kind='cpu_memory', data=data)
+
+        if data.__len__() > 0 and config['performance_upstream']:
             guest_collection_performance_emit.cpu_memory(data=data)
 
     def guest_traffic_performance_report(self):
@@ -564,7 +698,9 @@ class Host(object):
                 if traffic.__len__() > 0:
                     data.append(traffic)
 
-        if data.__len__() > 0:
+        Metrics.collect(scope='guest', kind='traffic', data=data)
+
+        if data.__len__() > 0 and config['performance_upstream']:
             guest_collection_performance_emit.traffic(data=data)
 
     def guest_disk_io_performance_report(self):
@@ -579,6 +715,10 @@ class Host(object):
             root = ET.fromstring(dom.XMLDesc())
 
             for disk in root.findall('devices/disk'):
+                # 空的光驱
+                if disk.find('source') is None:
+                    continue
+
                 dev = disk.find('target').get('dev')
                 protocol = disk.find('source').get('protocol')
 
@@ -620,7 +760,9 @@ class Host(object):
                 if disk_io.__len__() > 0:
                     data.append(disk_io)
 
-        if data.__len__() > 0:
+        Metrics.collect(scope='guest', kind='disk_io', data=data)
+
+        if data.__len__() > 0 and config['performance_upstream']:
             guest_collection_performance_emit.disk_io(data=data)
 
     def guest_performance_collection_engine(self):
@@ -671,7 +813,10 @@ class Host(object):
             'memory_available': psutil.virtual_memory().available,
         }
 
-        host_collection_performance_emit.cpu_memory(data=cpu_memory)
+        Metrics.collect(scope='host', kind='cpu_memory', data=cpu_memory)
+
+        if config['performance_upstream']:
+            host_collection_performance_emit.cpu_memory(data=cpu_memory)
 
     def host_traffic_performance_report(self):
 
@@ -708,7 +853,9 @@ class Host(object):
             if traffic.__len__() > 0:
                 data.append(traffic)
 
-        if data.__len__() > 0:
+        Metrics.collect(scope='host', kind='traffic', data=data)
+
+        if data.__len__() > 0 and config['performance_upstream']:
             host_collection_performance_emit.traffic(data=data)
 
     def host_disk_usage_io_performance_report(self):
@@ -742,9 +889,25 @@ class Host(object):
             if disk_usage_io.__len__() > 0:
                 data.append(disk_usage_io)
 
-        if data.__len__() > 0:
+        Metrics.collect(scope='host', kind='disk_usage_io', data=data)
+
+        if data.__len__() > 0 and config['performance_upstream']:
             host_collection_performance_emit.disk_usage_io(data=data)
 
+    def host_pressure_performance_report(self):
+
+        pressure = Pressure.get()
+
+        if pressure.__len__() < 1:
+            return
+
+        pressure['node_id'] = self.node_id
+
+        Metrics.collect(scope='host', kind='pressure', data=pressure)
+
+        if config['performance_upstream']:
+            host_collection_performance_emit.pressure(data=pressure)
+
     def host_performance_collection_engine(self):
         while True:
             if Utils.exit_flag:
@@ -758,6 +921,9 @@ class Host(object):
                 threads_status['host_performance_collection_engine'] = {'timestamp': ji.Common.ts()}
                 self.ts = ji.Common.ts()
 
+                # 压力数据每个周期都采集，以便进程内的其它功能读取到及时的数据
+                Pressure.sample()
+
                 if self.ts % self.interval != 0:
                     continue
 
@@ -766,6 +932,156 @@ class Host(object):
                 self.host_cpu_memory_performance_report()
                 self.host_traffic_performance_report()
                 self.host_disk_usage_io_performance_report()
+                self.host_pressure_performance_report()
+
+            except:
+                log_emit.warn(traceback.format_exc())
+
+    def metrics_exporter_engine(self):
+        """
+        本地指标拉取服务，以 Prometheus 文本格式提供最近一次采集的宿主机及 Guest 性能数据
+        """
+
+        server = None
+
+        while True:
+            if Utils.exit_flag:
+                if server is not None:
+                    server.server_close()
+
+                msg = 'Thread metrics_exporter_engine say bye-bye'
+                print msg
+                logger.info(msg=msg)
+                return
+
+            try:
+                threads_status['metrics_exporter_engine'] = {'timestamp': ji.Common.ts()}
+
+                if server is None:
+                    # 监听地址被占用等情况下，记录后稍候重试，不使引擎线程退出
+                    try:
+                        server = Metrics.make_server(listen=config['metrics_listen'])
+                        server.timeout = config['engine_cycle_interval']
+
+                    except (socket.error, OSError) as e:
+                        log_emit.warn(u' '.join([u'指标服务监听', config['metrics_listen'], u'失败：', str(e)]))
+                        time.sleep(config['engine_cycle_interval'] * 10)
+                        continue
+
+                server.handle_request()
+
+            except:
+                log_emit.warn(traceback.format_exc())
+
+    @staticmethod
+    def warm_image_pool_engine():
+        """
+        预置镜像池补充引擎
+        """
+        last = 0
+
+        while True:
+            if Utils.exit_flag:
+                msg = 'Thread warm_image_pool_engine say bye-bye'
+                print msg
+                logger.info(msg=msg)
+                return
+
+            try:
+                time.sleep(config['engine_cycle_interval'])
+                threads_status['warm_image_pool_engine'] = {'timestamp': ji.Common.ts()}
+
+                if ji.Common.ts() - last < config['warm_image_pool_interval']:
+                    continue
+
+                last = ji.Common.ts()
+                WarmImagePool.top_up()
+
+            except:
+                log_emit.warn(traceback.format_exc())
+
+    @staticmethod
+    def glusterfs_pool_engine():
+        """
+        卸载 gfapi 连接池中长期空闲的句柄
+        """
+
+        while True:
+            if Utils.exit_flag:
+                msg = 'Thread glusterfs_pool_engine say bye-bye'
+                print msg
+                logger.info(msg=msg)
+                return
+
+            try:
+                time.sleep(config['engine_cycle_interval'])
+                threads_status['glusterfs_pool_engine'] = {'timestamp': ji.Common.ts()}
+
+                GlusterFSPool.reap()
+
+            except:
+                log_emit.warn(traceback.format_exc())
+
+    @staticmethod
+    def trash_reaper_engine():
+        """
+        限速回收回收站中超过保留期的镜像
+        """
+
+        last = 0
+
+        while True:
+            if Utils.exit_flag:
+                msg = 'Thread trash_reaper_engine say bye-bye'
+                print msg
+                logger.info(msg=msg)
+                return
+
+            try:
+                time.sleep(config['engine_cycle_interval'])
+                threads_status['trash_reaper_engine'] = {'timestamp': ji.Common.ts()}
+
+                if ji.Common.ts() - last < config['trash_reap_interval']:
+                    continue
+
+                last = ji.Common.ts()
+                Trash.reap()
+
+            except:
+                log_emit.warn(traceback.format_exc())
+
+    def image_allocation_engine(self):
+        """
+        低优先级地批量统计镜像的实际占用与虚拟大小，仅上报增量
+        """
+
+        last = 0
+
+        while True:
+            if Utils.exit_flag:
+                msg = 'Thread image_allocation_engine say bye-bye'
+                print msg
+                logger.info(msg=msg)
+                return
+
+            try:
+                time.sleep(config['engine_cycle_interval'])
+                threads_status['image_allocation_engine'] = {'timestamp': ji.Common.ts()}
+
+                if ji.Common.ts() - last < config['image_allocation_interval']:
+                    continue
+
+                # 扫描需逐个读取镜像头，宿主机 IO 紧张时推迟至下个周期，让位于 Guest 的 IO
+                if Pressure.is_under_pressure(resource='io'):
+                    Metrics.inc(name='jimvn_image_allocation_deferred_total',
+                                _help='image allocation scans deferred by io pressure')
+                    continue
+
+                last = ji.Common.ts()
+                data = ImageAllocation.collect(node_id=self.node_id)
+
+                if data.__len__() > 0 and config['performance_upstream']:
+                    host_collection_performance_emit.image_allocation(data=data)
 
             except:
                 log_emit.warn(traceback.format_exc())
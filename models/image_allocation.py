@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+
+import jimit as ji
+
+from initialize import config
+from metrics import Metrics
+from storage import Storage
+
+
+__author__ = 'James Iter'
+__date__ = '2026/10/19'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2026 by James Iter.'
+
+
+class ImageAllocation(object):
+    """
+    镜像空间分配统计。周期性地批量扫描 image_allocation_dirs 中的目录，得到各镜像的实际占用与虚拟大小。
+    只上报新出现、已消失，或实际占用变化超过 image_allocation_delta 的镜像，每 image_allocation_full_interval 秒全量上报一次。
+    """
+
+    # (storage_mode, dfs_volume, 路径) -> 最近一次上报的 (actual_size, virtual_size)
+    reported = dict()
+    last_full = 0
+
+    @staticmethod
+    def scan():
+        allocation = dict()
+
+        for item in config['image_allocation_dirs']:
+            storage = Storage(storage_mode=item['storage_mode'], dfs_volume=item.get('dfs_volume'))
+
+            for record in storage.allocation(path=item['path']):
+                allocation[(item['storage_mode'], item.get('dfs_volume'), record['path'])] = \
+                    (record['actual_size'], record['virtual_size'])
+
+        return allocation
+
+    @staticmethod
+    def record(node_id=None, key=None, sizes=None):
+        storage_mode, dfs_volume, path = key
+
+        return {
+            'node_id': node_id,
+            'storage_mode': storage_mode,
+            'dfs_volume': dfs_volume,
+            'path': path,
+            'disk_uuid': os.path.basename(path).split('.')[0],
+            'actual_size': sizes[0],
+            'virtual_size': sizes[1]
+        }
+
+    @classmethod
+    def collect(cls, node_id=None):
+        """
+        :return: 需上报的增量记录。已消失镜像的 actual_size、virtual_size 为 None
+        """
+        allocation = cls.scan()
+        full = ji.Common.ts() - cls.last_full >= config['image_allocation_full_interval']
+        delta = config['image_allocation_delta'] * 1024 ** 2
+        data = list()
+
+        for key, sizes in allocation.items():
+            last = cls.reported.get(key)
+
+            if full or last is None or abs(sizes[0] - last[0]) >= delta or sizes[1] != last[1]:
+                data.append(cls.record(node_id=node_id, key=key, sizes=sizes))
+                cls.reported[key] = sizes
+
+        for key in set(cls.reported.keys()) - set(allocation.keys()):
+            data.append(cls.record(node_id=node_id, key=key, sizes=(None, None)))
+            del cls.reported[key]
+
+        if full:
+            cls.last_full = ji.Common.ts()
+
+        Metrics.collect(scope='host', kind='image_allocation', data=[
+            {'node_id': node_id, 'disk_uuid': os.path.basename(key[2]).split('.')[0], 'actual_size': sizes[0],
+             'virtual_size': sizes[1]} for key, sizes in allocation.items()])
+
+        return data
@@ -11,11 +11,10 @@ import json
 import getopt
 import redis
 import jimit as ji
-import Queue
 import errno
 
 from jimvn_exception import PathNotExist
-from utils import LogEmit, GuestEventEmit, ResponseEmit, HostEventEmit
+from utils import LogEmit, GuestEventEmit, GuestStateEmit, ResponseEmit, HostEventEmit
 from utils import GuestCollectionPerformanceEmit, HostCollectionPerformanceEmit
 
 
@@ -38,7 +37,106 @@ class Init(object):
         'pidfile': '/run/jimv/jimvn.pid',
         'engine_cycle_interval': 1,
         'version': '0.7',
-        'jimvn_path': '/usr/local/JimV-N'
+        'jimvn_path': '/usr/local/JimV-N',
+        # 宿主机压力状态的窗口平均统计周期，单位(秒)
+        'pressure_sample_window': 60,
+        # 判定宿主机处于压力之下的阈值，单位(百分比)
+        'pressure_threshold': {'cpu': 50, 'memory': 20, 'io': 30},
+        # host, guest 性能收集统计周期，单位(秒)
+        'performance_collection_interval': 60,
+        # 是否通过 Redis 上行队列推送性能数据。由本地监控代理拉取时，可关闭以减轻 JimV-C 的汇聚压力
+        'performance_upstream': True,
+        # 本地指标拉取服务监听地址，如 127.0.0.1:9178 或 unix:/run/jimv/metrics.sock。为 None 时不启用
+        'metrics_listen': None,
+        # guest-ping 的超时时间，单位(秒)
+        'guest_agent_ping_timeout': 1,
+        # Guest 状态校准周期、并行度及单次校准的总超时时间，单位(秒)
+        'guest_state_reconcile_interval': 60,
+        'guest_state_reconcile_workers': 8,
+        'guest_state_reconcile_timeout': 10,
+        # Guest 状态去抖窗口，窗口内同一 Guest 的多次状态变化只上报最后一次，单位(秒)
+        'guest_state_debounce_window': 1,
+        # 是否以合并的 guest_state 消息上报 Guest 状态变化。置为 False 时退回为按 Guest 逐个发射状态事件，仅用于兼容旧的控制器
+        'guest_state_batch_report': True,
+        # 刷新 Guest 状态时，是否以分块的全量快照上报。置为 False 时退回为按 Guest 逐个发射状态事件，仅用于兼容旧的控制器
+        'guest_state_snapshot_report': True,
+        # Guest 状态全量快照中，单条消息所含 Guest 的最大数量
+        'guest_state_snapshot_chunk_size': 1000,
+        # 创建 Guest 时，指令未指定 linked_clone 的情况下，是否以链接克隆的方式生成系统镜像
+        'linked_clone': False,
+        # 计算节点本地的模板缓存路径，及其容量预算，单位(GiB)。容量为 0 时不启用
+        'template_cache_path': '/var/lib/jimv/template_cache',
+        'template_cache_size': 0,
+        # 命中模板缓存时，是否以 md5 校验缓存文件
+        'template_cache_checksum': False,
+        # 经 gfapi 在卷内复制镜像时的并行线程数
+        'glusterfs_copy_workers': 4,
+        # 进度发射的最小时间间隔(秒)及最小百分比变化，及判定复制停滞的时长(秒)
+        'progress_emit_interval': 1,
+        'progress_emit_step': 1,
+        'progress_stall_timeout': 60,
+        # 常驻的 libguestfs appliance 数量，0 表示每次初始化 Guest 时新建并启动 appliance
+        'guestfs_pool_size': 2,
+        # 模板初始化方式，0 经 libguestfs 离线写入系统盘，1 生成 cloud-init NoCloud seed 由 Guest 首次启动时应用
+        'guest_initialize_mode': 0,
+        'cloud_init_seed_path': '/var/lib/jimv/cloud_init',
+        # 预置系统镜像池，如 [{'storage_mode': 0, 'dfs_volume': None, 'template_path': '/opt/Images/centos.qcow2',
+        # 'size': 3}]。可选的 pool_path 需与系统镜像位于同一文件系统(卷)内，默认为模板所在目录下的 .warm_pool
+        'warm_image_pool': [],
+        # 预置镜像池的巡检周期，单位(秒)
+        'warm_image_pool_interval': 10,
+        # 池目录被多个节点共享时，其它节点的临时文件超过该时长(秒)未被写入，才视为遗留文件删除
+        'warm_image_pool_tmp_expire': 3600,
+        # 共享存储模式下，合并基于同一模板的创建请求的时间窗口，单位(秒)，0 表示不合并。及单组的目标数量上限
+        'fan_out_window': 1,
+        'fan_out_max_destinations': 32,
+        # 每个存储后端(存储模式及卷)并发的元数据作业、批量作业数量，及批量复制的带宽上限，单位(MiB/s)，0 表示不限
+        'storage_metadata_concurrency': 8,
+        'storage_bulk_concurrency': 2,
+        'storage_bandwidth': 0,
+        # 按后端覆盖以上限制，键形如 '1:gv0'(存储模式:卷)，如 {'1:gv0': {'bulk': 4, 'bandwidth': 200}}
+        'storage_limits': {},
+        # 每个 GlusterFS 卷的 gfapi 句柄上限，及空闲句柄被卸载前的时长，单位(秒)
+        'glusterfs_pool_size': 4,
+        'glusterfs_pool_idle_timeout': 300,
+        # 删除的镜像在回收站中保留的时长(秒)，期间可恢复。小于 0 表示不使用回收站，直接删除
+        'trash_delay': 600,
+        # 回收站释放空间的速率，单位(MiB/s)。0 表示不限速
+        'trash_reclaim_rate': 256,
+        # 回收站的巡检周期，单位(秒)。及共享存储上回收站目录的回收租约有效期，单位(秒)，需大于巡检周期
+        'trash_reap_interval': 10,
+        'trash_lease_timeout': 60,
+        # 回收站目录名(位于镜像所在目录下)，及记录各回收站目录的文件，重启后据此继续回收
+        'trash_dir_name': '.trash',
+        'trash_registry': '/var/lib/jimv/trash.json',
+        # 统计镜像空间分配的目录，如 [{'storage_mode': 3, 'dfs_volume': 'gv0', 'path': '/jimv/guest_disk'}]。为空时不启用
+        'image_allocation_dirs': [],
+        # 扫描周期，单位(秒)。实际占用变化超过 image_allocation_delta(MiB) 的镜像才上报，及全量上报的周期，单位(秒)
+        'image_allocation_interval': 300,
+        'image_allocation_delta': 64,
+        'image_allocation_full_interval': 3600,
+        # 快照转模板时 qemu-img convert 的并行协程数(-m，1 至 16)，是否乱序写入(-W)，是否压缩(-c，与乱序写互斥)，
+        # 目标的缓存模式(-t)。指令中可用同名键覆盖
+        'convert_coroutines': 8,
+        'convert_out_of_order': True,
+        'convert_compress': False,
+        'convert_cache': 'none',
+        # 本节点同时进行的快照转模板数量上限
+        'convert_concurrency': 2,
+        # qemu-img 作业的超时时长，单位(秒)，0 表示不限。分别用于创建、扩容等短作业，及转换、合并后端镜像等长作业
+        'qemu_img_timeout': 600,
+        'qemu_img_bulk_timeout': 21600,
+        # 快照方式，0 为 qcow2 内部快照，1 为仅含磁盘的外部快照(经 Guest Agent 冻结文件系统，删除时在线 block commit)。
+        # 指令中可用 snapshot_mode 覆盖
+        'snapshot_mode': 0,
+        # 块设备作业(block pull、block commit)的超时时长，单位(秒)，0 表示不限。超时的作业被取消
+        'block_job_timeout': 21600,
+        # 增量备份使用的持久化脏位图名称
+        'backup_bitmap_name': 'jimv-backup',
+        # 本地存储迁移时，目标磁盘的预分配方式(off、metadata、falloc、full)，指令中可用 preallocation 覆盖
+        'migrate_preallocation': 'off',
+        # 远程命令的超时时长，单位(秒)
+        'ssh_command_timeout': 600
     }
 
     @classmethod
@@ -148,7 +246,6 @@ logger = Init.init_logger()
 
 r = Init.redis_init_conn()
 assert isinstance(r, redis.StrictRedis)
-q_creating_guest = Queue.Queue()
 
 host_cpu_count = multiprocessing.cpu_count()
 
@@ -161,6 +258,10 @@ guest_event_emit = GuestEventEmit()
 guest_event_emit.upstream_queue = config['upstream_queue']
 guest_event_emit.r = r
 
+guest_state_emit = GuestStateEmit()
+guest_state_emit.upstream_queue = config['upstream_queue']
+guest_state_emit.r = r
+
 host_event_emit = HostEventEmit()
 host_event_emit.upstream_queue = config['upstream_queue']
 host_event_emit.r = r
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import time
+import numbers
+import threading
+import contextlib
+import BaseHTTPServer
+import SocketServer
+
+from initialize import logger
+
+
+__author__ = 'James Iter'
+__date__ = '2026/10/19'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2026 by James Iter.'
+
+
+class Metrics(object):
+    """
+    计算节点进程内指标。
+    性能收集引擎把每轮采集结果交给 collect 保存，其它功能通过 set、inc 维护各自的指标，
+    由 exposition 生成 Prometheus 文本格式，供本地监控代理拉取。拉取时不会产生额外的 libvirt 调用。
+    """
+
+    lock = threading.Lock()
+    # 各性能收集引擎最近一次的采集结果，key 为 (scope, kind)
+    collections = dict()
+    # 由各功能自行维护的指标，key 为指标名称
+    families = dict()
+
+    label_keys = ['node_id', 'guest_uuid', 'disk_uuid', 'name', 'mountpoint']
+    # 采集记录中不作为指标输出的字段
+    skip_keys = ['timestamp']
+    # 直方图的默认分桶，单位(秒)
+    default_buckets = [0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+    @classmethod
+    def collect(cls, scope=None, kind=None, data=None):
+        """
+        :param scope: guest 或 host
+        :param kind: 与 GuestCollectionPerformanceDataKind、HostCollectionPerformanceDataKind 的名称一致
+        :param data: 一条或多条采集记录，每轮整体替换，以便已消失的对象不再出现在结果中
+        """
+        if isinstance(data, dict):
+            data = [data]
+
+        with cls.lock:
+            cls.collections[(scope, kind)] = data or list()
+
+    @classmethod
+    def set(cls, name=None, value=None, labels=None, _type='gauge', _help=None):
+        with cls.lock:
+            family = cls.families.setdefault(name, {'type': _type, 'help': _help or name, 'samples': dict()})
+            family['samples'][cls.labels_key(labels)] = value
+
+    @classmethod
+    def inc(cls, name=None, value=1, labels=None, _help=None):
+        with cls.lock:
+            family = cls.families.setdefault(name, {'type': 'counter', 'help': _help or name, 'samples': dict()})
+            key = cls.labels_key(labels)
+            family['samples'][key] = family['samples'].get(key, 0) + value
+
+    @classmethod
+    def observe(cls, name=None, value=None, labels=None, buckets=None, _help=None):
+        """
+        记录一次观测值至直方图
+        :param buckets: 各桶的上界，升序。仅在首次观测时生效
+        """
+        with cls.lock:
+            family = cls.families.setdefault(name, {'type': 'histogram', 'help': _help or name, 'samples': dict(),
+                                                    'buckets': buckets or cls.default_buckets})
+            key = cls.labels_key(labels)
+            sample = family['samples'].setdefault(key, {'counts': [0] * family['buckets'].__len__(),
+                                                        'sum': 0, 'count': 0})
+
+            for i, bound in enumerate(family['buckets']):
+                if value <= bound:
+                    sample['counts'][i] += 1
+
+            sample['sum'] += value
+            sample['count'] += 1
+
+    @classmethod
+    def get(cls, name=None, labels=None, default=0):
+        with cls.lock:
+            family = cls.families.get(name)
+            if family is None:
+                return default
+
+            return family['samples'].get(cls.labels_key(labels), default)
+
+    @staticmethod
+    def labels_key(labels=None):
+        if not labels:
+            return tuple()
+
+        return tuple(sorted(labels.items()))
+
+    @staticmethod
+    def format_labels(labels=None):
+        if not labels:
+            return ''
+
+        items = list()
+        for k, v in labels:
+            v = unicode(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            items.append(u''.join([k, u'="', v, u'"']))
+
+        return u'{' + u','.join(items) + u'}'
+
+    @classmethod
+    def exposition(cls):
+        families = dict()
+
+        with cls.lock:
+            for (scope, kind), data in cls.collections.items():
+                for record in data:
+                    labels = tuple(sorted([(k, record[k]) for k in cls.label_keys if k in record]))
+
+                    for k, v in record.items():
+                        if k in cls.label_keys or k in cls.skip_keys or not isinstance(v, numbers.Number):
+                            continue
+
+                        # 不同 kind 的采集记录可能有同名字段，故指标名称中带上 kind
+                        name = '_'.join(['jimvn', scope, kind, k])
+                        family = families.setdefault(name, {
+                            'type': 'gauge', 'help': ' '.join([scope, kind, k]), 'samples': dict()})
+                        family['samples'][labels] = ('', v)
+
+            for name, family in cls.families.items():
+                if family['type'] == 'histogram':
+                    # 展开为累积的 _bucket，及 _sum、_count
+                    samples = dict()
+
+                    for labels, sample in family['samples'].items():
+                        for bound, count in zip(family['buckets'], sample['counts']):
+                            samples[labels + (('le', repr(float(bound))),)] = ('_bucket', count)
+
+                        samples[labels + (('le', '+Inf'),)] = ('_bucket', sample['count'])
+                        samples[labels + (('~', 'sum'),)] = ('_sum', sample['sum'])
+                        samples[labels + (('~', 'count'),)] = ('_count', sample['count'])
+
+                    families[name] = {'type': family['type'], 'help': family['help'], 'samples': samples}
+                    continue
+
+                families[name] = {'type': family['type'], 'help': family['help'],
+                                  'samples': dict([(labels, ('', value))
+                                                   for labels, value in family['samples'].items()])}
+
+        lines = list()
+        for name in sorted(families.keys()):
+            family = families[name]
+            lines.append(u' '.join([u'# HELP', name, family['help']]))
+            lines.append(u' '.join([u'# TYPE', name, family['type']]))
+
+            for labels, (suffix, value) in sorted(family['samples'].items(), key=cls.sample_order):
+                labels = tuple([label for label in labels if label[0] != '~'])
+                lines.append(u''.join([name, suffix, cls.format_labels(labels), u' ', repr(float(value))]))
+
+        return u'\n'.join(lines) + u'\n'
+
+    @staticmethod
+    def sample_order(item):
+        labels, (suffix, value) = item
+        # 直方图的桶按上界的数值排序，并排在 _sum、_count 之前
+        order = [(k, float(v) if k == 'le' else v) for k, v in labels]
+        return [suffix != '_bucket'] + order
+
+    @classmethod
+    def make_server(cls, listen=None):
+        """
+        :param listen: 形如 127.0.0.1:9178 的 TCP 地址，或形如 unix:/run/jimv/metrics.sock 的 Unix socket 路径
+        """
+        if listen.startswith('unix:'):
+            path = listen[len('unix:'):]
+
+            if os.path.exists(path):
+                os.remove(path)
+
+            return UnixMetricsServer(path, MetricsRequestHandler)
+
+        host, port = listen.rsplit(':', 1)
+        return MetricsServer((host, int(port)), MetricsRequestHandler)
+
+
+class StageTimer(object):
+    """
+    分阶段计时。各阶段的耗时按执行顺序记录，并以阶段为标签计入直方图，便于汇总分析哪个阶段主导了总耗时。
+    """
+
+    def __init__(self, name=None, _help=None):
+        self.name = name
+        self.help = _help
+        self.begin = time.time()
+        self.stages = list()
+
+    @contextlib.contextmanager
+    def stage(self, stage=None):
+        begin = time.time()
+
+        try:
+            yield
+
+        except:
+            self.record(stage=stage, duration=time.time() - begin, failed=True)
+            raise
+
+        self.record(stage=stage, duration=time.time() - begin)
+
+    def record(self, stage=None, duration=None, failed=False):
+        item = {'stage': stage, 'duration': round(duration, 3)}
+
+        if failed:
+            item['failed'] = True
+
+        self.stages.append(item)
+        Metrics.observe(name=self.name, value=duration, labels={'stage': stage}, _help=self.help)
+
+    def report(self):
+        """
+        :return: 各阶段及总耗时，单位(秒)。应只调用一次
+        """
+        total = time.time() - self.begin
+        Metrics.observe(name=self.name, value=total, labels={'stage': 'total'}, _help=self.help)
+
+        return {'stages': self.stages, 'total': round(total, 3)}
+
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+
+        body = Metrics.exposition().encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(body.__len__()))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket 的 client_address 为空字符串
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+
+        return 'unix'
+
+    def log_message(self, _format, *args):
+        logger.debug(msg=' '.join([self.address_string(), _format % args]))
+
+
+class MetricsServer(BaseHTTPServer.HTTPServer):
+    allow_reuse_address = True
+
+
+class UnixMetricsServer(SocketServer.UnixStreamServer):
+    pass
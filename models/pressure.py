@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import collections
+import threading
+import time
+
+import psutil
+
+from initialize import config
+
+
+__author__ = 'James Iter'
+__date__ = '2026/10/19'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2026 by James Iter.'
+
+
+class Pressure(object):
+    """
+    宿主机压力状态采集。包含 CPU、内存、IO 的 PSI(Pressure Stall Information)，以及 iowait、steal。
+    采集结果保存在进程内，其它功能(如延迟创建、限速后台复制)可通过 Pressure.get、Pressure.is_under_pressure 读取。
+    """
+
+    resources = ['cpu', 'memory', 'io']
+    lock = threading.Lock()
+    samples = collections.deque()
+    state = dict()
+
+    @staticmethod
+    def read_psi(resource=None):
+        """
+        解析 /proc/pressure/<resource>，内核未开启 PSI 时返回 None。
+        文件格式如下：
+        some avg10=0.00 avg60=0.00 avg300=0.00 total=0
+        full avg10=0.00 avg60=0.00 avg300=0.00 total=0
+        """
+        psi = dict()
+
+        try:
+            with open('/proc/pressure/' + resource, 'r') as f:
+                for line in f.readlines():
+                    fields = line.split()
+                    if fields.__len__() < 2:
+                        continue
+
+                    psi[fields[0]] = dict()
+                    for field in fields[1:]:
+                        k, v = field.split('=')
+                        psi[fields[0]][k] = float(v)
+
+        except (IOError, OSError):
+            return None
+
+        return psi
+
+    @classmethod
+    def sample(cls):
+        """
+        采集一次压力数据，并基于窗口内首尾两个采样点计算窗口平均值
+        """
+        window = config['pressure_sample_window']
+        ts = time.time()
+
+        psi_s = dict()
+        for resource in cls.resources:
+            psi_s[resource] = cls.read_psi(resource=resource)
+
+        cpu_times = psutil.cpu_times()
+
+        with cls.lock:
+            cls.samples.append({'timestamp': ts, 'psi': psi_s, 'cpu_times': cpu_times})
+
+            while cls.samples.__len__() > 2 and ts - cls.samples[0]['timestamp'] > window:
+                cls.samples.popleft()
+
+            first = cls.samples[0]
+            interval = ts - first['timestamp']
+
+            state = {
+                'window': window,
+                'timestamp': int(ts),
+                'psi_supported': psi_s['io'] is not None
+            }
+
+            for resource in cls.resources:
+                psi = psi_s[resource]
+                for kind in ['some', 'full']:
+                    prefix = '_'.join([resource, kind])
+
+                    if psi is None or kind not in psi:
+                        continue
+
+                    state[prefix + '_avg10'] = psi[kind]['avg10']
+                    state[prefix + '_avg60'] = psi[kind]['avg60']
+                    state[prefix + '_avg300'] = psi[kind]['avg300']
+                    state[prefix + '_window'] = 0.0
+
+                    # total 单位为微秒，窗口内的停顿时长占比即为窗口平均值
+                    first_psi = first['psi'][resource]
+                    if interval > 0 and first_psi is not None and kind in first_psi:
+                        state[prefix + '_window'] = round(
+                            (psi[kind]['total'] - first_psi[kind]['total']) / (interval * 10 ** 6) * 100, 2)
+
+            state['iowait'] = 0.0
+            state['steal'] = 0.0
+
+            cpu_total = sum(cpu_times) - sum(first['cpu_times'])
+            if cpu_total > 0:
+                state['iowait'] = round(
+                    (getattr(cpu_times, 'iowait', 0) - getattr(first['cpu_times'], 'iowait', 0)) / cpu_total * 100, 2)
+                state['steal'] = round(
+                    (getattr(cpu_times, 'steal', 0) - getattr(first['cpu_times'], 'steal', 0)) / cpu_total * 100, 2)
+
+            cls.state = state
+
+        return state
+
+    @classmethod
+    def get(cls):
+        with cls.lock:
+            return dict(cls.state)
+
+    @classmethod
+    def is_under_pressure(cls, resource='io', threshold=None):
+        """
+        判断宿主机某项资源是否处于压力之下。
+        优先使用窗口内 some 停顿占比，内核不支持 PSI 时，io 以 iowait 代替，cpu 以 steal 代替。
+        :param resource: cpu、memory、io
+        :param threshold: 百分比阈值，默认取配置项 pressure_threshold
+        """
+        if threshold is None:
+            threshold = config['pressure_threshold'][resource]
+
+        state = cls.get()
+
+        value = state.get('_'.join([resource, 'some', 'window']))
+
+        if value is None:
+            value = {'io': state.get('iowait'), 'cpu': state.get('steal')}.get(resource)
+
+        if value is None:
+            return False
+
+        return value >= threshold
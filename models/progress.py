@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import threading
+import time
+
+from initialize import config, log_emit
+from metrics import Metrics
+
+
+__author__ = 'James Iter'
+__date__ = '2026/10/19'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2026 by James Iter.'
+
+
+class ProgressTracker(object):
+    """
+    进度跟踪器。由复制引擎等直接推送已完成及总字节数，按时间间隔及百分比变化节流后发射进度，
+    并明确地处理完成、失败及停滞，无需轮询文件系统。
+    """
+
+    lock = threading.Lock()
+    # key -> {'emit', 'done', 'total', 'percent', 'emitted_percent', 'emitted_ts', 'updated_ts', 'stalled'}
+    jobs = dict()
+
+    @classmethod
+    def start(cls, key=None, emit=None):
+        """
+        :param key: 作业标识，如 Guest 的 uuid
+        :param emit: 发射函数 emit(percent)，percent 取值 0 ~ 100
+        """
+        now = time.time()
+
+        with cls.lock:
+            cls.jobs[key] = {'emit': emit, 'done': 0, 'total': 0, 'percent': 0, 'emitted_percent': -1,
+                             'emitted_ts': 0, 'updated_ts': now, 'stalled': False}
+
+            Metrics.set(name='jimvn_progress_jobs', value=cls.jobs.__len__(), _help='jobs tracked for progress')
+
+    @classmethod
+    def update(cls, key=None, done=None, total=None):
+        now = time.time()
+
+        with cls.lock:
+            job = cls.jobs.get(key)
+
+            if job is None:
+                return
+
+            job['done'] = done
+            job['total'] = total
+            job['updated_ts'] = now
+            job['stalled'] = False
+
+            if total > 0:
+                # 进度只增不减
+                job['percent'] = max(job['percent'], int(done * 100 / total))
+
+            if not cls.should_emit(job=job, now=now):
+                return
+
+            job['emitted_percent'] = job['percent']
+            job['emitted_ts'] = now
+            percent = job['percent']
+
+        job['emit'](percent)
+
+    @staticmethod
+    def should_emit(job=None, now=None):
+        if job['percent'] <= job['emitted_percent']:
+            return False
+
+        if now - job['emitted_ts'] < config['progress_emit_interval']:
+            return False
+
+        return job['percent'] - job['emitted_percent'] >= config['progress_emit_step'] or job['percent'] == 100
+
+    @classmethod
+    def callback(cls, key=None):
+        """
+        :return: 供复制引擎使用的进度回调 progress(done, total)
+        """
+        return lambda done, total: cls.update(key=key, done=done, total=total)
+
+    @classmethod
+    def finish(cls, key=None):
+        with cls.lock:
+            job = cls.jobs.pop(key, None)
+            Metrics.set(name='jimvn_progress_jobs', value=cls.jobs.__len__(), _help='jobs tracked for progress')
+
+        if job is not None and job['emitted_percent'] < 100:
+            job['emit'](100)
+
+    @classmethod
+    def fail(cls, key=None, reason=None):
+        with cls.lock:
+            job = cls.jobs.pop(key, None)
+            Metrics.set(name='jimvn_progress_jobs', value=cls.jobs.__len__(), _help='jobs tracked for progress')
+
+        if job is not None:
+            log_emit.warn(u' '.join([u'作业', key, u'在进度', str(job['percent']), u'% 时失败：', unicode(reason)]))
+
+    @classmethod
+    def flush(cls):
+        """
+        补发因节流而未发射的最新进度，并检测停滞的作业
+        """
+        now = time.time()
+        pending = list()
+        stalled = list()
+
+        with cls.lock:
+            for key, job in cls.jobs.items():
+                if cls.should_emit(job=job, now=now):
+                    job['emitted_percent'] = job['percent']
+                    job['emitted_ts'] = now
+                    pending.append((job['emit'], job['percent']))
+
+                if not job['stalled'] and now - job['updated_ts'] > config['progress_stall_timeout']:
+                    job['stalled'] = True
+                    stalled.append((key, job['percent']))
+
+        for emit, percent in pending:
+            emit(percent)
+
+        for key, percent in stalled:
+            Metrics.inc(name='jimvn_progress_stalled_total', _help='jobs detected as stalled')
+            log_emit.warn(u' '.join([u'作业', key, u'在进度', str(percent), u'% 处已停滞超过',
+                                     str(config['progress_stall_timeout']), u'秒。']))
+
+        return stalled
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import re
+import time
+import Queue
+import fcntl
+import select
+import threading
+import traceback
+import subprocess
+
+from initialize import logger
+from metrics import Metrics
+
+
+__author__ = 'James Iter'
+__date__ = '2026/10/19'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2026 by James Iter.'
+
+
+class QemuImg(object):
+    """
+    qemu-img 作业运行器。由单个监视线程以 select 等待所有作业的输出管道，解析 -p 输出的进度，并在超时后终止作业。
+    调用者只在 run 中等待自身作业结束，无需轮询或发送信号。
+    进度回调由独立的分发线程依次执行，不阻塞监视线程。同一作业积压的多个进度，只回调最新的。
+    """
+
+    binary = '/usr/bin/qemu-img'
+    pattern_progress = re.compile(r'\((\d+(?:\.\d+)?)/100%\)')
+
+    lock = threading.Lock()
+    # 管道的文件描述符 -> {'args', 'proc', 'progress', 'percent', 'deadline', 'buffer', 'output', 'event', 'timed_out'}
+    jobs = dict()
+    monitor = None
+    # 进度回调的分发线程及其队列，队列元素为 ('progress' 或 'finish', job)
+    dispatcher = None
+    notifications = Queue.Queue()
+    # 用于在新作业加入时唤醒监视线程
+    wake_r = None
+    wake_w = None
+
+    @classmethod
+    def ensure_monitor(cls):
+        # 调用者需持有 cls.lock
+        if cls.monitor is not None:
+            return
+
+        cls.wake_r, cls.wake_w = os.pipe()
+
+        for fd in [cls.wake_r, cls.wake_w]:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        cls.monitor = threading.Thread(target=cls.loop, name='qemu_img_monitor')
+        cls.monitor.setDaemon(True)
+        cls.monitor.start()
+
+        cls.dispatcher = threading.Thread(target=cls.dispatch, name='qemu_img_progress')
+        cls.dispatcher.setDaemon(True)
+        cls.dispatcher.start()
+
+    @classmethod
+    def submit(cls, args=None, progress=None, timeout=None):
+        """
+        :param args: qemu-img 的参数列表，不含可执行文件本身
+        :param progress: 进度回调 progress(done, total)，total 恒为 100。需在 args 中带 -p
+        :param timeout: 单位(秒)。None 或 0 表示不限
+        """
+        proc = subprocess.Popen([cls.binary] + args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
+
+        job = {
+            'args': args,
+            'proc': proc,
+            'progress': progress,
+            # 已记录、尚未回调的最新进度
+            'percent': None,
+            'deadline': time.time() + timeout if timeout else None,
+            'buffer': '',
+            'output': list(),
+            'event': threading.Event(),
+            'timed_out': False
+        }
+
+        with cls.lock:
+            cls.ensure_monitor()
+            cls.jobs[proc.stdout.fileno()] = job
+            Metrics.set(name='jimvn_qemu_img_jobs', value=cls.jobs.__len__(), _help='qemu-img jobs running')
+
+        os.write(cls.wake_w, 'x')
+        return job
+
+    @classmethod
+    def run(cls, args=None, progress=None, timeout=None):
+        """
+        :return: (exit_status, output)，与 Utils.shell_cmd 一致
+        """
+        job = cls.submit(args=args, progress=progress, timeout=timeout)
+        job['event'].wait()
+
+        output = '\n'.join(job['output'])
+
+        if job['timed_out']:
+            output = '\n'.join([output, 'qemu-img ' + args[0] + ' timed out after ' + str(timeout) + 's'])
+
+        return job['proc'].returncode, output
+
+    @classmethod
+    def loop(cls):
+        while True:
+            try:
+                with cls.lock:
+                    fds = cls.jobs.keys()
+                    deadlines = [job['deadline'] for job in cls.jobs.values() if job['deadline'] is not None]
+
+                timeout = None
+
+                if deadlines:
+                    timeout = max(min(deadlines) - time.time(), 0)
+
+                readable = select.select(fds + [cls.wake_r], [], [], timeout)[0]
+
+                for fd in readable:
+                    if fd == cls.wake_r:
+                        try:
+                            os.read(cls.wake_r, 4096)
+
+                        except OSError:
+                            pass
+
+                        continue
+
+                    cls.read(fd=fd)
+
+                cls.expire()
+
+            except:
+                logger.error(traceback.format_exc())
+                time.sleep(1)
+
+    @classmethod
+    def dispatch(cls):
+        while True:
+            kind, job = cls.notifications.get()
+
+            try:
+                if kind == 'progress':
+                    with cls.lock:
+                        percent, job['percent'] = job['percent'], None
+
+                    if percent is not None:
+                        job['progress'](percent, 100)
+
+                # 队列先进先出，作业此前的进度均已回调
+                elif kind == 'finish':
+                    if job['proc'].returncode == 0:
+                        job['progress'](100, 100)
+
+            except:
+                logger.error(traceback.format_exc())
+
+            finally:
+                if kind == 'finish':
+                    job['event'].set()
+
+    @classmethod
+    def read(cls, fd=None):
+        with cls.lock:
+            job = cls.jobs.get(fd)
+
+        # 同一轮 select 中已结束的作业
+        if job is None:
+            return
+
+        data = os.read(fd, 65536)
+
+        if data.__len__() == 0:
+            cls.finish(fd=fd, job=job)
+            return
+
+        # -p 的进度以 \r 分隔
+        lines = re.split(r'[\r\n]', job['buffer'] + data)
+        job['buffer'] = lines.pop()
+        percent = None
+
+        for line in lines:
+            p = cls.pattern_progress.search(line)
+
+            if p is not None:
+                percent = float(p.group(1))
+
+            elif line.strip():
+                job['output'].append(line.strip())
+
+        # 监视线程只记录最新的进度，由分发线程回调
+        if percent is not None and job['progress'] is not None:
+            with cls.lock:
+                queued = job['percent'] is not None
+                job['percent'] = percent
+
+            if not queued:
+                cls.notifications.put(('progress', job))
+
+    @classmethod
+    def finish(cls, fd=None, job=None):
+        if job['buffer'].strip() and cls.pattern_progress.search(job['buffer']) is None:
+            job['output'].append(job['buffer'].strip())
+
+        # 关闭管道后，其文件描述符可能立即被新提交的作业复用，故须先在锁内移除
+        with cls.lock:
+            del cls.jobs[fd]
+            Metrics.set(name='jimvn_qemu_img_jobs', value=cls.jobs.__len__(), _help='qemu-img jobs running')
+
+        job['proc'].stdout.close()
+        job['proc'].wait()
+
+        Metrics.inc(name='jimvn_qemu_img_jobs_total', labels={'command': job['args'][0]},
+                    _help='qemu-img jobs finished')
+
+        if job['progress'] is None:
+            job['event'].set()
+
+        else:
+            cls.notifications.put(('finish', job))
+
+    @classmethod
+    def expire(cls):
+        now = time.time()
+
+        with cls.lock:
+            expired = [job for job in cls.jobs.values() if job['deadline'] is not None and job['deadline'] <= now]
+
+        for job in expired:
+            job['timed_out'] = True
+            job['deadline'] = None
+            logger.warn(u' '.join([u'qemu-img 作业超时，终止：', ' '.join(job['args'])]))
+            Metrics.inc(name='jimvn_qemu_img_timeouts_total', labels={'command': job['args'][0]},
+                        _help='qemu-img jobs killed after timing out')
+
+            try:
+                job['proc'].kill()
+
+            except OSError:
+                pass
@@ -30,6 +30,7 @@ class EmitKind(IntEnum):
     response = 3
     guest_collection_performance = 4
     host_collection_performance = 5
+    guest_state = 6
 
 
 class GuestState(IntEnum):
@@ -49,9 +50,16 @@ class GuestState(IntEnum):
     update = 10
     creating = 11
     snapshot_converting = 12
+    snapshot_deleting = 13
+    backing_up = 14
     dirty = 255
 
 
+class GuestStateReportKind(IntEnum):
+    batch = 0
+    snapshot = 1
+
+
 class HostEvent(IntEnum):
     heartbeat = 0
 
@@ -75,6 +83,16 @@ class OSTemplateInitializeOperateKind(IntEnum):
     append_file = 2
 
 
+class GuestInitializeMode(IntEnum):
+    guestfs = 0
+    cloud_init = 1
+
+
+class SnapshotMode(IntEnum):
+    internal = 0
+    external = 1
+
+
 class GuestCollectionPerformanceDataKind(IntEnum):
     cpu_memory = 0
     traffic = 1
@@ -85,4 +103,6 @@ class HostCollectionPerformanceDataKind(IntEnum):
     cpu_memory = 0
     traffic = 1
     disk_usage_io = 2
+    pressure = 3
+    image_allocation = 4
 
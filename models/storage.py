@@ -4,14 +4,20 @@
 
 import json
 import os
-import shutil
-import threading
-
-from gluster import gfapi
-
-from utils import Utils
+import stat
+import errno
+import base64
+
+from initialize import config
+from template_cache import TemplateCache
+from copy_engine import CopyEngine, LocalFile
+from qcow2 import Qcow2
+from qemu_img import QemuImg
+from storage_scheduler import StorageScheduler
+from gluster_pool import GlusterFSPool
+from trash import Trash
 from models.status import StorageMode
-from jimvn_exception import CommandExecFailed
+from jimvn_exception import CommandExecFailed, AlreadyUsed
 
 
 __author__ = 'James Iter'
@@ -21,80 +27,210 @@ __copyright__ = '(c) 2017 by James Iter.'
 
 
 class Storage(object):
-    storage_mode = None
-    gf = None
-    dfs_volume = None
-    thread_mutex_lock = threading.Lock()
-
     def __init__(self, **kwargs):
+        self.storage_mode = None
+        self.dfs_volume = None
         self.set_storage_mode(storage_mode=kwargs.get('storage_mode', None))
         self.set_dfs_volume(dfs_volume=kwargs.get('dfs_volume', None))
 
-        if self.storage_mode == StorageMode.glusterfs.value:
-            self.init_gfapi()
+    def set_storage_mode(self, storage_mode):
+        self.storage_mode = storage_mode
 
-    @classmethod
-    def set_storage_mode(cls, storage_mode):
-        cls.storage_mode = storage_mode
+    def set_dfs_volume(self, dfs_volume):
+        self.dfs_volume = dfs_volume
 
-    @classmethod
-    def set_dfs_volume(cls, dfs_volume):
-        cls.dfs_volume = dfs_volume
+    def volume(self):
+        """
+        从连接池中取用当前卷的 gfapi 句柄
+        with self.volume() as gf:
+            ...
+        """
+        return GlusterFSPool.handle(volume=self.dfs_volume)
 
-    @classmethod
-    def init_gfapi(cls):
-        cls.thread_mutex_lock.acquire()
+    def make_image_by_glusterfs(self, path=None, size=None):
 
-        if cls.gf is None:
-            cls.gf = gfapi.Volume('127.0.0.1', cls.dfs_volume)
-            cls.gf.mount()
+        self.makedirs_by_glusterfs(path=os.path.dirname(path))
 
-        cls.thread_mutex_lock.release()
+        # qemu-img 经 gluster:// 自行连接卷，执行期间不占用连接池中的句柄
+        path = '/'.join(['gluster://127.0.0.1', self.dfs_volume, path])
 
-        return cls.gf
+        exit_status, output = QemuImg.run(args=['create', '-f', 'qcow2', path, size.__str__() + 'G'],
+                                          timeout=config['qemu_img_timeout'])
 
-    @classmethod
-    def make_image_by_glusterfs(cls, path=None, size=None):
+        if exit_status != 0:
+            err = u' '.join([u'路径', path, u'创建磁盘时，命令执行退出异常：', str(output)])
+            raise CommandExecFailed(err)
 
-        if not cls.gf.isdir(os.path.dirname(path)):
-            cls.gf.makedirs(os.path.dirname(path), 0755)
+    @staticmethod
+    def make_image_by_local(path=None, size=None):
 
-        path = '/'.join(['gluster://127.0.0.1', cls.dfs_volume, path])
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), 0755)
 
-        cmd = ' '.join(['/usr/bin/qemu-img', 'create', '-f', 'qcow2', path, size.__str__() + 'G'])
-        exit_status, output = Utils.shell_cmd(cmd)
+        exit_status, output = QemuImg.run(args=['create', '-f', 'qcow2', path, size.__str__() + 'G'],
+                                          timeout=config['qemu_img_timeout'])
 
         if exit_status != 0:
             err = u' '.join([u'路径', path, u'创建磁盘时，命令执行退出异常：', str(output)])
             raise CommandExecFailed(err)
 
+    def make_image(self, path=None, size=None):
+        with StorageScheduler.job(storage=self, kind=StorageScheduler.metadata, name='make_image'):
+            if self.storage_mode == StorageMode.glusterfs.value:
+                self.make_image_by_glusterfs(path=path, size=size)
+
+            elif self.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+                self.make_image_by_local(path=path, size=size)
+
+    def make_linked_clone_by_glusterfs(self, backing=None, path=None):
+
+        self.makedirs_by_glusterfs(path=os.path.dirname(path))
+
+        # qemu-img 经 gluster:// 自行连接卷，执行期间不占用连接池中的句柄
+        backing = '/'.join(['gluster://127.0.0.1', self.dfs_volume, backing])
+        path = '/'.join(['gluster://127.0.0.1', self.dfs_volume, path])
+
+        exit_status, output = QemuImg.run(args=['create', '-f', 'qcow2', '-F', 'qcow2', '-b', backing, path],
+                                          timeout=config['qemu_img_timeout'])
+
+        if exit_status != 0:
+            err = u' '.join([u'路径', path, u'创建链接克隆时，命令执行退出异常：', str(output)])
+            raise CommandExecFailed(err)
+
     @staticmethod
-    def make_image_by_local(path=None, size=None):
+    def make_linked_clone_by_local(backing=None, path=None):
 
         if not os.path.isdir(os.path.dirname(path)):
             os.makedirs(os.path.dirname(path), 0755)
 
-        cmd = ' '.join(['/usr/bin/qemu-img', 'create', '-f', 'qcow2', path, size.__str__() + 'G'])
-        exit_status, output = Utils.shell_cmd(cmd)
+        exit_status, output = QemuImg.run(args=['create', '-f', 'qcow2', '-F', 'qcow2', '-b', backing, path],
+                                          timeout=config['qemu_img_timeout'])
 
         if exit_status != 0:
-            err = u' '.join([u'路径', path, u'创建磁盘时，命令执行退出异常：', str(output)])
+            err = u' '.join([u'路径', path, u'创建链接克隆时，命令执行退出异常：', str(output)])
             raise CommandExecFailed(err)
 
-    @classmethod
-    def make_image(cls, path=None, size=None):
-        if cls.storage_mode == StorageMode.glusterfs.value:
-            cls.make_image_by_glusterfs(path=path, size=size)
+    def make_linked_clone(self, backing=None, path=None):
+        """
+        以 backing 为只读的后端镜像，创建 qcow2 链接克隆。耗时与模板大小无关。
+        backing 被置为只读，并在其旁的 .clones 目录中记录该克隆，删除 backing 前据此判断是否仍被引用
+        """
+        with StorageScheduler.job(storage=self, kind=StorageScheduler.metadata, name='make_linked_clone'):
+            if self.storage_mode == StorageMode.glusterfs.value:
+                self.make_linked_clone_by_glusterfs(backing=backing, path=path)
+
+            elif self.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+                self.make_linked_clone_by_local(backing=backing, path=path)
 
-        elif cls.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
-            cls.make_image_by_local(path=path, size=size)
+            self.chmod(path=backing, mode=0444)
+            self.makedirs(path=self.clones_dir(backing=backing))
+            self.touch(path=os.path.join(self.clones_dir(backing=backing), base64.urlsafe_b64encode(path)))
 
-    @classmethod
-    def resize_image_by_glusterfs(cls, path=None, size=None):
-        path = '/'.join(['gluster://127.0.0.1', cls.dfs_volume, path])
+    @staticmethod
+    def clones_dir(backing=None):
+        return backing + '.clones'
+
+    def backing_filename(self, path=None):
+        # 与创建链接克隆时传给 qemu-img 的后端镜像路径一致
+        if self.storage_mode == StorageMode.glusterfs.value:
+            return '/'.join(['gluster://127.0.0.1', self.dfs_volume, path])
 
-        cmd = ' '.join(['/usr/bin/qemu-img', 'resize', '-f', 'qcow2', path, size.__str__() + 'G'])
-        exit_status, output = Utils.shell_cmd(cmd)
+        return path
+
+    def backing_chain(self, path=None):
+        """
+        :return: 镜像及其各级后端镜像的路径 [path, 后端镜像, ...]，路径不包含 dfs 卷标。位于其它卷中的后端镜像不在其列
+        """
+        chain = list()
+
+        while path is not None and path not in chain:
+            chain.append(path)
+
+            try:
+                backing = self.image_info(path=path).get('backing-filename')
+
+            except (ValueError, CommandExecFailed):
+                # 非 qcow2 镜像，没有后端镜像
+                break
+
+            if not backing:
+                break
+
+            if backing.startswith('gluster://'):
+                # gluster://主机/卷/路径
+                _, _, _, dfs_volume, backing = backing.split('/', 4)
+
+                if dfs_volume != self.dfs_volume:
+                    break
+
+            elif not backing.startswith('/'):
+                backing = os.path.join(os.path.dirname(path), backing)
+
+            path = backing
+
+        return chain
+
+    def linked_clones(self, backing=None):
+        """
+        :return: 仍以 backing 为后端镜像的链接克隆路径。已删除或已转为完整镜像的克隆，其记录在此被清除
+        """
+        clones = list()
+        clones_dir = self.clones_dir(backing=backing)
+
+        for name in self.listdir(path=clones_dir):
+            try:
+                path = base64.urlsafe_b64decode(name)
+
+            except TypeError:
+                continue
+
+            try:
+                if self.image_info(path=path).get('backing-filename') == self.backing_filename(path=backing):
+                    clones.append(path)
+                    continue
+
+            except (OSError, IOError, ValueError, CommandExecFailed):
+                pass
+
+            self.unlink(path=os.path.join(clones_dir, name))
+
+        return clones
+
+    def flatten_image_by_glusterfs(self, path=None):
+        path = '/'.join(['gluster://127.0.0.1', self.dfs_volume, path])
+
+        exit_status, output = QemuImg.run(args=['rebase', '-f', 'qcow2', '-b', '', path],
+                                          timeout=config['qemu_img_bulk_timeout'])
+
+        if exit_status != 0:
+            err = u' '.join([u'路径', path, u'合并后端镜像时，命令执行退出异常：', str(output)])
+            raise CommandExecFailed(err)
+
+    @staticmethod
+    def flatten_image_by_local(path=None):
+        exit_status, output = QemuImg.run(args=['rebase', '-f', 'qcow2', '-b', '', path],
+                                          timeout=config['qemu_img_bulk_timeout'])
+
+        if exit_status != 0:
+            err = u' '.join([u'路径', path, u'合并后端镜像时，命令执行退出异常：', str(output)])
+            raise CommandExecFailed(err)
+
+    def flatten_image(self, path=None):
+        """
+        将链接克隆的后端镜像数据合并进来，使其成为不依赖模板的完整镜像。仅适用于未运行的 Guest
+        """
+        with StorageScheduler.job(storage=self, kind=StorageScheduler.bulk, name='flatten_image'):
+            if self.storage_mode == StorageMode.glusterfs.value:
+                self.flatten_image_by_glusterfs(path=path)
+
+            elif self.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+                self.flatten_image_by_local(path=path)
+
+    def resize_image_by_glusterfs(self, path=None, size=None):
+        path = '/'.join(['gluster://127.0.0.1', self.dfs_volume, path])
+
+        exit_status, output = QemuImg.run(args=['resize', '-f', 'qcow2', path, size.__str__() + 'G'],
+                                          timeout=config['qemu_img_timeout'])
 
         if exit_status != 0:
             err = u' '.join([u'路径', path, u'磁盘扩容时，命令执行退出异常：', str(output)])
@@ -102,30 +238,31 @@ class Storage(object):
 
     @staticmethod
     def resize_image_by_local(path=None, size=None):
-        cmd = ' '.join(['/usr/bin/qemu-img', 'resize', '-f', 'qcow2', path, size.__str__() + 'G'])
-        exit_status, output = Utils.shell_cmd(cmd)
+        exit_status, output = QemuImg.run(args=['resize', '-f', 'qcow2', path, size.__str__() + 'G'],
+                                          timeout=config['qemu_img_timeout'])
 
         if exit_status != 0:
             err = u' '.join([u'路径', path, u'磁盘扩容时，命令执行退出异常：', str(output)])
             raise CommandExecFailed(err)
 
-    @classmethod
-    def resize_image(cls, path=None, size=None):
-        if cls.storage_mode == StorageMode.glusterfs.value:
-            cls.resize_image_by_glusterfs(path=path, size=size)
+    def resize_image(self, path=None, size=None):
+        with StorageScheduler.job(storage=self, kind=StorageScheduler.metadata, name='resize_image'):
+            if self.storage_mode == StorageMode.glusterfs.value:
+                self.resize_image_by_glusterfs(path=path, size=size)
 
-        elif cls.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
-            cls.resize_image_by_local(path=path, size=size)
+            elif self.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+                self.resize_image_by_local(path=path, size=size)
 
-    @classmethod
-    def copy_file_by_glusterfs(cls, src=None, dst=None):
-        if not cls.gf.isdir(os.path.dirname(dst)):
-            cls.gf.makedirs(os.path.dirname(dst), 0755)
+    def copy_file_by_glusterfs(self, src=None, dst=None, progress=None, meter=None):
+        with self.volume() as gf:
+            if not gf.isdir(os.path.dirname(dst)):
+                gf.makedirs(os.path.dirname(dst), 0755)
 
-        cls.gf.copyfile(src=src, dst=dst)
+            CopyEngine.copy_by_volume(volume=gf, src=src, dst=dst, workers=config['glusterfs_copy_workers'],
+                                      progress=progress, meter=meter)
 
     @staticmethod
-    def copy_file_by_local_path(src=None, dst=None):
+    def copy_file_by_local_path(src=None, dst=None, progress=None, meter=None):
         system_image_path_dir = os.path.dirname(dst)
 
         if not os.path.exists(system_image_path_dir):
@@ -135,76 +272,539 @@ class Storage(object):
             os.rename(system_image_path_dir, system_image_path_dir + '.bak')
             os.makedirs(system_image_path_dir, 0755)
 
-        shutil.copyfile(src=src, dst=dst)
+        CopyEngine.copy(src=src, dst=dst, progress=progress, meter=meter)
+
+    def copy_file_to_local_by_glusterfs(self, src=None, dst=None, progress=None, meter=None):
+        with self.volume() as gf:
+            total = gf.stat(src).st_size
+            done = 0
+
+            with gf.fopen(src, 'rb') as f_src:
+                with open(dst, 'wb') as f_dst:
+                    for data in iter(lambda: f_src.read(TemplateCache.chunk_size), ''):
+                        f_dst.write(data)
+                        done += data.__len__()
+
+                        if meter is not None:
+                            meter(read=data.__len__(), written=data.__len__())
+
+                        if progress is not None:
+                            progress(done, total)
+
+    def copy_file_to_local(self, src=None, dst=None, progress=None, meter=None):
+        """
+        把存储中的文件复制到计算节点本地路径
+        """
+        if self.storage_mode == StorageMode.glusterfs.value:
+            self.copy_file_to_local_by_glusterfs(src=src, dst=dst, progress=progress, meter=meter)
+
+        elif self.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            self.copy_file_by_local_path(src=src, dst=dst, progress=progress)
+
+    def copy_file_from_local_by_glusterfs(self, src=None, dst=None, progress=None, meter=None):
+        with self.volume() as gf:
+            if not gf.isdir(os.path.dirname(dst)):
+                gf.makedirs(os.path.dirname(dst), 0755)
+
+            total = os.path.getsize(src)
+            done = 0
+
+            with open(src, 'rb') as f_src:
+                with gf.fopen(dst, 'wb') as f_dst:
+                    for data in iter(lambda: f_src.read(TemplateCache.chunk_size), ''):
+                        f_dst.write(data)
+                        done += data.__len__()
+
+                        if meter is not None:
+                            meter(read=data.__len__(), written=data.__len__())
+
+                        if progress is not None:
+                            progress(done, total)
+
+    def copy_file_from_local(self, src=None, dst=None, progress=None, meter=None):
+        """
+        把计算节点本地路径的文件复制到存储中
+        """
+        if self.storage_mode == StorageMode.glusterfs.value:
+            self.copy_file_from_local_by_glusterfs(src=src, dst=dst, progress=progress, meter=meter)
+
+        elif self.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            self.copy_file_by_local_path(src=src, dst=dst, progress=progress)
+
+    def copy_file(self, src=None, dst=None, progress=None):
+        """
+        :param progress: 进度回调 progress(done, total)，单位(字节)
+        """
+        with StorageScheduler.job(storage=self, kind=StorageScheduler.bulk, name='copy_file'):
+            # 共享存储中的模板，优先从计算节点本地的模板缓存复制
+            if TemplateCache.enabled() and \
+                    self.storage_mode in [StorageMode.shared_mount.value, StorageMode.glusterfs.value]:
+
+                # 未命中缓存时，拉取模板至缓存与从缓存复制各占一半进度
+                filled = {'total': 0}
+
+                def fill_progress(done, total):
+                    filled['total'] = total
+
+                    if progress is not None:
+                        progress(done, total * 2)
 
-    @classmethod
-    def copy_file(cls, src=None, dst=None):
-        if cls.storage_mode in [StorageMode.ceph.value, StorageMode.glusterfs.value]:
-            if cls.storage_mode == StorageMode.glusterfs.value:
-                cls.copy_file_by_glusterfs(src=src, dst=dst)
+                def copy_progress(done, total):
+                    if progress is None:
+                        return
 
-        elif cls.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
-            cls.copy_file_by_local_path(src=src, dst=dst)
+                    if filled['total'] > 0:
+                        progress(total + done, total * 2)
 
-    @classmethod
-    def delete_image_by_glusterfs(cls, path=None):
-        cls.gf.remove(path)
+                    else:
+                        progress(done, total)
+
+                # 复制期间保持对缓存条目的引用，使其不被其它拉取淘汰。
+                # 拉取时只读取存储，从缓存复制时只写入存储，仅经过存储的字节计入后端的带宽
+                with TemplateCache.use(storage=self, path=src, progress=fill_progress,
+                                       meter=StorageScheduler.meter(storage=self, charge_written=False)) as cached_path:
+                    if cached_path is not None:
+                        self.copy_file_from_local(src=cached_path, dst=dst, progress=copy_progress,
+                                                  meter=StorageScheduler.meter(storage=self, charge_read=False))
+                        return
+
+            meter = StorageScheduler.meter(storage=self)
+
+            if self.storage_mode in [StorageMode.ceph.value, StorageMode.glusterfs.value]:
+                if self.storage_mode == StorageMode.glusterfs.value:
+                    self.copy_file_by_glusterfs(src=src, dst=dst, progress=progress, meter=meter)
+
+            elif self.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+                self.copy_file_by_local_path(src=src, dst=dst, progress=progress, meter=meter)
+
+    def fan_out_copy_by_glusterfs(self, src=None, dsts=None, progresses=None, meter=None):
+        with self.volume() as gf:
+            for dst in dsts:
+                if not gf.isdir(os.path.dirname(dst)):
+                    gf.makedirs(os.path.dirname(dst), 0755)
+
+            size = gf.stat(src).st_size
+            f_dsts = list()
+
+            try:
+                for dst in dsts:
+                    f_dsts.append(gf.fopen(dst, 'wb'))
+
+                with gf.fopen(src, 'rb') as f_src:
+                    return CopyEngine.fan_out(f_src=f_src, f_dsts=f_dsts, size=size, progresses=progresses,
+                                              meter=meter)
+
+            finally:
+                for f_dst in f_dsts:
+                    f_dst.close()
+
+    @staticmethod
+    def fan_out_copy_by_local_path(src=None, dsts=None, progresses=None, meter=None):
+        for dst in dsts:
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst), 0755)
+
+        size = os.path.getsize(src)
+        f_dsts = list()
+
+        try:
+            for dst in dsts:
+                f_dsts.append(LocalFile(path=dst, flags=os.O_WRONLY | os.O_CREAT | os.O_TRUNC))
+
+            with LocalFile(path=src) as f_src:
+                return CopyEngine.fan_out(f_src=f_src, f_dsts=f_dsts, size=size, progresses=progresses, meter=meter)
+
+        finally:
+            for f_dst in f_dsts:
+                f_dst.close()
+
+    def fan_out_copy(self, src=None, dsts=None, progresses=None):
+        """
+        读取一次 src，复制到多个 dsts
+        :return: 与 dsts 一一对应的异常列表，成功的目标为 None
+        """
+        meter = StorageScheduler.meter(storage=self)
+
+        with StorageScheduler.job(storage=self, kind=StorageScheduler.bulk, name='fan_out_copy'):
+            if self.storage_mode == StorageMode.glusterfs.value:
+                return self.fan_out_copy_by_glusterfs(src=src, dsts=dsts, progresses=progresses, meter=meter)
+
+            elif self.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+                return self.fan_out_copy_by_local_path(src=src, dsts=dsts, progresses=progresses, meter=meter)
+
+    def delete_image_by_glusterfs(self, path=None):
+        with self.volume() as gf:
+            gf.remove(path)
 
     @staticmethod
     def delete_image_by_local(path=None):
         os.remove(path)
 
-    @classmethod
-    def delete_image(cls, path=None):
-        if cls.storage_mode == StorageMode.glusterfs.value:
-            cls.delete_image_by_glusterfs(path=path)
+    def unlink(self, path=None):
+        if self.storage_mode == StorageMode.glusterfs.value:
+            self.delete_image_by_glusterfs(path=path)
+
+        elif self.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            self.delete_image_by_local(path=path)
+
+    def delete_image(self, path=None):
+        """
+        镜像先被原子地移入回收站，由回收引擎限速释放空间。trash_delay 小于 0 时直接删除
+        """
+        with StorageScheduler.job(storage=self, kind=StorageScheduler.metadata, name='delete_image'):
+            # 创建链接克隆时，其模板被设为只读，并在 .clones 目录中登记克隆。只有模板需要检查其克隆，
+            # 普通镜像的删除无需逐个读取克隆记录
+            if not self.stat(path=path).st_mode & 0222 or self.listdir(path=self.clones_dir(backing=path)):
+                clones = self.linked_clones(backing=path)
+
+                if clones.__len__() > 0:
+                    raise AlreadyUsed(u' '.join([u'镜像', path, u'仍是', str(clones.__len__()),
+                                                 u'个链接克隆的后端镜像，无法删除']))
+
+                if self.listdir(path=self.clones_dir(backing=path)).__len__() == 0:
+                    self.rmdir(path=self.clones_dir(backing=path))
+
+            if config['trash_delay'] < 0:
+                self.unlink(path=path)
 
-        elif cls.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
-            cls.delete_image_by_local(path=path)
+            else:
+                Trash.put(storage=self, path=path)
 
-    @classmethod
-    def image_info_by_glusterfs(cls, path=None):
-        path = '/'.join(['gluster://127.0.0.1', cls.dfs_volume, path])
-        cmd = ' '.join(['/usr/bin/qemu-img', 'info', '--output=json', '-f', 'qcow2', path, '2>/dev/null'])
-        exit_status, output = Utils.shell_cmd(cmd)
+    def undelete_image(self, path=None):
+        with StorageScheduler.job(storage=self, kind=StorageScheduler.metadata, name='undelete_image'):
+            Trash.restore(storage=self, path=path)
+
+    def truncate_by_glusterfs(self, path=None, length=None):
+        with self.volume() as gf:
+            with gf.fopen(path, 'r+b') as f:
+                f.ftruncate(length)
+
+    @staticmethod
+    def truncate_by_local(path=None, length=None):
+        with open(path, 'r+b') as f:
+            f.truncate(length)
+
+    def truncate(self, path=None, length=None):
+        if self.storage_mode == StorageMode.glusterfs.value:
+            self.truncate_by_glusterfs(path=path, length=length)
+
+        elif self.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            self.truncate_by_local(path=path, length=length)
+
+    def data_segments_by_glusterfs(self, path=None):
+        with self.volume() as gf:
+            size = gf.stat(path).st_size
+
+            with gf.fopen(path, 'rb') as f:
+                return CopyEngine.data_segments(size=size, lseek=f.lseek)
+
+    @staticmethod
+    def data_segments_by_local(path=None):
+        with LocalFile(path=path) as f:
+            return CopyEngine.data_segments(size=os.fstat(f.fd).st_size, lseek=f.lseek)
+
+    def data_segments(self, path=None):
+        """
+        :return: 文件中含数据区段的列表 [(start, end), ...]
+        """
+        if self.storage_mode == StorageMode.glusterfs.value:
+            return self.data_segments_by_glusterfs(path=path)
+
+        elif self.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            return self.data_segments_by_local(path=path)
+
+    def rename_by_glusterfs(self, src=None, dst=None):
+        with self.volume() as gf:
+            if not gf.isdir(os.path.dirname(dst)):
+                gf.makedirs(os.path.dirname(dst), 0755)
+
+            gf.rename(src, dst)
+
+    @staticmethod
+    def rename_by_local(src=None, dst=None):
+        if not os.path.isdir(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst), 0755)
+
+        os.rename(src, dst)
+
+    def rename(self, src=None, dst=None):
+        """
+        同一文件系统(卷)内的原子重命名
+        """
+        with StorageScheduler.job(storage=self, kind=StorageScheduler.metadata, name='rename'):
+            if self.storage_mode == StorageMode.glusterfs.value:
+                self.rename_by_glusterfs(src=src, dst=dst)
+
+            elif self.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+                self.rename_by_local(src=src, dst=dst)
+
+    def chmod_by_glusterfs(self, path=None, mode=None):
+        with self.volume() as gf:
+            gf.chmod(path, mode)
+
+    @staticmethod
+    def chmod_by_local(path=None, mode=None):
+        os.chmod(path, mode)
+
+    def chmod(self, path=None, mode=None):
+        if self.storage_mode == StorageMode.glusterfs.value:
+            self.chmod_by_glusterfs(path=path, mode=mode)
+
+        elif self.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            self.chmod_by_local(path=path, mode=mode)
+
+    def touch_by_glusterfs(self, path=None):
+        with self.volume() as gf:
+            with gf.fopen(path, 'a'):
+                pass
+
+    @staticmethod
+    def touch_by_local(path=None):
+        with open(path, 'a'):
+            pass
+
+    def touch(self, path=None):
+        if self.storage_mode == StorageMode.glusterfs.value:
+            self.touch_by_glusterfs(path=path)
+
+        elif self.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            self.touch_by_local(path=path)
+
+    def utime_by_glusterfs(self, path=None):
+        with self.volume() as gf:
+            gf.utime(path, None)
+
+    @staticmethod
+    def utime_by_local(path=None):
+        os.utime(path, None)
+
+    def utime(self, path=None):
+        # 将访问、修改时间置为当前时间
+        if self.storage_mode == StorageMode.glusterfs.value:
+            self.utime_by_glusterfs(path=path)
+
+        elif self.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            self.utime_by_local(path=path)
+
+    def rmdir_by_glusterfs(self, path=None):
+        with self.volume() as gf:
+            if gf.isdir(path):
+                gf.rmdir(path)
+
+    @staticmethod
+    def rmdir_by_local(path=None):
+        if os.path.isdir(path):
+            os.rmdir(path)
+
+    def rmdir(self, path=None):
+        if self.storage_mode == StorageMode.glusterfs.value:
+            self.rmdir_by_glusterfs(path=path)
+
+        elif self.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            self.rmdir_by_local(path=path)
+
+    def listdir_by_glusterfs(self, path=None):
+        with self.volume() as gf:
+            if not gf.isdir(path):
+                return list()
+
+            return gf.listdir(path)
+
+    @staticmethod
+    def listdir_by_local(path=None):
+        if not os.path.isdir(path):
+            return list()
+
+        return os.listdir(path)
+
+    def listdir(self, path=None):
+        if self.storage_mode == StorageMode.glusterfs.value:
+            return self.listdir_by_glusterfs(path=path)
+
+        elif self.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            return self.listdir_by_local(path=path)
+
+    def makedirs_by_glusterfs(self, path=None):
+        with self.volume() as gf:
+            if not gf.isdir(path):
+                gf.makedirs(path, 0755)
+
+    @staticmethod
+    def makedirs_by_local(path=None):
+        if not os.path.isdir(path):
+            os.makedirs(path, 0755)
+
+    def makedirs(self, path=None):
+        if self.storage_mode == StorageMode.glusterfs.value:
+            self.makedirs_by_glusterfs(path=path)
+
+        elif self.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            self.makedirs_by_local(path=path)
+
+    def qemu_img_info_by_glusterfs(self, path=None):
+        path = '/'.join(['gluster://127.0.0.1', self.dfs_volume, path])
+        exit_status, output = QemuImg.run(args=['info', '--output=json', '-f', 'qcow2', path],
+                                          timeout=config['qemu_img_timeout'])
 
         if exit_status != 0:
             err = u' '.join([u'路径', path, u'磁盘扩容时，命令执行退出异常：', str(output)])
             raise CommandExecFailed(err)
 
-        return json.loads(output)
+        # qemu-img 的 stderr 与 stdout 合并输出，跳过 JSON 之前可能出现的告警
+        return json.loads(output[output.index('{'):])
+
+    def image_info_by_glusterfs(self, path=None):
+        def load():
+            with self.volume() as gf:
+                try:
+                    with gf.fopen(path, 'rb') as f:
+                        return Qcow2.parse(f=f, filename='/'.join(['gluster://127.0.0.1', self.dfs_volume, path]),
+                                           actual_size=st.st_blocks * 512)
+
+                except ValueError:
+                    pass
+
+            # 无法解析时，先释放卷句柄，再调用 qemu-img，以免外部命令长时间占用句柄
+            return self.qemu_img_info_by_glusterfs(path=path)
+
+        with self.volume() as gf:
+            st = gf.stat(path)
+
+        return Qcow2.info(key=(self.dfs_volume, path), st=st, load=load)
 
     @staticmethod
-    def image_info_by_local(path=None):
-        cmd = ' '.join(['/usr/bin/qemu-img', 'info', '--output=json', '-f', 'qcow2', path, '2>/dev/null'])
-        exit_status, output = Utils.shell_cmd(cmd)
+    def qemu_img_info_by_local(path=None):
+        exit_status, output = QemuImg.run(args=['info', '--output=json', '-f', 'qcow2', path],
+                                          timeout=config['qemu_img_timeout'])
 
         if exit_status != 0:
             err = u' '.join([u'路径', path, u'磁盘扩容时，命令执行退出异常：', str(output)])
             raise CommandExecFailed(err)
 
-        return json.loads(output)
+        # qemu-img 的 stderr 与 stdout 合并输出，跳过 JSON 之前可能出现的告警
+        return json.loads(output[output.index('{'):])
+
+    @staticmethod
+    def image_info_by_local(path=None):
+        """
+        优先在进程内解析 qcow2 头，无法解析时退回到 qemu-img info
+        """
+        def load():
+            try:
+                with LocalFile(path=path) as f:
+                    return Qcow2.parse(f=f, filename=path, actual_size=st.st_blocks * 512)
+
+            except ValueError:
+                return Storage.qemu_img_info_by_local(path=path)
+
+        st = os.stat(path)
+        return Qcow2.info(key=(None, path), st=st, load=load)
+
+    def image_info(self, path=None):
+        if self.storage_mode == StorageMode.glusterfs.value:
+            return self.image_info_by_glusterfs(path=path)
+
+        elif self.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            return self.image_info_by_local(path=path)
+
+    def allocation_by_glusterfs(self, path=None):
+        allocation = list()
+
+        with self.volume() as gf:
+            if not gf.isdir(path):
+                return allocation
+
+            for name in gf.listdir(path):
+                image_path = os.path.join(path, name)
+
+                try:
+                    st = gf.stat(image_path)
 
-    @classmethod
-    def image_info(cls, path=None):
-        if cls.storage_mode == StorageMode.glusterfs.value:
-            return cls.image_info_by_glusterfs(path=path)
+                    if not stat.S_ISREG(st.st_mode):
+                        continue
 
-        elif cls.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
-            return cls.image_info_by_local(path=path)
+                    with gf.fopen(image_path, 'rb') as f:
+                        virtual_size = Qcow2.virtual_size(f=f)
 
-    @classmethod
-    def getsize_by_glusterfs(cls, path=None):
-        return cls.gf.getsize(path=path)
+                except (OSError, IOError) as e:
+                    # 扫描期间被删除或移走的镜像
+                    if e.errno == errno.ENOENT:
+                        continue
+
+                    raise
+
+                allocation.append({'path': image_path, 'actual_size': st.st_blocks * 512,
+                                   'virtual_size': virtual_size or st.st_size})
+
+        return allocation
+
+    @staticmethod
+    def allocation_by_local(path=None):
+        allocation = list()
+
+        if not os.path.isdir(path):
+            return allocation
+
+        for name in os.listdir(path):
+            image_path = os.path.join(path, name)
+
+            try:
+                st = os.stat(image_path)
+
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+
+                with LocalFile(path=image_path) as f:
+                    virtual_size = Qcow2.virtual_size(f=f)
+
+            except (OSError, IOError) as e:
+                if e.errno == errno.ENOENT:
+                    continue
+
+                raise
+
+            allocation.append({'path': image_path, 'actual_size': st.st_blocks * 512,
+                               'virtual_size': virtual_size or st.st_size})
+
+        return allocation
+
+    def allocation(self, path=None):
+        """
+        批量获取目录下各镜像的实际占用及虚拟大小。以 stat 的块数及 qcow2 头获得，不调用 qemu-img
+        :return: [{'path', 'actual_size', 'virtual_size'}, ...]
+        """
+        if self.storage_mode == StorageMode.glusterfs.value:
+            return self.allocation_by_glusterfs(path=path)
+
+        elif self.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            return self.allocation_by_local(path=path)
+
+    def stat_by_glusterfs(self, path=None):
+        with self.volume() as gf:
+            return gf.stat(path)
+
+    @staticmethod
+    def stat_by_local(path=None):
+        return os.stat(path)
+
+    def stat(self, path=None):
+        if self.storage_mode == StorageMode.glusterfs.value:
+            return self.stat_by_glusterfs(path=path)
+
+        elif self.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            return self.stat_by_local(path=path)
+
+    def getsize_by_glusterfs(self, path=None):
+        with self.volume() as gf:
+            return gf.getsize(path=path)
 
     @staticmethod
     def getsize_by_local(path=None):
         return os.path.getsize(filename=path)
 
-    @classmethod
-    def getsize(cls, path=None):
-        if cls.storage_mode == StorageMode.glusterfs.value:
-            return cls.getsize_by_glusterfs(path=path)
+    def getsize(self, path=None):
+        if self.storage_mode == StorageMode.glusterfs.value:
+            return self.getsize_by_glusterfs(path=path)
 
-        elif cls.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
-            return cls.getsize_by_local(path=path)
+        elif self.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            return self.getsize_by_local(path=path)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import time
+import threading
+import contextlib
+
+from initialize import config
+from metrics import Metrics
+
+
+__author__ = 'James Iter'
+__date__ = '2026/10/19'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2026 by James Iter.'
+
+
+class TokenBucket(object):
+    """
+    令牌桶限速。rate 为每秒字节数，0 表示不限速。允许至多 1 秒的突发
+    """
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.tokens = rate
+        self.ts = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, amount=None):
+        if self.rate <= 0 or amount <= 0:
+            return
+
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.ts) * self.rate)
+            self.ts = now
+            self.tokens -= amount
+            # 令牌不足时，按欠额计算需等待的时长。由调用者在锁外等待，其它调用者排在其后
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class StorageScheduler(object):
+    """
+    存储作业调度。按后端(存储模式及卷)限制并发的作业数及复制带宽。
+    作业分为元数据(创建、删除、改名、调整大小等短操作)及批量(复制、转换等长操作)两类，
+    有元数据作业在排队时，批量作业不会被调度，以免短操作被长时间阻塞在批量作业之后。
+    """
+
+    metadata = 'metadata'
+    bulk = 'bulk'
+
+    lock = threading.Lock()
+    # 后端 -> {'cond', 'running': {kind: n}, 'waiting': {kind: n}, 'bucket'}
+    backends = dict()
+    # 当前线程已持有许可的后端。作业内嵌套的存储操作不再重复申请，避免自身死锁
+    held = threading.local()
+
+    @staticmethod
+    def backend(storage=None):
+        return ':'.join([str(storage.storage_mode), str(storage.dfs_volume)])
+
+    @staticmethod
+    def limits(backend=None):
+        """
+        :return: {'metadata': 并发数, 'bulk': 并发数, 'bandwidth': 单位(MiB/s)，0 表示不限}
+        """
+        limits = {
+            StorageScheduler.metadata: config['storage_metadata_concurrency'],
+            StorageScheduler.bulk: config['storage_bulk_concurrency'],
+            'bandwidth': config['storage_bandwidth']
+        }
+        limits.update(config['storage_limits'].get(backend, dict()))
+        return limits
+
+    @classmethod
+    def state(cls, backend=None):
+        with cls.lock:
+            if backend not in cls.backends:
+                cls.backends[backend] = {
+                    'cond': threading.Condition(threading.Lock()),
+                    'running': {cls.metadata: 0, cls.bulk: 0},
+                    'waiting': {cls.metadata: 0, cls.bulk: 0},
+                    'bucket': TokenBucket(rate=cls.limits(backend=backend)['bandwidth'] * 1024 ** 2)
+                }
+
+            return cls.backends[backend]
+
+    @classmethod
+    def runnable(cls, state=None, kind=None, limits=None):
+        if state['running'][kind] >= limits[kind]:
+            return False
+
+        if kind == cls.bulk and state['waiting'][cls.metadata] > 0:
+            return False
+
+        return True
+
+    @classmethod
+    @contextlib.contextmanager
+    def job(cls, storage=None, kind=None, name=None):
+        """
+        在调度许可下执行作业
+        with StorageScheduler.job(storage=storage, kind=StorageScheduler.bulk, name='copy_file'):
+            ...
+        """
+        backend = cls.backend(storage=storage)
+
+        if not hasattr(cls.held, 'backends'):
+            cls.held.backends = set()
+
+        if backend in cls.held.backends:
+            yield
+            return
+
+        limits = cls.limits(backend=backend)
+        state = cls.state(backend=backend)
+        labels = {'backend': backend, 'kind': kind}
+        begin = time.time()
+
+        with state['cond']:
+            state['waiting'][kind] += 1
+
+            try:
+                while not cls.runnable(state=state, kind=kind, limits=limits):
+                    state['cond'].wait()
+
+            finally:
+                state['waiting'][kind] -= 1
+
+            state['running'][kind] += 1
+            Metrics.set(name='jimvn_storage_jobs_running', value=state['running'][kind], labels=labels,
+                        _help='storage jobs running per backend')
+
+        Metrics.observe(name='jimvn_storage_queue_wait_seconds', value=time.time() - begin, labels=labels,
+                        _help='time storage jobs waited for a slot')
+
+        cls.held.backends.add(backend)
+
+        try:
+            yield
+
+        finally:
+            cls.held.backends.discard(backend)
+
+            with state['cond']:
+                state['running'][kind] -= 1
+                Metrics.set(name='jimvn_storage_jobs_running', value=state['running'][kind], labels=labels,
+                            _help='storage jobs running per backend')
+                state['cond'].notify_all()
+
+            Metrics.inc(name='jimvn_storage_jobs_total', labels={'backend': backend, 'kind': kind, 'job': name},
+                        _help='storage jobs completed')
+
+    @classmethod
+    def meter(cls, storage=None, charge_read=True, charge_written=True):
+        """
+        :param charge_read: 读取的字节是否经过该后端。从计算节点本地(如模板缓存)读取时为 False
+        :param charge_written: 写入的字节是否经过该后端。写入计算节点本地时为 False
+        :return: 供复制循环调用的记账回调 meter(read, written)，参数为实际读取、写入的字节数。
+                 按经过后端的字节消耗带宽令牌，并统计吞吐量。reflink 等仅复制元数据的操作不调用
+        """
+        backend = cls.backend(storage=storage)
+        bucket = cls.state(backend=backend)['bucket']
+
+        def _meter(read=0, written=0):
+            amount = (read if charge_read else 0) + (written if charge_written else 0)
+
+            if amount > 0:
+                Metrics.inc(name='jimvn_storage_bytes_total', value=amount, labels={'backend': backend},
+                            _help='bytes read and written per storage backend')
+                bucket.consume(amount=amount)
+
+        return _meter
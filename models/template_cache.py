@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import json
+import hashlib
+import threading
+import contextlib
+
+import jimit as ji
+
+from initialize import config, logger
+from metrics import Metrics
+from utils import Utils
+
+
+__author__ = 'James Iter'
+__date__ = '2026/10/19'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2026 by James Iter.'
+
+
+class TemplateCache(object):
+    """
+    计算节点本地的模板缓存。共享挂载及 GlusterFS 存储模式下，热门模板只需经网络读取一次，之后从本地副本复制。
+    缓存条目以模板的大小、修改时间校验(可选 md5 校验)，超出容量预算时，按最近最少使用淘汰。
+    """
+
+    lock = threading.Lock()
+    # 每个缓存条目一把锁，避免同一模板被并发地重复拉取
+    entry_locks = dict()
+    # key -> {'source', 'size', 'mtime', 'checksum', 'last_used'}
+    index = None
+    # key -> 正在从该缓存条目复制的作业数。被引用的条目不会被淘汰或替换
+    references = dict()
+    chunk_size = 4 * 1024 ** 2
+
+    @staticmethod
+    def enabled():
+        return config['template_cache_size'] > 0
+
+    @staticmethod
+    def budget():
+        return config['template_cache_size'] * 1024 ** 3
+
+    @staticmethod
+    def key(storage=None, path=None):
+        return Utils.md5(_str=':'.join([str(storage.storage_mode), str(storage.dfs_volume), path]))
+
+    @staticmethod
+    def entry_path(key=None):
+        return os.path.join(config['template_cache_path'], key + '.qcow2')
+
+    @staticmethod
+    def meta_path(key=None):
+        return os.path.join(config['template_cache_path'], key + '.json')
+
+    @classmethod
+    def load_index(cls):
+        # 调用者需持有 cls.lock
+        if cls.index is not None:
+            return
+
+        cls.index = dict()
+        cache_path = config['template_cache_path']
+
+        if not os.path.isdir(cache_path):
+            os.makedirs(cache_path, 0755)
+
+        for filename in os.listdir(cache_path):
+            if filename.endswith('.tmp'):
+                # 上次拉取中途退出所遗留的文件
+                os.remove(os.path.join(cache_path, filename))
+                continue
+
+            if not filename.endswith('.json'):
+                continue
+
+            key = filename[:-len('.json')]
+
+            try:
+                with open(cls.meta_path(key=key), 'r') as f:
+                    meta = json.load(f)
+
+                if os.path.getsize(cls.entry_path(key=key)) != meta['size']:
+                    raise ValueError(u'缓存文件大小与记录不符')
+
+                cls.index[key] = meta
+
+            except (IOError, OSError, ValueError, KeyError) as e:
+                logger.warn(u' '.join([u'丢弃无效的模板缓存', key, unicode(e)]))
+                cls.remove_entry(key=key)
+
+    @classmethod
+    def remove_entry(cls, key=None):
+        for path in [cls.entry_path(key=key), cls.meta_path(key=key)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+        if cls.index is not None:
+            cls.index.pop(key, None)
+
+    @classmethod
+    def save_meta(cls, key=None):
+        with open(cls.meta_path(key=key), 'w') as f:
+            json.dump(cls.index[key], f)
+
+    @classmethod
+    def used(cls):
+        return sum([meta['size'] for meta in cls.index.values()])
+
+    @classmethod
+    def evict(cls, size=None):
+        """
+        按最近最少使用淘汰，直至可容纳 size 字节。调用者需持有 cls.lock
+        """
+        for key, meta in sorted(cls.index.items(), key=lambda item: item[1]['last_used']):
+            if cls.used() + size <= cls.budget():
+                break
+
+            entry_lock = cls.entry_locks.get(key)
+            if entry_lock is not None and entry_lock.locked() or cls.references.get(key, 0) > 0:
+                continue
+
+            logger.info(msg=u' '.join([u'淘汰模板缓存', meta['source']]))
+            cls.remove_entry(key=key)
+
+        return cls.used() + size <= cls.budget()
+
+    @classmethod
+    def checksum(cls, path=None):
+        m = hashlib.md5()
+        with open(path, 'rb') as f:
+            for data in iter(lambda: f.read(cls.chunk_size), ''):
+                m.update(data)
+
+        return m.hexdigest()
+
+    @classmethod
+    def release(cls, key=None):
+        with cls.lock:
+            cls.references[key] -= 1
+
+            if cls.references[key] < 1:
+                del cls.references[key]
+
+    @classmethod
+    @contextlib.contextmanager
+    def use(cls, storage=None, path=None, progress=None, meter=None):
+        """
+        取得模板在本地缓存中的路径，并在 with 块内保持对该条目的引用，使其在复制期间不被淘汰
+        with TemplateCache.use(storage=storage, path=path) as cached_path:
+            ...
+        """
+        cached_path = cls.fetch(storage=storage, path=path, progress=progress, meter=meter)
+
+        try:
+            yield cached_path
+
+        finally:
+            if cached_path is not None:
+                cls.release(key=cls.key(storage=storage, path=path))
+
+    @classmethod
+    def fetch(cls, storage=None, path=None, progress=None, meter=None):
+        """
+        命中或拉取成功时，条目的引用计数加一，调用者用毕须调用 release。宜经 use 调用
+        :param storage: 模板所在的 Storage
+        :param path: 模板路径，不包含 dfs 卷标
+        :param progress: 未命中时，拉取模板的进度回调 progress(done, total)
+        :param meter: 未命中时，拉取模板的记账回调 meter(read, written)
+        :return: 模板在本地缓存中的路径。模板大于缓存容量，或旧的缓存条目仍在被使用时返回 None，由调用者直接复制
+        """
+        key = cls.key(storage=storage, path=path)
+        st = storage.stat(path=path)
+
+        with cls.lock:
+            cls.load_index()
+            entry_lock = cls.entry_locks.setdefault(key, threading.Lock())
+
+        with entry_lock:
+            with cls.lock:
+                meta = cls.index.get(key)
+
+            if meta is not None and meta['size'] == st.st_size and meta['mtime'] == int(st.st_mtime):
+                if not config['template_cache_checksum'] or \
+                        cls.checksum(path=cls.entry_path(key=key)) == meta['checksum']:
+
+                    with cls.lock:
+                        meta['last_used'] = ji.Common.ts()
+                        cls.save_meta(key=key)
+                        cls.references[key] = cls.references.get(key, 0) + 1
+
+                    Metrics.inc(name='jimvn_template_cache_hits_total', _help='template cache hits')
+                    Metrics.inc(name='jimvn_template_cache_saved_bytes_total', value=st.st_size,
+                                _help='template bytes not read from shared storage thanks to the cache')
+                    return cls.entry_path(key=key)
+
+            Metrics.inc(name='jimvn_template_cache_misses_total', _help='template cache misses')
+
+            with cls.lock:
+                if meta is not None:
+                    # 模板已更新，但旧的缓存文件仍在被复制
+                    if cls.references.get(key, 0) > 0:
+                        return None
+
+                    cls.remove_entry(key=key)
+
+                if not cls.evict(size=st.st_size):
+                    return None
+
+                # 先行占位，避免并发拉取其它模板时超出容量预算
+                cls.index[key] = {'source': path, 'size': st.st_size, 'mtime': int(st.st_mtime), 'checksum': None,
+                                  'last_used': ji.Common.ts()}
+
+            tmp_path = cls.entry_path(key=key) + '.tmp'
+
+            try:
+                storage.copy_file_to_local(src=path, dst=tmp_path, progress=progress, meter=meter)
+                os.rename(tmp_path, cls.entry_path(key=key))
+
+                with cls.lock:
+                    if config['template_cache_checksum']:
+                        cls.index[key]['checksum'] = cls.checksum(path=cls.entry_path(key=key))
+
+                    cls.save_meta(key=key)
+                    cls.references[key] = cls.references.get(key, 0) + 1
+
+            except:
+                with cls.lock:
+                    cls.remove_entry(key=key)
+
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+                raise
+
+            cls.report()
+            return cls.entry_path(key=key)
+
+    @classmethod
+    def report(cls):
+        with cls.lock:
+            if cls.index is None:
+                return
+
+            Metrics.set(name='jimvn_template_cache_bytes', value=cls.used(), _help='bytes held by the template cache')
+            Metrics.set(name='jimvn_template_cache_entries', value=cls.index.__len__(),
+                        _help='templates held by the template cache')
+
+    @classmethod
+    def stats(cls):
+        cls.report()
+
+        return {
+            'hits': Metrics.get(name='jimvn_template_cache_hits_total'),
+            'misses': Metrics.get(name='jimvn_template_cache_misses_total'),
+            'saved_bytes': Metrics.get(name='jimvn_template_cache_saved_bytes_total'),
+            'bytes': Metrics.get(name='jimvn_template_cache_bytes'),
+            'entries': Metrics.get(name='jimvn_template_cache_entries')
+        }
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import json
+import time
+import errno
+import base64
+import threading
+
+from initialize import config, logger
+from metrics import Metrics
+from jimvn_exception import PathExist, PathNotExist
+
+
+__author__ = 'James Iter'
+__date__ = '2026/10/19'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2026 by James Iter.'
+
+
+class Trash(object):
+    """
+    镜像回收站。删除镜像时将其原子地移入同目录下的回收站目录后立即返回，
+    由 trash_reaper_engine 在 trash_delay 秒后，以逐步截短再删除的方式限速释放空间，避免一次性删除大文件阻塞文件系统。
+    在 trash_delay 之内，镜像可被恢复。
+    回收站中的文件名形如 <删除时间>.<原路径的 base64>。
+    位于共享存储上的回收站目录，只由持有其租约的一个节点回收。
+    """
+
+    lock = threading.Lock()
+    # 已知的回收站目录 (storage_mode, dfs_volume, 回收站目录)，持久化于 trash_registry，重启后继续回收
+    dirs = None
+    # 最近一次回收后的统计
+    summary = {'entries': 0, 'bytes': 0, 'reclaimed': 0}
+    # 回收站中各镜像的实际占用，(回收站目录, 文件名) -> 字节数。镜像在开始回收前不会改变，故只需 stat 一次
+    sizes = dict()
+    lease_prefix = '.reaper.'
+    node_id = None
+
+    @staticmethod
+    def trash_dir(path=None):
+        return os.path.join(os.path.dirname(path), config['trash_dir_name'])
+
+    @staticmethod
+    def entry_name(path=None, ts=None):
+        return '.'.join([str(ts), base64.urlsafe_b64encode(path)])
+
+    @staticmethod
+    def parse_name(name=None):
+        """
+        :return: (删除时间, 原路径)。非回收站文件返回 None
+        """
+        try:
+            ts, encoded = name.split('.', 1)
+            return int(ts), base64.urlsafe_b64decode(encoded)
+
+        except (ValueError, TypeError):
+            return None
+
+    @classmethod
+    def load(cls):
+        # 调用者需持有 cls.lock
+        if cls.dirs is not None:
+            return
+
+        cls.dirs = set()
+
+        if os.path.exists(config['trash_registry']):
+            with open(config['trash_registry'], 'r') as f:
+                # json 载入的路径为 unicode，以之 listdir 得到的文件名无法被 base64 解码，故转回 str
+                cls.dirs = set([(storage_mode, dfs_volume if dfs_volume is None else dfs_volume.encode('utf-8'),
+                                 trash_dir.encode('utf-8')) for storage_mode, dfs_volume, trash_dir in json.load(f)])
+
+    @classmethod
+    def register(cls, storage=None, trash_dir=None):
+        with cls.lock:
+            cls.load()
+            key = (storage.storage_mode, storage.dfs_volume, trash_dir)
+
+            if key in cls.dirs:
+                return
+
+            cls.dirs.add(key)
+
+            if not os.path.isdir(os.path.dirname(config['trash_registry'])):
+                os.makedirs(os.path.dirname(config['trash_registry']), 0755)
+
+            with open(config['trash_registry'], 'w') as f:
+                json.dump(list(cls.dirs), f)
+
+    @classmethod
+    def put(cls, storage=None, path=None):
+        trash_dir = cls.trash_dir(path=path)
+        cls.register(storage=storage, trash_dir=trash_dir)
+        storage.rename(src=path, dst=os.path.join(trash_dir, cls.entry_name(path=path, ts=int(time.time()))))
+
+    @classmethod
+    def restore(cls, storage=None, path=None):
+        """
+        恢复 path 最近一次被删除的镜像。已开始回收的镜像无法恢复
+        """
+        trash_dir = cls.trash_dir(path=path)
+        candidates = list()
+
+        for name in storage.listdir(path=trash_dir):
+            parsed = cls.parse_name(name=name)
+
+            if parsed is not None and parsed[1] == path:
+                candidates.append((parsed[0], name))
+
+        with cls.lock:
+            for ts, name in sorted(candidates, reverse=True):
+                if time.time() - ts >= config['trash_delay']:
+                    continue
+
+                try:
+                    storage.stat(path=path)
+                    raise PathExist(u' '.join([u'路径', path, u'已存在，无法恢复']))
+
+                except (OSError, IOError):
+                    pass
+
+                storage.rename(src=os.path.join(trash_dir, name), dst=path)
+                logger.info(msg=u' '.join([u'已从回收站恢复镜像', path]))
+                return
+
+        raise PathNotExist(u' '.join([u'回收站中没有可恢复的镜像', path]))
+
+    @classmethod
+    def local_node_id(cls):
+        if cls.node_id is None:
+            from utils import Utils
+            cls.node_id = str(Utils.get_node_id())
+
+        return cls.node_id
+
+    @classmethod
+    def lease(cls, storage=None, trash_dir=None, names=None):
+        """
+        回收站目录中名为 .reaper.<node_id> 的文件为各节点的租约，其修改时间在 trash_lease_timeout 秒之内视为有效。
+        有效的租约中 node_id 最小者回收该目录，其余节点跳过。长期失效的租约(如节点已下线)被清除
+        :return: 本节点是否回收该目录
+        """
+        now = time.time()
+        holders = [cls.local_node_id()]
+
+        for name in names:
+            if not name.startswith(cls.lease_prefix) or name == cls.lease_prefix + cls.local_node_id():
+                continue
+
+            path = os.path.join(trash_dir, name)
+
+            try:
+                age = now - storage.stat(path=path).st_mtime
+
+                if age < config['trash_lease_timeout']:
+                    holders.append(name[len(cls.lease_prefix):])
+
+                elif age > config['trash_lease_timeout'] * 10:
+                    storage.unlink(path=path)
+
+            except (OSError, IOError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+        if min(holders) != cls.local_node_id():
+            return False
+
+        # 续约
+        path = os.path.join(trash_dir, cls.lease_prefix + cls.local_node_id())
+        storage.touch(path=path)
+        storage.utime(path=path)
+        return True
+
+    @classmethod
+    def reap(cls):
+        """
+        由 trash_reaper_engine 每 trash_reap_interval 秒调用一次。每次最多释放 trash_reclaim_rate * trash_reap_interval 字节
+        """
+        from storage import Storage
+
+        with cls.lock:
+            cls.load()
+            dirs = list(cls.dirs)
+
+        budget = config['trash_reclaim_rate'] * 1024 ** 2 * config['trash_reap_interval']
+        unlimited = budget <= 0
+        reclaimed = 0
+        sizes = dict()
+
+        for storage_mode, dfs_volume, trash_dir in dirs:
+            storage = Storage(storage_mode=storage_mode, dfs_volume=dfs_volume)
+            names = storage.listdir(path=trash_dir)
+
+            if names.__len__() < 1 or not cls.lease(storage=storage, trash_dir=trash_dir, names=names):
+                continue
+
+            for name in sorted(names):
+                parsed = cls.parse_name(name=name)
+
+                if parsed is None:
+                    continue
+
+                path = os.path.join(trash_dir, name)
+                key = (trash_dir, name)
+
+                try:
+                    if key in cls.sizes:
+                        sizes[key] = cls.sizes[key]
+
+                    else:
+                        sizes[key] = storage.stat(path=path).st_blocks * 512
+
+                    if time.time() - parsed[0] < config['trash_delay']:
+                        continue
+
+                    if not unlimited and reclaimed >= budget:
+                        continue
+
+                    with cls.lock:
+                        st = storage.stat(path=path)
+                        allocated = st.st_blocks * 512
+
+                        # 逐步截短，每次释放的量受本次剩余额度限制。额度按实际占用的块计量，而非文件长度
+                        if unlimited or allocated <= budget - reclaimed:
+                            storage.unlink(path=path)
+                            reclaimed += allocated
+                            del sizes[key]
+                            logger.info(msg=u' '.join([u'已回收镜像', parsed[1]]))
+
+                        else:
+                            # 稀疏镜像的占用并非均匀分布于长度，自末尾起跳过空洞，只截去剩余额度对应的数据区段。
+                            # 释放的量以截短前后块数之差计
+                            remaining = budget - reclaimed
+                            length = st.st_size
+
+                            for start, end in reversed(storage.data_segments(path=path)):
+                                if end - start >= remaining:
+                                    length = end - remaining
+                                    break
+
+                                remaining -= end - start
+                                length = start
+
+                            storage.truncate(path=path, length=length)
+                            sizes[key] = storage.stat(path=path).st_blocks * 512
+                            reclaimed += allocated - sizes[key]
+
+                except (OSError, IOError) as e:
+                    # 已被恢复，或已被其它节点回收
+                    if e.errno != errno.ENOENT:
+                        raise
+
+                    sizes.pop(key, None)
+
+        cls.sizes = sizes
+        entries = sizes.__len__()
+        _bytes = sum(sizes.values())
+        cls.summary = {'entries': entries, 'bytes': _bytes, 'reclaimed': cls.summary['reclaimed'] + reclaimed}
+
+        Metrics.set(name='jimvn_trash_entries', value=entries, _help='images waiting in the trash')
+        Metrics.set(name='jimvn_trash_bytes', value=_bytes, _help='bytes held by images in the trash')
+        Metrics.inc(name='jimvn_trash_reclaimed_bytes_total', value=reclaimed, _help='bytes reclaimed from the trash')
+
+    @classmethod
+    def stats(cls):
+        return dict(cls.summary)
@@ -12,11 +12,13 @@ import redis
 import time
 import base64
 import paramiko
+import threading
+import contextlib
 
 import libvirt
 import libvirt_qemu
 
-from models import LogLevel, EmitKind, GuestState, ResponseState, HostEvent
+from models import LogLevel, EmitKind, GuestState, ResponseState, HostEvent, GuestStateReportKind
 from models import GuestCollectionPerformanceDataKind, HostCollectionPerformanceDataKind
 
 
@@ -81,6 +83,107 @@ class Utils(object):
         return Utils.uuid_by_decimal(_str=machine_id, _len=16)
 
 
+class SSHPool(object):
+    """
+    SSH 连接池。每个 (主机, 用户) 复用一个连接，paramiko 的 Transport 可在同一连接上并发打开多个会话通道，
+    因此多个远程命令可并行执行。连接失效，或无人使用且空闲超过 idle_timeout 秒时重新建立。
+    仍有使用者的连接不会被关闭，以免中断其上正在执行的命令。
+    """
+
+    lock = threading.Lock()
+    # (hostname, user) -> {'client', 'lock', 'ts', 'users', 'closing'}
+    clients = dict()
+    idle_timeout = 300
+
+    @classmethod
+    @contextlib.contextmanager
+    def use(cls, hostname=None, user=None):
+        """
+        取得连接，并在 with 块内登记为其使用者
+        with SSHPool.use(hostname=hostname, user=user) as client:
+            ...
+        """
+        with cls.lock:
+            entry = cls.clients.setdefault((hostname, user), {'client': None, 'lock': threading.Lock(), 'ts': 0,
+                                                              'users': 0, 'closing': False})
+
+        with entry['lock']:
+            client = entry['client']
+            transport = None if client is None else client.get_transport()
+            idle = entry['users'] == 0 and time.time() - entry['ts'] > cls.idle_timeout
+
+            # 失效的连接上已无可用的通道，可直接关闭
+            if transport is None or not transport.is_active() or idle:
+                if client is not None:
+                    client.close()
+
+                entry['client'] = Utils.ssh_client(hostname=hostname, user=user)
+                entry['client'].get_transport().set_keepalive(30)
+
+            entry['users'] += 1
+            entry['ts'] = time.time()
+            client = entry['client']
+
+        try:
+            yield client
+
+        finally:
+            with entry['lock']:
+                entry['users'] -= 1
+                entry['ts'] = time.time()
+
+                # 连接在使用期间被 close，由最后一个使用者关闭
+                if entry['closing'] and entry['users'] == 0 and entry['client'] is not None:
+                    entry['client'].close()
+                    entry['client'] = None
+
+    @classmethod
+    def exec_command(cls, hostname=None, user=None, cmd=None, timeout=None):
+        """
+        :return: (exit_status, stdout, stderr)
+        """
+        with cls.use(hostname=hostname, user=user) as client:
+            stdin, stdout, stderr = client.exec_command(cmd, timeout=timeout)
+            stdin.close()
+
+            # 两个输出流需同时读取。只顺序读取时，远程命令的 stderr 写满通道窗口后将阻塞，stdout 也就无法读完
+            err = list()
+
+            def drain():
+                try:
+                    err.append(stderr.read())
+
+                except Exception as e:
+                    err.append(e)
+
+            t = threading.Thread(target=drain)
+            t.setDaemon(True)
+            t.start()
+
+            out = stdout.read()
+            t.join()
+
+            if isinstance(err[0], Exception):
+                raise err[0]
+
+            return stdout.channel.recv_exit_status(), out.decode('utf-8', 'replace'), err[0].decode('utf-8', 'replace')
+
+    @classmethod
+    def close(cls, hostname=None, user=None):
+        with cls.lock:
+            entry = cls.clients.pop((hostname, user), None)
+
+        if entry is None:
+            return
+
+        with entry['lock']:
+            entry['closing'] = True
+
+            if entry['users'] == 0 and entry['client'] is not None:
+                entry['client'].close()
+                entry['client'] = None
+
+
 class QGA(object):
 
     @staticmethod
@@ -225,10 +328,11 @@ class GuestEventEmit(Emit):
     def __init__(self):
         super(GuestEventEmit, self).__init__()
 
-    def emit2(self, _type=None, uuid=None, os_template_image_id=None, migrating_info=None, xml=None, progress=None):
+    def emit2(self, _type=None, uuid=None, os_template_image_id=None, migrating_info=None, xml=None, progress=None,
+              throughput=None):
         return self.emit(_kind=EmitKind.guest_event.value, _type=_type, message={
             'uuid': uuid, 'os_template_image_id': os_template_image_id, 'migrating_info': migrating_info, 'xml': xml,
-            'progress': progress})
+            'progress': progress, 'throughput': throughput})
 
     def no_state(self, uuid):
         return self.emit2(_type=GuestState.no_state.value, uuid=uuid)
@@ -266,9 +370,30 @@ class GuestEventEmit(Emit):
     def creating(self, uuid, progress):
         return self.emit2(_type=GuestState.creating.value, uuid=uuid, progress=progress)
 
-    def snapshot_converting(self, uuid, os_template_image_id, progress):
+    def snapshot_converting(self, uuid, os_template_image_id, progress, throughput=None):
         return self.emit2(_type=GuestState.snapshot_converting.value, uuid=uuid,
-                          os_template_image_id=os_template_image_id, progress=progress)
+                          os_template_image_id=os_template_image_id, progress=progress, throughput=throughput)
+
+    def snapshot_deleting(self, uuid, progress):
+        return self.emit2(_type=GuestState.snapshot_deleting.value, uuid=uuid, progress=progress)
+
+    def backing_up(self, uuid, progress):
+        return self.emit2(_type=GuestState.backing_up.value, uuid=uuid, progress=progress)
+
+
+class GuestStateEmit(Emit):
+    def __init__(self):
+        super(GuestStateEmit, self).__init__()
+
+    def emit2(self, _type=None, guests=None, chunk=0, chunks=1):
+        return self.emit(_kind=EmitKind.guest_state.value, _type=_type, message={
+            'guests': guests, 'chunk': chunk, 'chunks': chunks})
+
+    def batch(self, guests):
+        return self.emit2(_type=GuestStateReportKind.batch.value, guests=guests)
+
+    def snapshot(self, guests, chunk, chunks):
+        return self.emit2(_type=GuestStateReportKind.snapshot.value, guests=guests, chunk=chunk, chunks=chunks)
 
 
 class HostEventEmit(Emit):
@@ -335,3 +460,9 @@ class HostCollectionPerformanceEmit(Emit):
     def disk_usage_io(self, data=None):
         return self.emit2(_type=HostCollectionPerformanceDataKind.disk_usage_io.value, data=data)
 
+    def pressure(self, data=None):
+        return self.emit2(_type=HostCollectionPerformanceDataKind.pressure.value, data=data)
+
+    def image_allocation(self, data=None):
+        return self.emit2(_type=HostCollectionPerformanceDataKind.image_allocation.value, data=data)
+
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import time
+import uuid
+import threading
+import traceback
+
+from initialize import config, logger, log_emit
+from metrics import Metrics
+from pressure import Pressure
+from storage import Storage
+from utils import Utils
+
+
+__author__ = 'James Iter'
+__date__ = '2026/10/19'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2026 by James Iter.'
+
+
+class WarmImagePool(object):
+    """
+    热门模板的预置系统镜像池。后台在磁盘空闲时为每个配置的模板预先复制若干系统镜像，创建 Guest 时以原子重命名直接领用。
+    池中镜像名包含模板路径的摘要及模板的修改时间，模板更新后旧镜像自动作废。
+    """
+
+    lock = threading.Lock()
+    # 正在补充的镜像(同一时刻只补充一个，避免挤占磁盘带宽)
+    filling = None
+    filling_path = None
+    # 临时文件名中带有本节点的 node_id，以便在共享的池目录中区分各节点的临时文件
+    node_id = None
+
+    @staticmethod
+    def entries():
+        """
+        :return: [{'storage_mode', 'dfs_volume', 'template_path', 'size', 'pool_path'(可选)}, ...]
+        """
+        return config['warm_image_pool']
+
+    @staticmethod
+    def pool_path(entry=None):
+        # 池目录需与系统镜像位于同一文件系统(卷)内，重命名才是原子的
+        return entry.get('pool_path') or os.path.join(os.path.dirname(entry['template_path']), '.warm_pool')
+
+    @staticmethod
+    def storage(entry=None):
+        return Storage(storage_mode=entry['storage_mode'], dfs_volume=entry.get('dfs_volume'))
+
+    @staticmethod
+    def prefix(template_path=None, mtime=None):
+        prefix = Utils.md5(template_path) + '_'
+
+        if mtime is not None:
+            prefix += str(int(mtime)) + '_'
+
+        return prefix
+
+    @classmethod
+    def local_node_id(cls):
+        if cls.node_id is None:
+            cls.node_id = str(Utils.get_node_id())
+
+        return cls.node_id
+
+    @classmethod
+    def tmp_name(cls, template_path=None, mtime=None):
+        return cls.prefix(template_path=template_path, mtime=mtime) + \
+            '_'.join([cls.local_node_id(), uuid.uuid4().hex]) + '.qcow2.tmp'
+
+    @classmethod
+    def find_entry(cls, storage=None, template_path=None):
+        for entry in cls.entries():
+            if entry['template_path'] == template_path and entry['storage_mode'] == storage.storage_mode and \
+                    entry.get('dfs_volume') == storage.dfs_volume:
+                return entry
+
+        return None
+
+    @classmethod
+    def ready(cls, storage=None, entry=None, mtime=None):
+        """
+        :return: 池中可领用的镜像名列表
+        """
+        prefix = cls.prefix(template_path=entry['template_path'], mtime=mtime)
+
+        return sorted([name for name in storage.listdir(path=cls.pool_path(entry=entry))
+                       if name.startswith(prefix) and name.endswith('.qcow2')])
+
+    @classmethod
+    def claim(cls, storage=None, template_path=None, dst=None):
+        """
+        :return: 是否已从池中领用镜像至 dst
+        """
+        entry = cls.find_entry(storage=storage, template_path=template_path)
+
+        if entry is None:
+            return False
+
+        mtime = storage.stat(path=template_path).st_mtime
+
+        with cls.lock:
+            for name in cls.ready(storage=storage, entry=entry, mtime=mtime):
+                try:
+                    storage.rename(src=os.path.join(cls.pool_path(entry=entry), name), dst=dst)
+
+                except (OSError, IOError) as e:
+                    # 已被其它节点领用，或池目录与目标不在同一文件系统内
+                    logger.warn(u' '.join([u'领用预置镜像', name, u'失败：', unicode(e)]))
+                    continue
+
+                Metrics.inc(name='jimvn_warm_pool_claims_total', labels={'result': 'hit'},
+                            _help='warm image pool claims')
+                return True
+
+        Metrics.inc(name='jimvn_warm_pool_claims_total', labels={'result': 'miss'}, _help='warm image pool claims')
+        return False
+
+    @classmethod
+    def purge(cls, storage=None, entry=None, mtime=None):
+        """
+        删除模板更新前预置的镜像，及中途退出所遗留的临时文件。
+        池目录可能被多个节点共享，其它节点的临时文件可能正在写入，仅在其长时间未被写入时删除
+        """
+        pool_path = cls.pool_path(entry=entry)
+        prefix = cls.prefix(template_path=entry['template_path'])
+        current = cls.prefix(template_path=entry['template_path'], mtime=mtime)
+
+        for name in storage.listdir(path=pool_path):
+            if not name.startswith(prefix):
+                continue
+
+            path = os.path.join(pool_path, name)
+
+            if path == cls.filling_path:
+                continue
+
+            if name.endswith('.tmp'):
+                # 形如 <摘要>_<mtime>_<node_id>_<uuid>.qcow2.tmp
+                if name.split('_')[2:3] != [cls.local_node_id()]:
+                    try:
+                        if time.time() - storage.stat(path=path).st_mtime < config['warm_image_pool_tmp_expire']:
+                            continue
+
+                    except (OSError, IOError):
+                        # 已被其它节点重命名或删除
+                        continue
+
+                storage.delete_image(path=path)
+
+            elif not name.startswith(current):
+                storage.delete_image(path=path)
+
+    @classmethod
+    def fill(cls, entry=None, mtime=None):
+        storage = cls.storage(entry=entry)
+        name = cls.prefix(template_path=entry['template_path'], mtime=mtime) + uuid.uuid4().hex + '.qcow2'
+        path = os.path.join(cls.pool_path(entry=entry), name)
+
+        try:
+            storage.copy_file(src=entry['template_path'], dst=cls.filling_path)
+            storage.rename(src=cls.filling_path, dst=path)
+
+            logger.info(msg=u' '.join([u'已为模板', entry['template_path'], u'预置镜像', name]))
+
+        except:
+            log_emit.warn(traceback.format_exc())
+
+        finally:
+            with cls.lock:
+                cls.filling_path = None
+
+    @classmethod
+    def top_up(cls):
+        """
+        由 warm_image_pool_engine 周期调用。磁盘处于压力之下时暂停补充
+        """
+        if cls.filling is not None and cls.filling.is_alive():
+            return
+
+        images = 0
+        _bytes = 0
+        deficit = None
+
+        for entry in cls.entries():
+            storage = cls.storage(entry=entry)
+            mtime = storage.stat(path=entry['template_path']).st_mtime
+
+            cls.purge(storage=storage, entry=entry, mtime=mtime)
+            names = cls.ready(storage=storage, entry=entry, mtime=mtime)
+
+            images += names.__len__()
+            for name in names:
+                _bytes += storage.stat(path=os.path.join(cls.pool_path(entry=entry), name)).st_size
+
+            if deficit is None and names.__len__() < entry['size']:
+                deficit = (entry, mtime)
+
+        Metrics.set(name='jimvn_warm_pool_images', value=images, _help='images ready in the warm image pool')
+        Metrics.set(name='jimvn_warm_pool_bytes', value=_bytes, _help='bytes held by the warm image pool')
+
+        if deficit is None or Pressure.is_under_pressure(resource='io'):
+            return
+
+        entry, mtime = deficit
+
+        with cls.lock:
+            cls.filling_path = os.path.join(cls.pool_path(entry=entry),
+                                            cls.tmp_name(template_path=entry['template_path'], mtime=mtime))
+
+        # 复制耗时较长，不阻塞引擎自身的心跳
+        cls.filling = threading.Thread(target=cls.fill, kwargs={'entry': entry, 'mtime': mtime})
+        cls.filling.setDaemon(True)
+        cls.filling.start()
+
+    @staticmethod
+    def stats():
+        hits = Metrics.get(name='jimvn_warm_pool_claims_total', labels={'result': 'hit'})
+        misses = Metrics.get(name='jimvn_warm_pool_claims_total', labels={'result': 'miss'})
+
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(float(hits) / (hits + misses), 4) if hits + misses > 0 else None,
+            'images': Metrics.get(name='jimvn_warm_pool_images'),
+            'bytes': Metrics.get(name='jimvn_warm_pool_bytes')
+        }
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import sys
+import types
+import logging
+
+
+__author__ = 'James Iter'
+__date__ = '2026/10/19'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2026 by James Iter.'
+
+
+# 单元测试的运行环境。用法：python -m unittest discover -s tests
+# models 下的模块以隐式相对导入的方式引用 initialize，而 initialize 在导入时即读取配置文件、连接 redis，
+# 故以只含 config、logger 的模块代替，使被测模块可以脱离计算节点的运行环境导入。
+# 同理，models/__init__.py 会导入全部模块，以不执行 __init__ 的同名包代替，其子模块照常导入。
+
+models_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'models')
+
+if models_dir not in sys.path:
+    sys.path.insert(0, models_dir)
+
+if 'initialize' not in sys.modules:
+    initialize = types.ModuleType('initialize')
+    initialize.config = dict()
+    initialize.logger = logging.getLogger('jimvn_tests')
+    initialize.logger.addHandler(logging.NullHandler())
+    sys.modules['initialize'] = initialize
+
+if 'models' not in sys.modules:
+    import status
+
+    models = types.ModuleType('models')
+    models.__path__ = [models_dir]
+
+    for name in dir(status):
+        if not name.startswith('_'):
+            setattr(models, name, getattr(status, name))
+
+    sys.modules['models'] = models
+    sys.modules['models.status'] = status
+
+config = sys.modules['initialize'].config
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import environment
+from backup import IncrementalBackup
+from qemu_img import QemuImg
+from jimvn_exception import CommandExecFailed
+
+
+__author__ = 'James Iter'
+__date__ = '2026/10/19'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2026 by James Iter.'
+
+
+class FakeQemu(object):
+    """
+    模拟 qemu 的 QMP 接口中与备份相关的命令。fail 为真时，备份作业以错误结束
+    """
+
+    def __init__(self, bitmaps=None):
+        self.bitmaps = set(bitmaps or list())
+        self.commands = list()
+        self.jobs = list()
+        self.fail = False
+
+    def qmp(self, dom=None, execute=None, arguments=None):
+        self.commands.append((execute, arguments))
+
+        if execute == 'query-block':
+            return [{'device': 'drive-virtio-disk0', 'inserted': {'image': {'virtual-size': 1024 ** 3}},
+                     'dirty-bitmaps': [{'name': name} for name in self.bitmaps]}]
+
+        if execute == 'transaction':
+            for action in arguments['actions']:
+                if action['type'] == 'block-dirty-bitmap-add':
+                    self.bitmaps.add(action['data']['name'])
+
+                elif action['type'] == 'drive-backup':
+                    self.start(backup=action['data'])
+
+        elif execute == 'drive-backup':
+            self.start(backup=arguments)
+
+        elif execute == 'block-dirty-bitmap-remove':
+            self.bitmaps.discard(arguments['name'])
+
+        elif execute == 'query-jobs':
+            return self.jobs
+
+        elif execute == 'job-dismiss':
+            self.jobs = [job for job in self.jobs if job['id'] != arguments['id']]
+
+    def start(self, backup=None):
+        job = {'id': backup['job-id'], 'status': 'concluded', 'current-progress': 1, 'total-progress': 1}
+
+        if self.fail:
+            job['error'] = 'Input/output error'
+
+        self.jobs.append(job)
+
+    def executed(self, execute=None):
+        return [arguments for _execute, arguments in self.commands if _execute == execute]
+
+
+class TestIncrementalBackup(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.qmp = IncrementalBackup.__dict__['qmp']
+        self.run = QemuImg.__dict__['run']
+        self.qemu = FakeQemu()
+
+        environment.config.update({'backup_bitmap_name': 'jimvn-backup', 'qemu_img_timeout': 60})
+        IncrementalBackup.qmp = staticmethod(self.qemu.qmp)
+
+        def run(args=None, progress=None, timeout=None):
+            open(args[-2], 'w').close()
+            return 0, ''
+
+        QemuImg.run = staticmethod(run)
+
+    def tearDown(self):
+        IncrementalBackup.qmp = self.qmp
+        QemuImg.run = self.run
+        shutil.rmtree(self.tmp_dir)
+
+    def backup_disk(self, full=False):
+        return IncrementalBackup.backup_disk(dom=None, dev='vda', device='drive-virtio-disk0',
+                                             path='/opt/Images/4b3c.qcow2', target_dir=self.tmp_dir, full=full)
+
+    def test_full_then_incremental(self):
+        first = self.backup_disk()
+        second = self.backup_disk()
+
+        self.assertEqual(first['mode'], 'full')
+        self.assertEqual(second['mode'], 'incremental')
+        self.assertEqual(self.qemu.executed('drive-backup')[-1]['bitmap'], 'jimvn-backup')
+
+    def test_failed_full_backup_forces_next_full(self):
+        self.backup_disk()
+        self.backup_disk(full=False)
+
+        # 强制全量备份时位图被清空，备份作业随后失败
+        self.qemu.fail = True
+
+        with self.assertRaises(CommandExecFailed):
+            self.backup_disk(full=True)
+
+        self.assertEqual(self.qemu.executed('block-dirty-bitmap-remove'),
+                         [{'node': 'drive-virtio-disk0', 'name': 'jimvn-backup'}])
+        self.assertNotIn('jimvn-backup', self.qemu.bitmaps)
+        # 失败的备份目标已被删除
+        self.assertEqual(os.listdir(os.path.join(self.tmp_dir, '4b3c')).__len__(), 2)
+
+        self.qemu.fail = False
+        self.assertEqual(self.backup_disk()['mode'], 'full')
+
+    def test_failed_incremental_backup_keeps_bitmap(self):
+        self.backup_disk()
+        self.qemu.fail = True
+
+        with self.assertRaises(CommandExecFailed):
+            self.backup_disk()
+
+        self.assertEqual(self.qemu.executed('block-dirty-bitmap-remove'), list())
+        self.assertIn('jimvn-backup', self.qemu.bitmaps)
+
+        self.qemu.fail = False
+        self.assertEqual(self.backup_disk()['mode'], 'incremental')
+
+
+if __name__ == '__main__':
+    unittest.main()
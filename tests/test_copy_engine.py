@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import errno
+import shutil
+import tempfile
+import unittest
+
+import environment
+from copy_engine import CopyEngine, LocalFile
+
+
+__author__ = 'James Iter'
+__date__ = '2026/10/19'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2026 by James Iter.'
+
+
+class FakeVolume(object):
+    """
+    以本地目录模拟 gfapi.Volume 的 stat、fopen
+    """
+
+    flags = {
+        'rb': os.O_RDONLY,
+        'wb': os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+        'r+b': os.O_RDWR
+    }
+
+    def __init__(self, root=None):
+        self.root = root
+
+    def stat(self, path=None):
+        return os.stat(os.path.join(self.root, path))
+
+    def fopen(self, path=None, mode=None):
+        return LocalFile(path=os.path.join(self.root, path), flags=self.flags[mode])
+
+
+class FailingFile(object):
+
+    def lseek(self, offset=None, whence=None):
+        return offset
+
+    def write(self, data=None):
+        raise IOError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+    def ftruncate(self, length=None):
+        pass
+
+
+class Progress(object):
+
+    def __init__(self):
+        self.calls = list()
+
+    def __call__(self, done, total):
+        self.calls.append((done, total))
+
+
+class TestCopyEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.chunk_size = CopyEngine.chunk_size
+        self.volume_io_size = CopyEngine.volume_io_size
+        # 缩小块大小，使少量数据也能覆盖多块、多线程的路径
+        CopyEngine.chunk_size = 64 * 1024
+        CopyEngine.volume_io_size = 16 * 1024
+
+    def tearDown(self):
+        CopyEngine.chunk_size = self.chunk_size
+        CopyEngine.volume_io_size = self.volume_io_size
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, name=None):
+        return os.path.join(self.tmp_dir, name)
+
+    def make_sparse_file(self, name=None):
+        """
+        数据 / 1 MiB 空洞 / 数据 / 全零数据 / 末尾空洞
+        """
+        path = self.path(name)
+
+        with open(path, 'wb') as f:
+            f.write(os.urandom(200 * 1024 + 123))
+            f.seek(1024 ** 2, os.SEEK_CUR)
+            f.write(os.urandom(100 * 1024))
+            f.write('\0' * 50 * 1024)
+            f.truncate(2 * 1024 ** 2)
+
+        return path
+
+    def assertSameContent(self, src=None, dst=None):
+        with open(src, 'rb') as f_src:
+            with open(dst, 'rb') as f_dst:
+                self.assertEqual(f_src.read(), f_dst.read())
+
+    def test_copy(self):
+        src = self.make_sparse_file('src.img')
+        progress = Progress()
+
+        method = CopyEngine.copy(src=src, dst=self.path('dst.img'), progress=progress)
+
+        self.assertIn(method, ['reflink', 'copy_file_range', 'sendfile', 'read_write'])
+        self.assertSameContent(src=src, dst=self.path('dst.img'))
+        self.assertEqual(progress.calls[-1], (os.path.getsize(src), os.path.getsize(src)))
+
+    def test_copy_falls_back_to_read_write(self):
+        src = self.make_sparse_file('src.img')
+
+        def unsupported(**kwargs):
+            raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+
+        saved = CopyEngine.reflink, CopyEngine.copy_file_range, CopyEngine.sendfile
+        CopyEngine.reflink = classmethod(lambda cls, **kwargs: False)
+        CopyEngine.copy_file_range = staticmethod(unsupported)
+        CopyEngine.sendfile = staticmethod(unsupported)
+
+        try:
+            method = CopyEngine.copy(src=src, dst=self.path('dst.img'))
+
+        finally:
+            CopyEngine.reflink, CopyEngine.copy_file_range, CopyEngine.sendfile = saved
+
+        self.assertEqual(method, 'read_write')
+        self.assertSameContent(src=src, dst=self.path('dst.img'))
+        # 空洞未被写入，目标文件保持稀疏
+        self.assertLess(os.stat(self.path('dst.img')).st_blocks * 512, os.path.getsize(src))
+
+    def test_read_write_handles_short_writes(self):
+        src = self.make_sparse_file('src.img')
+        write = os.write
+
+        def short_write(fd, data):
+            return write(fd, data[:4096])
+
+        fd_src = os.open(src, os.O_RDONLY)
+        fd_dst = os.open(self.path('dst.img'), os.O_WRONLY | os.O_CREAT, 0644)
+        os.write = short_write
+
+        try:
+            copied = CopyEngine.read_write(fd_src=fd_src, fd_dst=fd_dst, offset=0, length=64 * 1024)
+
+        finally:
+            os.write = write
+            os.close(fd_src)
+            os.close(fd_dst)
+
+        self.assertEqual(copied, 64 * 1024)
+
+        with open(src, 'rb') as f:
+            self.assertEqual(f.read(64 * 1024), open(self.path('dst.img'), 'rb').read())
+
+    def test_copy_empty_file(self):
+        open(self.path('src.img'), 'wb').close()
+
+        CopyEngine.copy(src=self.path('src.img'), dst=self.path('dst.img'))
+
+        self.assertEqual(os.path.getsize(self.path('dst.img')), 0)
+
+    def test_copy_by_volume(self):
+        src = self.make_sparse_file('src.img')
+        progress = Progress()
+
+        CopyEngine.copy_by_volume(volume=FakeVolume(root=self.tmp_dir), src='src.img', dst='dst.img', workers=4,
+                                  progress=progress)
+
+        self.assertSameContent(src=src, dst=self.path('dst.img'))
+        self.assertEqual(progress.calls[-1], (os.path.getsize(src), os.path.getsize(src)))
+
+        for i in range(1, progress.calls.__len__()):
+            self.assertGreaterEqual(progress.calls[i][0], progress.calls[i - 1][0])
+
+    def test_copy_by_volume_meters_actual_io(self):
+        src = self.make_sparse_file('src.img')
+        io = {'read': 0, 'written': 0}
+
+        def meter(read=0, written=0):
+            io['read'] += read
+            io['written'] += written
+
+        CopyEngine.copy_by_volume(volume=FakeVolume(root=self.tmp_dir), src='src.img', dst='dst.img', meter=meter)
+
+        # 空洞未读取，全零块未写入
+        self.assertLessEqual(io['read'], os.path.getsize(src))
+        self.assertGreaterEqual(io['written'], 300 * 1024 + 123)
+        self.assertLess(io['written'], io['read'])
+
+    def test_copy_by_reflink_is_not_metered(self):
+        src = self.make_sparse_file('src.img')
+        calls = list()
+
+        saved = CopyEngine.reflink
+        CopyEngine.reflink = classmethod(lambda cls, **kwargs: True)
+
+        try:
+            method = CopyEngine.copy(src=src, dst=self.path('dst.img'),
+                                     meter=lambda read=0, written=0: calls.append((read, written)))
+
+        finally:
+            CopyEngine.reflink = saved
+
+        self.assertEqual(method, 'reflink')
+        self.assertEqual(calls, [])
+
+    def test_copy_by_volume_raises_worker_error(self):
+        self.make_sparse_file('src.img')
+        volume = FakeVolume(root=self.tmp_dir)
+        fopen = volume.fopen
+
+        def fopen_read_only_dst(path=None, mode=None):
+            if path == 'dst.img' and mode == 'r+b':
+                raise IOError(errno.EACCES, os.strerror(errno.EACCES))
+
+            return fopen(path=path, mode=mode)
+
+        volume.fopen = fopen_read_only_dst
+
+        with self.assertRaises(IOError):
+            CopyEngine.copy_by_volume(volume=volume, src='src.img', dst='dst.img')
+
+    def test_fan_out(self):
+        src = self.make_sparse_file('src.img')
+        size = os.path.getsize(src)
+        names = ['dst0.img', 'dst1.img', 'dst2.img']
+        progresses = [Progress(), None, Progress()]
+
+        with LocalFile(path=src) as f_src:
+            f_dsts = [LocalFile(path=self.path(name), flags=os.O_RDWR | os.O_CREAT) for name in names]
+
+            try:
+                errors = CopyEngine.fan_out(f_src=f_src, f_dsts=f_dsts, size=size, progresses=progresses)
+
+            finally:
+                for f_dst in f_dsts:
+                    f_dst.close()
+
+        self.assertEqual(errors, [None, None, None])
+
+        for name in names:
+            self.assertSameContent(src=src, dst=self.path(name))
+
+        self.assertEqual(progresses[0].calls[-1], (size, size))
+        self.assertEqual(progresses[2].calls[-1], (size, size))
+
+    def test_fan_out_isolates_failed_target(self):
+        src = self.make_sparse_file('src.img')
+        size = os.path.getsize(src)
+        progresses = [Progress(), Progress()]
+
+        with LocalFile(path=src) as f_src:
+            with LocalFile(path=self.path('dst.img'), flags=os.O_RDWR | os.O_CREAT) as f_dst:
+                errors = CopyEngine.fan_out(f_src=f_src, f_dsts=[FailingFile(), f_dst], size=size,
+                                            progresses=progresses)
+
+        self.assertIsInstance(errors[0], IOError)
+        self.assertIsNone(errors[1])
+        self.assertSameContent(src=src, dst=self.path('dst.img'))
+        # 失败的目标不会收到完成的进度
+        self.assertNotIn((size, size), progresses[0].calls)
+        self.assertEqual(progresses[1].calls[-1], (size, size))
+
+
+if __name__ == '__main__':
+    unittest.main()
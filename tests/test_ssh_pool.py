@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import time
+import threading
+import unittest
+
+import environment
+from utils import Utils, SSHPool
+
+
+__author__ = 'James Iter'
+__date__ = '2026/10/19'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2026 by James Iter.'
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.active = True
+        self.keepalive = None
+
+    def is_active(self):
+        return self.active
+
+    def set_keepalive(self, interval=None):
+        self.keepalive = interval
+
+
+class FakeChannel(object):
+
+    def __init__(self, exit_status=None):
+        self.exit_status = exit_status
+
+    def recv_exit_status(self):
+        return self.exit_status
+
+
+class FakeStream(object):
+
+    def __init__(self, read=None, channel=None):
+        self._read = read
+        self.channel = channel
+
+    def read(self):
+        return self._read()
+
+    def close(self):
+        pass
+
+
+class FakeClient(object):
+    """
+    模拟 paramiko.SSHClient。run(cmd) 返回 (exit_status, stdout 的读取函数, stderr 的读取函数)
+    """
+
+    def __init__(self, run=None):
+        self.transport = FakeTransport()
+        self.closed = False
+        self.run = run
+
+    def get_transport(self):
+        return self.transport
+
+    def exec_command(self, cmd, timeout=None):
+        exit_status, read_out, read_err = self.run(cmd)
+        channel = FakeChannel(exit_status=exit_status)
+        return FakeStream(), FakeStream(read=read_out, channel=channel), FakeStream(read=read_err, channel=channel)
+
+    def close(self):
+        self.closed = True
+
+
+class TestSSHPool(unittest.TestCase):
+
+    def setUp(self):
+        self.ssh_client = Utils.ssh_client
+        self.idle_timeout = SSHPool.idle_timeout
+        self.created = list()
+        self.run = lambda cmd: (0, lambda: cmd, lambda: '')
+
+        def ssh_client(hostname, user):
+            client = FakeClient(run=lambda cmd: self.run(cmd))
+            self.created.append(client)
+            return client
+
+        Utils.ssh_client = staticmethod(ssh_client)
+        SSHPool.clients.clear()
+
+    def tearDown(self):
+        Utils.ssh_client = self.ssh_client
+        SSHPool.idle_timeout = self.idle_timeout
+        SSHPool.clients.clear()
+
+    def test_reuses_connection(self):
+        self.assertEqual(SSHPool.exec_command(hostname='h1', user='root', cmd='echo a'), (0, u'echo a', u''))
+        self.assertEqual(SSHPool.exec_command(hostname='h1', user='root', cmd='echo b'), (0, u'echo b', u''))
+        self.assertEqual(self.created.__len__(), 1)
+        self.assertEqual(self.created[0].transport.keepalive, 30)
+
+        SSHPool.exec_command(hostname='h2', user='root', cmd='echo c')
+        self.assertEqual(self.created.__len__(), 2)
+
+    def test_reconnects_dead_transport(self):
+        SSHPool.exec_command(hostname='h1', user='root', cmd='true')
+        self.created[0].transport.active = False
+
+        SSHPool.exec_command(hostname='h1', user='root', cmd='true')
+
+        self.assertEqual(self.created.__len__(), 2)
+        self.assertTrue(self.created[0].closed)
+        self.assertFalse(self.created[1].closed)
+
+    def test_reconnects_after_idle_timeout(self):
+        SSHPool.idle_timeout = 0.05
+        SSHPool.exec_command(hostname='h1', user='root', cmd='true')
+        SSHPool.exec_command(hostname='h1', user='root', cmd='true')
+        self.assertEqual(self.created.__len__(), 1)
+
+        time.sleep(0.1)
+        SSHPool.exec_command(hostname='h1', user='root', cmd='true')
+
+        self.assertEqual(self.created.__len__(), 2)
+        self.assertTrue(self.created[0].closed)
+
+    def test_keeps_idle_timed_out_connection_in_use(self):
+        SSHPool.idle_timeout = 0.05
+
+        with SSHPool.use(hostname='h1', user='root'):
+            time.sleep(0.1)
+            # 另一个使用者到来时，连接仍在被使用，不因空闲超时而被替换
+            SSHPool.exec_command(hostname='h1', user='root', cmd='true')
+
+            self.assertEqual(self.created.__len__(), 1)
+            self.assertFalse(self.created[0].closed)
+
+    def test_close_waits_for_users(self):
+        with SSHPool.use(hostname='h1', user='root'):
+            SSHPool.close(hostname='h1', user='root')
+            self.assertFalse(self.created[0].closed)
+
+        self.assertTrue(self.created[0].closed)
+
+    def test_concurrent_exec_command(self):
+        def run(cmd):
+            def read_out():
+                time.sleep(0.2)
+                return cmd
+
+            return 0, read_out, lambda: ''
+
+        self.run = run
+        results = dict()
+
+        def worker(i):
+            results[i] = SSHPool.exec_command(hostname='h1', user='root', cmd='echo ' + str(i))
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+        begin = time.time()
+
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        # 同一连接上的命令并行执行，且只建立一个连接
+        self.assertLess(time.time() - begin, 0.2 * 8 / 2)
+        self.assertEqual(self.created.__len__(), 1)
+        self.assertEqual(results, dict([(i, (0, u'echo ' + str(i), u'')) for i in range(8)]))
+
+    def test_drains_stderr_while_reading_stdout(self):
+        stderr_read = threading.Event()
+
+        def read_out():
+            # 远程命令在 stderr 被读取前阻塞，不会结束 stdout
+            stderr_read.wait(2)
+            return 'out' if stderr_read.is_set() else 'blocked'
+
+        def read_err():
+            stderr_read.set()
+            return 'err'
+
+        self.run = lambda cmd: (1, read_out, read_err)
+
+        self.assertEqual(SSHPool.exec_command(hostname='h1', user='root', cmd='noisy'), (1, u'out', u'err'))
+
+    def test_raises_stderr_error(self):
+        def read_err():
+            raise IOError('channel closed')
+
+        self.run = lambda cmd: (0, lambda: '', read_err)
+
+        with self.assertRaises(IOError):
+            SSHPool.exec_command(hostname='h1', user='root', cmd='true')
+
+
+if __name__ == '__main__':
+    unittest.main()